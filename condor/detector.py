@@ -52,6 +52,7 @@ from condor.utils.pixelmask import PixelMask
 from condor.utils.linalg import length
 import condor.utils.testing
 import condor.utils.scattering_vector
+from condor.utils.cache import LRUCache
 
 
 class Detector:
@@ -155,6 +156,7 @@ class Detector:
         self.saturation_level = saturation_level
         self.binning = binning
         self.solid_angle_correction = solid_angle_correction
+        self.geometry_cache = DetectorGeometryCache(self)
 
     def get_conf(self):
         """
@@ -183,8 +185,9 @@ class Detector:
         conf["detector"]["noise_dataset"]      = self._noise_dataset
         conf["detector"]["saturation_level"]   = self.saturation_level
         conf["detector"]["mask"]               = self._mask.copy()
-        conf["detector"]["mask_CXI_bitmask"]   = True
+        conf["detector"]["mask_is_cxi_bitmask"] = True
         conf["detector"]["solid_angle_correction"] = self.solid_angle_correction
+        conf["detector"]["binning"]            = self.binning
         return conf
         
     def set_noise(self, noise=None, noise_spread=None, noise_variation_n=None, noise_filename=None, noise_dataset=None):
@@ -344,6 +347,17 @@ class Detector:
         else:
             return self.cy_mean
         
+    def get_all_center_positions(self):
+        """
+        Return the finite list of beam center positions (``cx``, ``cy``) that are iterated if the center variation is set to ``'range'``. For all other center variation models ``None`` is returned
+        """
+        g = self._center_variation.get_grid()
+        if g is None:
+            return None
+        cx_mean = self.get_cx_mean_value()
+        cy_mean = self.get_cy_mean_value()
+        return [(cx_mean + dcx, cy_mean + dcy) for dcx, dcy in g.T]
+        
     def get_next(self):
         """
         Iterate the parameters of the Detector instance and return them as a dictionary
@@ -397,10 +411,10 @@ class Detector:
 
           :cy (float): *y*-coordinate of the center position in unit pixel
         """
-        Y, X = numpy.meshgrid(numpy.float64(numpy.arange(self._ny))-cy,
-                              numpy.float64(numpy.arange(self._nx))-cx,
-                              indexing="ij")
-        return self.get_pixel_solid_angle(X, Y)
+        # The angles subtended by a pixel in x and y are separable, evaluate them on one row and one column only
+        X = (numpy.float64(numpy.arange(self._nx))-cx)[numpy.newaxis,:]
+        Y = (numpy.float64(numpy.arange(self._ny))-cy)[:,numpy.newaxis]
+        return self.get_pixel_solid_angle(X, Y) * numpy.ones(shape=(self._ny, self._nx))
     
     def _get_xy_max_dist(self, cx = None, cy = None, center_variation = False):
         dist_max = []
@@ -548,7 +562,7 @@ class Detector:
         X, Y = self.generate_xypix(cx, cy)
         return condor.utils.scattering_vector.generate_qmap(X, Y, self.pixel_size, self.distance, wavelength, extrinsic_rotation=extrinsic_rotation, order=order)
 
-    def generate_qmap_3d(self, wavelength, qn=None, qmax=None, extrinsic_rotation=None, order='xyz'):
+    def generate_qmap_3d(self, wavelength, qn=None, qmax=None, extrinsic_rotation=None, order='xyz', slab=None):
         if qn is None and qmax is None:
             qn = max([self._nx, self._ny])
             qmax = self.get_q_max(wavelength, pos="edge")
@@ -557,7 +571,7 @@ class Detector:
         else:
             log_and_raise_error(logger, "Either none or both optional arguments qn and qmax have to be passed to this function.")
             return
-        return condor.utils.scattering_vector.generate_qmap_3d(qn=qn, qmax=qmax, extrinsic_rotation=extrinsic_rotation, order=order)
+        return condor.utils.scattering_vector.generate_qmap_3d(qn=qn, qmax=qmax, extrinsic_rotation=extrinsic_rotation, order=order, slab=slab)
 
     #def generate_rpix_3d(self, qmax, qn, wavelength):
     #    return condor.utils.scattering_vector.generate_rpix_3d(qn, qmax, wavelength, self.distance, self.pixel_size):
@@ -570,27 +584,56 @@ class Detector:
             P = condor.utils.diffraction.polarization_factor(X*self.pixel_size, Y*self.pixel_size, self.distance, polarization=polarization)
         return P
     
-    def detect_photons(self, I):
+    def detect_photons(self, I, random_state=None):
         """
         Return measurement of intensities from an array of expectation values of intensities. This method also returns the mask of the pattern
 
         Args:
           :I (array): Intensity pattern represented as 2D array
+
+        Kwargs:
+          :random_state: :class:`numpy.random.RandomState` instance from which the noise is drawn. If ``None`` the global random number generator of NumPy is used (default ``None``)
         """
-        I_det = self._noise.get(I)
+        return self._detect_photons(I, many=False, random_state=random_state)
+
+    def detect_photons_many(self, I, random_state=None):
+        """
+        Return measurements of intensities from a stack of arrays of expectation values of intensities (the first axis indexes the shots). For a stack of 2D patterns this method also returns the stack of masks
+
+        Args:
+          :I (array): Intensity patterns represented as 3D array (stack of 2D patterns) or 4D array (stack of 3D volumes)
+
+        Kwargs:
+          :random_state: :class:`numpy.random.RandomState` instance from which the noise is drawn. If ``None`` the global random number generator of NumPy is used (default ``None``)
+        """
+        return self._detect_photons(I, many=True, random_state=random_state)
+
+    def _detect_photons(self, I, many, random_state):
+        # Noise, background, saturation and mask of detect_photons (many=False) and detect_photons_many (many=True, the first axis of I indexes the shots)
+        r = numpy.random if random_state is None else random_state
+        I_det = self._noise.get(I, random_state=random_state)
         if self._noise_filename is not None:
             import h5py
             with h5py.File(self._noise_filename,"r") as f:
                 ds = f[self._noise_dataset]
                 if len(list(ds.shape)) == 2:
                     bg = ds[:,:]
+                elif many:
+                    # Every shot gets its own background
+                    bg = numpy.array([ds[i,:,:] for i in r.randint(ds.shape[0], size=I_det.shape[0])])
                 else:
-                    bg = ds[numpy.random.randint(ds.shape[0]),:,:]
+                    bg = ds[r.randint(ds.shape[0]),:,:]
             I_det = I_det + bg
         if self.saturation_level is not None:
             I_det = numpy.clip(I_det, -numpy.inf, self.saturation_level)
-        if I_det.ndim == 2:
-            M_det = self.get_mask(I_det)
+        if not many:
+            M_det = self.get_mask(I_det) if I_det.ndim == 2 else None
+        elif I_det.ndim == 3:
+            if not condor.utils.testing.same_shape(I_det[0], self._mask):
+                log_and_raise_error(logger, "Intensities and mask do not have the same shape")
+            M_det = numpy.repeat(self._mask[numpy.newaxis,:,:], I_det.shape[0], axis=0)
+            if self.saturation_level is not None:
+                M_det[I_det >= self.saturation_level] |= PixelMask.PIXEL_IS_SATURATED
         else:
             M_det = None
         return I_det, M_det
@@ -614,3 +657,154 @@ class Detector:
 
 
         
+
+
+class DetectorGeometryCache:
+    """
+    Cache for per-pixel maps that depend only on the detector geometry, the beam center position and the wavelength (solid angles, polarization factors, lengths of the scattering vectors and resolution elements)
+
+    Entries are keyed by the detector geometry (number of pixels, pixel size and distance), the beam center position and - where applicable - the wavelength. Changing the geometry of the detector therefore never returns stale values. Cached arrays are read-only.
+
+    An instance is created with every :class:`condor.detector.Detector` instance and accessible through its attribute ``geometry_cache``.
+
+    Args:
+      :detector: Detector instance
+
+    Kwargs:
+      :maxsize (int): Maximum number of cached maps. If ``None`` the number of cached maps is not limited (default ``32``)
+    """
+    def __init__(self, detector, maxsize=32):
+        self._detector = detector
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def _get_key(self, name, cx, cy, *args):
+        d = self._detector
+        cx = d.get_cx_mean_value() if cx is None else cx
+        cy = d.get_cy_mean_value() if cy is None else cy
+        return (name, d._nx, d._ny, d.pixel_size, d.distance, float(cx), float(cy)) + args
+
+    def _get(self, key, func, *args, **kwargs):
+        value = self._cache.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            if isinstance(value, numpy.ndarray):
+                value.setflags(write=False)
+            self._cache.put(key, value)
+        return value
+
+    def get_solid_angles(self, cx, cy):
+        """
+        Return the solid angles of all detector pixels (see :meth:`condor.detector.Detector.get_all_pixel_solid_angles`)
+
+        Args:
+          :cx (float): *x*-coordinate of the center position in unit pixel
+
+          :cy (float): *y*-coordinate of the center position in unit pixel
+        """
+        key = self._get_key("solid_angles", cx, cy)
+        return self._get(key, self._detector.get_all_pixel_solid_angles, cx, cy)
+
+    def get_polarization_factors(self, cx, cy, polarization="ignore"):
+        """
+        Return the polarization factors of all detector pixels (see :meth:`condor.detector.Detector.calculate_polarization_factors`)
+
+        Args:
+          :cx (float): *x*-coordinate of the center position in unit pixel
+
+          :cy (float): *y*-coordinate of the center position in unit pixel
+
+        Kwargs:
+          :polarization (str): Type of polarization (default ``'ignore'``)
+        """
+        key = self._get_key("polarization", cx, cy, polarization)
+        return self._get(key, self._detector.calculate_polarization_factors, cx=cx, cy=cy, polarization=polarization)
+
+    def get_q_abs(self, wavelength, cx, cy):
+        """
+        Return the lengths of the scattering vectors of all detector pixels
+
+        Args:
+          :wavelength (float): Photon wavelength in meters
+
+          :cx (float): *x*-coordinate of the center position in unit pixel
+
+          :cy (float): *y*-coordinate of the center position in unit pixel
+        """
+        key = self._get_key("q_abs", cx, cy, wavelength)
+        return self._get(key, self._calculate_q_abs, wavelength, cx, cy)
+
+    def _calculate_q_abs(self, wavelength, cx, cy):
+        qmap = self._detector.generate_qmap(wavelength, cx=cx, cy=cy, extrinsic_rotation=None)
+        return numpy.sqrt((qmap**2).sum(axis=2))
+        
+    def get_resolution_element_r(self, wavelength, cx=None, cy=None, center_variation=False):
+        """
+        Return resolution at the furthest corner position in 1/meters (see :meth:`condor.detector.Detector.get_resolution_element_r`)
+
+        Args:
+          :wavelength (float): Photon wavelength in meters
+
+        Kwargs:
+          :cx (float): *x*-coordinate of the center position in unit pixel (default ``None``)
+
+          :cy (float): *y*-coordinate of the center position in unit pixel (default ``None``)
+
+          :center_variation (bool): If ``True`` the beam center variation is taken into account (default ``False``)
+        """
+        cv = self._detector._center_variation
+        args = (wavelength, center_variation)
+        if center_variation:
+            args += (cv.get_mode(), repr(cv.get_spread()))
+        key = self._get_key("resolution_element_r", cx, cy, *args)
+        return self._get(key, self._detector.get_resolution_element_r, wavelength, cx=cx, cy=cy, center_variation=center_variation)
+
+    def precompute(self, wavelength=None, polarization="ignore", centers=None):
+        """
+        Calculate and cache the maps for a list of beam center positions. The maximum size of the cache is increased if it cannot hold all maps
+
+        Kwargs:
+          :wavelength (float): Photon wavelength in meters. If ``None`` only maps that do not depend on the wavelength are calculated (default ``None``)
+
+          :polarization (str): Type of polarization (default ``'ignore'``)
+
+          :centers (list): List of beam center positions (``cx``, ``cy``). If ``None`` all positions of the center variation ``'range'`` are used (see :meth:`condor.detector.Detector.get_all_center_positions`) or the mean center position for any other center variation (default ``None``)
+        """
+        d = self._detector
+        if centers is None:
+            centers = d.get_all_center_positions()
+            if centers is None:
+                centers = [(d.get_cx_mean_value(), d.get_cy_mean_value())]
+        n_maps = int(d.solid_angle_correction) + int(polarization != "ignore") + (2 if wavelength is not None else 0)
+        maxsize = self._cache.get_info()["maxsize"]
+        if maxsize is not None and maxsize < n_maps*len(centers):
+            log_debug(logger, "Increasing size of detector geometry cache from %i to %i." % (maxsize, n_maps*len(centers)))
+            self._cache.set_maxsize(n_maps*len(centers))
+        for cx, cy in centers:
+            if d.solid_angle_correction:
+                self.get_solid_angles(cx, cy)
+            if polarization != "ignore":
+                self.get_polarization_factors(cx, cy, polarization=polarization)
+            if wavelength is not None:
+                self.get_q_abs(wavelength, cx, cy)
+                self.get_resolution_element_r(wavelength, cx=cx, cy=cy, center_variation=False)
+
+    def set_maxsize(self, maxsize):
+        """
+        Set the maximum number of cached maps
+
+        Args:
+          :maxsize (int): Maximum number of cached maps. If ``None`` the number of cached maps is not limited
+        """
+        self._cache.set_maxsize(maxsize)
+
+    def get_info(self):
+        """
+        Return a dictionary with the numbers of hits, misses and evictions of the cache and its current and maximum size
+        """
+        return self._cache.get_info()
+
+    def clear(self):
+        """
+        Remove all cached maps
+        """
+        self._cache.clear()
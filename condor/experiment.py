@@ -49,9 +49,16 @@ import condor.utils.spheroid_diffraction
 import condor.utils.scattering_vector
 import condor.utils.resample
 from condor.utils.rotation import Rotation
+from condor.utils.cache import LRUCache
 import condor.particle
 import condor.utils.nfft
+import condor.utils.symmetry
+import condor.fourier_volume
 
+# Maximum number of particles that are evaluated together in one broadcasted pass
+_BATCH_SIZE = 32
+# Maximum number of scattering vectors that are transformed together in one NFFT by propagate_orientations
+_ORIENTATIONS_BATCH_POINTS = 2**19
 
 def experiment_from_configfile(configfile):
     """
@@ -134,7 +141,10 @@ class Experiment:
                 log_and_raise_error(logger, "The particle model name %s is invalid. The name has to start with either particle_sphere, particle_spheroid, particle_map or particle_atoms.")
         self.particles = particles
         self.detector  = detector
-        self._qmap_cache = {}
+        self._qmap_cache = LRUCache(maxsize=8)
+        self._qmap_last = None
+        self._nfft_plans = LRUCache(maxsize=2)
+        self._fourier_volume_sampler = None
 
     def get_conf(self):
         """
@@ -172,21 +182,529 @@ class Experiment:
     def propagate(self, save_map3d=False, save_qmap=False):
         return self._propagate(save_map3d=save_map3d, save_qmap=save_qmap, ndim=2)
 
-    def propagate3d(self, qn=None, qmax=None):
-        return self._propagate(ndim=3, qn=qn, qmax=qmax)
-    
-    def _propagate(self, save_map3d=False, save_qmap=False, ndim=2, qn=None, qmax=None):
+    def propagate3d(self, qn=None, qmax=None, symmetry=False):
+        """
+        Propagate one shot and return the 3D Fourier volume on a regular grid of scattering vectors
+
+        The volume of a map particle is calculated with FFTs on the regular grid (see :func:`condor.utils.nfft.nfft_grid`) if the particle is not rotated or if its rotation maps the grid onto itself (rotations by multiples of 90 degrees about the grid axes). Only other rotations require an NFFT at all scattering vectors of the volume.
+
+        With ``symmetry=True`` the volume of a map particle is only calculated on the part of the grid that is not related to the rest by a symmetry of the map and is then expanded (see :mod:`condor.utils.symmetry`). On the regular grid these are the reflections through the center of the map and the Friedel symmetry of maps that are real up to a global phase (one material). The volume of a cube or an icosahedron is reduced to one octant of the grid, the volume of an arbitrarily rotated map of one material to one half.
+
+        Kwargs:
+          :qn (int): Number of grid points along every dimension. If ``None`` the larger number of pixels of the detector is used (default ``None``)
+
+          :qmax (float): Largest scattering vector component in unit inverse meter. If ``None`` the scattering vector at the edge of the detector is used (default ``None``)
+
+          :symmetry (bool): If ``True`` symmetries of map particles are used to reduce the calculation (default ``False``)
+        """
+        return self._propagate(ndim=3, qn=qn, qmax=qmax, symmetry=symmetry)
+
+    @log_execution_time(logger)
+    def propagate_many(self, n, save_map3d=False, save_qmap=False):
+        """
+        Propagate ``n`` shots and return the results stacked along a leading shot axis
+
+        The parameters of all shots are drawn before any pattern is calculated. If all particle models are spheres or spheroids the form factors of all shots are evaluated in broadcasted passes over the shot axis, otherwise the shots are calculated one after the other.
+
+        The output dictionary has the same layout as the output of :meth:`condor.experiment.Experiment.propagate`. The arrays in ``entry_1`` have the shape ``(n, ny, nx)`` and every parameter in ``source``, ``particles`` and ``detector`` is an array with one value per shot. Parameters of particles that are missing in a shot are set to ``nan``.
+
+        Args:
+          :n (int): Number of shots
+
+        Kwargs:
+          :save_map3d (bool): If ``True`` the refractive index maps of map particles are included in the output (default ``False``)
+
+          :save_qmap (bool): If ``True`` the scattering vectors are included in the output (default ``False``)
+        """
+        return self._propagate_many(n, save_map3d=save_map3d, save_qmap=save_qmap, ndim=2)
+
+    def propagate3d_many(self, n, qn=None, qmax=None, symmetry=False):
+        """
+        Propagate ``n`` 3D Fourier volumes and return the results stacked along a leading shot axis (see also :meth:`condor.experiment.Experiment.propagate_many` and :meth:`condor.experiment.Experiment.propagate3d`)
+
+        Args:
+          :n (int): Number of shots
+        """
+        return self._propagate_many(n, ndim=3, qn=qn, qmax=qmax, symmetry=symmetry)
+
+    def propagate3d_to_file(self, filename, qn=None, qmax=None, slab_size=16, resume=True):
+        """
+        Propagate one 3D Fourier volume (see :meth:`condor.experiment.Experiment.propagate3d`) and write it slab by slab into a CXI (HDF5) file
+
+        The volume is evaluated in slabs of ``slab_size`` planes along the z-axis. Every slab is written into chunked datasets right away, the memory consumption is therefore proportional to the size of one slab and not to the size of the volume. The file has the same layout as a file written by :class:`condor.utils.cxiwriter.CXIWriter` with the output of :meth:`condor.experiment.Experiment.propagate3d`.
+
+        After every slab the index of the next plane is stored in the attribute ``next_slab`` of the group ``/entry_1/data_1``. If the propagation is interrupted it continues at this plane when the method is called again with ``resume=True``. The parameters of the shot are then read from the file instead of being drawn again.
+
+        Args:
+          :filename (str): Name of the CXI file
+
+        Kwargs:
+          :qn (int): Number of grid points along every dimension. If ``None`` the larger number of pixels of the detector is used (default ``None``)
+
+          :qmax (float): Largest scattering vector component in unit inverse meter. If ``None`` the scattering vector at the edge of the detector is used (default ``None``)
+
+          :slab_size (int): Number of planes per slab (default ``16``)
+
+          :resume (bool): If ``True`` an incomplete volume in an existing file with the same ``qn`` and ``qmax`` is completed. Otherwise the file is overwritten (default ``True``)
+        """
+        import h5py
+        import condor.utils.cxiwriter
+        if slab_size < 1:
+            log_and_raise_error(logger, "slab_size=%s is invalid. The number of planes per slab has to be positive." % str(slab_size))
+            return
+        D_source, D_particles, D_detector = self._get_next_shot()
+        if qmax is None:
+            qmax = numpy.sqrt((self.detector.get_q_max(D_source["wavelength"], pos="edge")**2).sum())
+        if qn is None:
+            qn = max([D_detector["nx"], D_detector["ny"]])
+
+        start = 0
+        if resume and os.path.exists(filename):
+            with h5py.File(filename, "r") as f:
+                if "entry_1/data_1" in f and f["entry_1/data_1"].attrs.get("qn") == qn and f["entry_1/data_1"].attrs.get("qmax") == qmax:
+                    start = int(f["entry_1/data_1"].attrs["next_slab"])
+                    # Continue with the parameters of the interrupted shot
+                    _read_parameters(f["source"], D_source)
+                    for particle_key, D_particle in D_particles.items():
+                        _read_parameters(f["particles"][particle_key], D_particle)
+                    _read_parameters(f["detector"], D_detector)
+                else:
+                    log_warning(logger, "File %s does not contain an incomplete volume with qn=%i and qmax=%e and is being overwritten." % (filename, qn, qmax))
+        if start >= qn:
+            log_info(logger, "Volume in %s is already complete." % filename)
+            return
+
+        f = None
+        try:
+            for k0 in range(start, qn, slab_size):
+                k1 = min(k0 + slab_size, qn)
+                # Copies because the propagation removes private entries from the parameter dictionaries
+                O = self._propagate_shot(dict(D_source), dict([(k, dict(v)) for k, v in D_particles.items()]), dict(D_detector), ndim=3, qn=qn, qmax=qmax, slab=(k0, k1))
+                if f is None:
+                    if k0 == 0:
+                        # Parameters of the shot in the layout of the CXIWriter (stacks of length one)
+                        W = condor.utils.cxiwriter.CXIWriter(filename)
+                        W.write({"source": O["source"], "particles": O["particles"], "detector": O["detector"],
+                                 "entry_1": {"data_1": {"full_period_resolution": O["entry_1"]["data_1"]["full_period_resolution"]}}})
+                        W.close()
+                        f = h5py.File(filename, "r+")
+                        for name in ["data_fourier", "data"]:
+                            dtype = O["entry_1"]["data_1"][name].dtype
+                            f["entry_1/data_1"].create_dataset(name, shape=(1, qn, qn, qn), chunks=(1, 1, qn, qn), dtype=dtype)
+                            f["entry_1/data_1"][name].attrs.modify("axes", ["experiment_identifier:z:y:x".encode('utf8')])
+                        f["entry_1/data_1"].attrs["qn"] = qn
+                        f["entry_1/data_1"].attrs["qmax"] = qmax
+                    else:
+                        f = h5py.File(filename, "r+")
+                for name in ["data_fourier", "data"]:
+                    f["entry_1/data_1"][name][0,k0:k1] = O["entry_1"]["data_1"][name]
+                # The slab index is updated only after the slab has been written
+                f["entry_1/data_1"].attrs["next_slab"] = k1
+                f.flush()
+                log_debug(logger, "Wrote planes %i-%i of %i to %s." % (k0, k1-1, qn, filename))
+        finally:
+            if f is not None:
+                f.close()
+
+    def propagate_orientations(self, quaternions, diameters=None):
+        """
+        Propagate the patterns of a single map particle in many orientations and return the results stacked along a leading orientation axis
+
+        Source, detector and particle parameters are drawn once and shared by all patterns, only the orientation (and optionally the diameter) differs. The rotated scattering vectors of many orientations are concatenated and transformed in one NFFT, such that the oversampled FFT of the map is calculated once for a batch of orientations instead of once per pattern. A diameter only rescales the grid spacing of the map. The map is therefore generated once for the largest diameter.
+
+        The output dictionary has the same layout as the output of :meth:`condor.experiment.Experiment.propagate_many`.
+
+        Args:
+          :quaternions (array): Array of shape (*n*, 4) of quaternions that define the extrinsic rotations of the particle (see :class:`condor.utils.rotation.Rotation`)
+
+        Kwargs:
+          :diameters (array): Array of *n* particle diameters. If ``None`` the drawn diameter is used for all patterns (default ``None``)
+        """
+        quaternions = numpy.asarray(quaternions, dtype=numpy.float64)
+        if quaternions.ndim != 2 or quaternions.shape[1] != 4:
+            log_and_raise_error(logger, "Quaternions must be given as array of shape (n, 4).")
+            return
+        n = quaternions.shape[0]
+
+        D_source, D_particles, D_detector = self._get_next_shot()
+        if len(D_particles) != 1 or not isinstance(list(D_particles.values())[0]["_class_instance"], condor.particle.ParticleMap):
+            log_and_raise_error(logger, "Propagating many orientations requires exactly one particle per shot that is an instance of ParticleMap.")
+            return
+        particle_key, D_particle = list(D_particles.items())[0]
+        p = D_particle["_class_instance"]
+
+        if diameters is None:
+            diameters = D_particle["diameter"] * numpy.ones(n)
+        else:
+            diameters = numpy.asarray(diameters, dtype=numpy.float64)
+            if diameters.shape != (n,):
+                log_and_raise_error(logger, "The number of diameters (%s) does not match the number of quaternions (%i)." % (str(diameters.shape), n))
+                return
+
+        # Pull out variables
+        nx                  = D_detector["nx"]
+        ny                  = D_detector["ny"]
+        cx                  = D_detector["cx"]
+        cy                  = D_detector["cy"]
+        pixel_size          = D_detector["pixel_size"]
+        detector_distance   = D_detector["distance"]
+        wavelength          = D_source["wavelength"]
+
+        # Intensity at interaction point and primary wave amplitude
+        D_particle["intensity"] = self.source.get_intensity(D_particle["position"], "ph/m2", pulse_energy=D_source["pulse_energy"])
+        F0 = numpy.sqrt(D_particle["intensity"])*2*numpy.pi/wavelength**2
+        D_particle["F0"] = F0
+
+        # Solid angles
+        if self.detector.solid_angle_correction:
+            Omega_p = self.detector.geometry_cache.get_solid_angles(cx, cy)
+        else:
+            Omega_p = pixel_size**2 / detector_distance**2
+
+        # Map for the largest diameter. Smaller diameters are sampled with a proportionally smaller grid spacing.
+        dx_required  = self.detector.geometry_cache.get_resolution_element_r(wavelength, cx=cx, cy=cy, center_variation=False)
+        dx_suggested = self.detector.geometry_cache.get_resolution_element_r(wavelength, center_variation=True)
+        D_particle["diameter"] = diameters.max()
+        accuracy = p.get_accuracy_parameters()
+        maps, dn, dx, origins = p.get_new_material_maps_cropped(D_particle, dx_required, dx_suggested / accuracy["map_oversampling"], wavelength)
+        dxs = dx * diameters / diameters.max()
+
+        F_tot = numpy.zeros(shape=(n, ny, nx), dtype=numpy.complex128)
+        batch = max(1, _ORIENTATIONS_BATCH_POINTS // (nx*ny))
+        for i0 in range(0, n, batch):
+            i1 = min(i0 + batch, n)
+            # Concatenated scattering vectors of all orientations in this batch (the nfft requires order z,y,x)
+            qmap_scaled = numpy.empty(shape=(i1-i0, ny, nx, 3), dtype=numpy.float64)
+            for i in range(i0, i1):
+                extrinsic_rotation = Rotation(values=quaternions[i], formalism="quaternion")
+                qmap = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=extrinsic_rotation, order="zyx")
+                qmap_scaled[i-i0] = dxs[i] * qmap / (2. * numpy.pi)
+            qmap_shaped = qmap_scaled.reshape(int(qmap_scaled.size/3), 3)
+            # Check inputs
+            invalid_mask = ~((qmap_shaped>=-0.5) * (qmap_shaped<0.5))
+            if numpy.any(invalid_mask):
+                qmap_shaped[invalid_mask] = 0.
+                log_warning(logger, "%i invalid pixel positions." % invalid_mask.sum())
+            # NFFT
+            nfft_plan = self._get_nfft_plan(maps.shape[1:], qmap_shaped.shape[0], m=accuracy["m"], sigma=accuracy["sigma"])
+            nfft_plan["plan"].set_coordinates(qmap_shaped)
+            nfft_plan["coordinates_key"] = None
+            nfft_plan["transforms"] = None
+            fourier_pattern = dn.dot(self._get_nfft_transforms(nfft_plan, maps, origins, qmap_shaped, invalid_mask))
+            F_tot[i0:i1] = fourier_pattern.reshape(i1-i0, ny, nx) * (F0 * dxs[i0:i1]**3).reshape(i1-i0, 1, 1)
+        F_tot *= numpy.sqrt(Omega_p)
+
+        # Phase factor of the particle position
+        qmap0 = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=None, order="xyz")
+        F_tot = _apply_phase_factors(F_tot, numpy.array([D_particle["position"]]), qmap0)
+
+        # Polarization correction
+        F_tot *= numpy.sqrt(self.detector.geometry_cache.get_polarization_factors(cx, cy, polarization=self.source.polarization))
+
+        shots = []
+        for q, d in zip(quaternions, diameters):
+            D_particle_i = dict(D_particle)
+            D_particle_i["extrinsic_quaternion"] = q
+            D_particle_i["diameter"] = d
+            shots.append((D_source, {particle_key: D_particle_i}, D_detector))
+        return self._get_output_many(shots, F_tot, ndim=2)
+
+    def iter_propagate(self, n=None, prefetch=2, workers=1, processes=False, save_map3d=False, save_qmap=False):
+        """
+        Generator that yields the outputs of :meth:`condor.experiment.Experiment.propagate` for ``n`` shots while up to ``prefetch`` following shots are calculated ahead by background workers
+
+        The shot parameters are drawn in the calling thread and the outputs are yielded in that order. The photon noise of every shot is drawn from its own seeded random number generator, with a fixed seed of the global random number generator of NumPy the outputs are therefore reproducible. Calculations are submitted only if fewer than ``prefetch`` shots are pending (backpressure). When the consumer stops iterating (``break``, ``close()`` or garbage collection of the generator) pending shots are cancelled and the workers are shut down.
+
+        .. code-block:: python
+
+          for res in E.iter_propagate(n=1000, prefetch=4, workers=4):
+              consume(res)
+
+        Kwargs:
+          :n (int): Number of shots. If ``None`` the generator never stops (default ``None``)
+
+          :prefetch (int): Maximum number of shots calculated ahead of the consumer (default ``2``)
+
+          :workers (int): Number of background workers (default ``1``)
+
+          :processes (bool): If ``True`` the workers are processes, otherwise threads (see :class:`condor.parallel.ExperimentPool`) (default ``False``)
+
+          :save_map3d (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+
+          :save_qmap (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+        """
+        import collections
+        import condor.parallel
+        if prefetch < 1:
+            log_and_raise_error(logger, "prefetch = %i is an invalid input. Has to be at least 1." % prefetch)
+        pool = condor.parallel.ExperimentPool(self, workers=workers, processes=processes)
+        queue = collections.deque()
+        i_submitted = 0
+        try:
+            while True:
+                # The shot that is handed to the consumer next plus up to prefetch shots ahead
+                while len(queue) < prefetch + 1 and (n is None or i_submitted < n):
+                    queue.append(pool.submit(save_map3d=save_map3d, save_qmap=save_qmap))
+                    i_submitted += 1
+                if len(queue) == 0:
+                    break
+                yield queue.popleft().result()
+        finally:
+            for f in queue:
+                f.cancel()
+            pool.close()
+
+    def _propagate_many(self, n, save_map3d=False, save_qmap=False, ndim=2, qn=None, qmax=None, symmetry=False):
 
         if ndim not in [2,3]:
             log_and_raise_error(logger, "ndim = %i is an invalid input. Has to be either 2 or 3." % ndim)
-            
-        log_debug(logger, "Start propagation")
-        
+        if n < 1:
+            log_and_raise_error(logger, "n = %i is an invalid input. The number of shots has to be at least 1." % n)
+
+        log_debug(logger, "Start propagation of %i shots" % n)
+
+        # Draw the parameters of all shots up front
+        shots = [self._get_next_shot() for i in range(n)]
+
+        # The beam center positions are known up front if they are iterated over a range
+        if ndim == 2 and self.detector.get_all_center_positions() is not None:
+            for wavelength in set([D_source["wavelength"] for D_source, D_particles, D_detector in shots]):
+                self.detector.geometry_cache.precompute(wavelength=wavelength, polarization=self.source.polarization)
+
+        if self._is_batchable(ndim) and not save_map3d and not save_qmap:
+            return self._propagate_batch(shots, ndim=ndim, qn=qn, qmax=qmax)
+        else:
+            return stack_dicts([self._propagate_shot(D_source, D_particles, D_detector, save_map3d=save_map3d, save_qmap=save_qmap, ndim=ndim, qn=qn, qmax=qmax, symmetry=symmetry)
+                                for D_source, D_particles, D_detector in shots])
+
+    def _is_batchable(self, ndim):
+        if self._fourier_volume_sampler is not None:
+            return False
+        for p in self.particles.values():
+            if isinstance(p, condor.particle.ParticleSphere):
+                continue
+            if isinstance(p, condor.particle.ParticleSpheroid) and ndim == 2:
+                continue
+            return False
+        return True
+
+    def set_fourier_volume_sampling(self, accuracy=None, maxsize=4):
+        """
+        Enable (or disable) the interpolation of 2D patterns from cached 3D Fourier volumes (see :class:`condor.fourier_volume.FourierVolumeSampler`)
+
+        If enabled the amplitudes of spheres, spheroids and maps in :meth:`propagate` are interpolated from the Fourier volume of the unrotated particle. The volume is calculated once per particle model, wavelength and particle size. Every shot then only costs an interpolation at the rotated scattering vectors instead of a full NFFT. Shots are no longer evaluated in broadcasted passes by :meth:`propagate_many`. Patterns of spheroids are calculated with the full 3D scattering vector and differ from the projected model of the default propagation (see :class:`condor.fourier_volume.FourierVolumeSampler`).
+
+        Kwargs:
+          :accuracy (str): If ``None`` the interpolation is disabled. Otherwise either ``'draft'``, ``'standard'`` or ``'reference'`` (see :class:`condor.fourier_volume.FourierVolumeSampler`) (default ``None``)
+
+          :maxsize (int): Maximum number of cached volumes (default ``4``)
+        """
+        if accuracy is None:
+            self._fourier_volume_sampler = None
+        else:
+            self._fourier_volume_sampler = condor.fourier_volume.FourierVolumeSampler(self.detector, accuracy=accuracy, maxsize=maxsize)
+
+    def get_fourier_volume_sampler(self):
+        """
+        Return the sampler of Fourier volumes (``None`` if the interpolation from Fourier volumes is disabled)
+        """
+        return self._fourier_volume_sampler
+
+    def _get_nfft_plan(self, shape, number_of_points, m=None, sigma=None):
+        key = (tuple(shape), number_of_points, condor.utils.nfft.get_backend(), m, sigma)
+        nfft_plan = self._nfft_plans.get(key)
+        if nfft_plan is None:
+            log_debug(logger, "Initialising NFFT plan for map shape %s and %i points" % (str(key[0]), number_of_points))
+            nfft_plan = {"plan": condor.utils.nfft.Plan(shape, number_of_points, m=m, sigma=sigma), "coordinates_key": None, "map": None, "transforms": None}
+            self._nfft_plans.put(key, nfft_plan)
+        return nfft_plan
+
+    def _get_nfft_transforms(self, nfft_plan, maps, origins, coordinates, invalid_mask):
+        # The maps are only set again if they are not the same array as before. ParticleMap returns the same read-only array as long as the maps do not change.
+        # Then the NumPy backend also keeps the oversampled spectrum of the maps and a transform only costs the interpolation at the scattering vectors.
+        if nfft_plan["map"] is not maps:
+            nfft_plan["plan"].set_maps(maps)
+            nfft_plan["map"] = maps
+            nfft_plan["transforms"] = None
+        # The transforms are kept until the maps or the coordinates change (other photon wavelengths or materials only weight them differently)
+        if nfft_plan["transforms"] is None:
+            transforms = log_execution_time(logger)(nfft_plan["plan"].transform_many)()
+            if origins != tuple([N//2 for N in maps.shape[1:]]):
+                transforms *= condor.utils.nfft.get_origin_phase(coordinates, maps.shape[1:], origins)
+            # Masking in case of invalid values
+            if numpy.any(invalid_mask):
+                transforms[:,invalid_mask.any(axis=1)] = numpy.nan
+            transforms.setflags(write=False)
+            nfft_plan["transforms"] = transforms
+        return nfft_plan["transforms"]
+
+    def _get_sphere_form_factor(self, K, q, R, form_factor_lookup, nx, ny, cx, cy, ndim):
+        if form_factor_lookup is None:
+            return condor.utils.sphere_diffraction.F_sphere_diffraction(K, q, R)
+        else:
+            # Scattering vector lengths are symmetric in both axes if the beam center lies in the middle of the detector
+            mirror = ndim == 2 and cx == (nx-1)/2. and cy == (ny-1)/2.
+            return condor.utils.sphere_diffraction.F_sphere_diffraction_lookup(K, q, R, accuracy=form_factor_lookup, mirror=mirror)
+
+    def _propagate_batch(self, shots, ndim=2, qn=None, qmax=None):
+
+        if ndim == 3:
+            if self.detector.solid_angle_correction:
+                log_and_raise_error(logger, "Carrying out solid angle correction for a simulation of a 3D Fourier volume does not make sense. Please set solid_angle_correction=False for your Detector and try again.")
+                return
+            if self.source.polarization != "ignore":
+                log_and_raise_error(logger, "polarization=\"%s\" for a 3D propagation does not make sense. Set polarization=\"ignore\" in your Source configuration and try again." % self.source.polarization)
+                return
+
+        # Shots with the same wavelength and beam center share scattering vectors, solid angles and polarization factors
+        groups = {}
+        for i_shot, (D_source, D_particles, D_detector) in enumerate(shots):
+            key = (D_source["wavelength"], D_detector["cx"], D_detector["cy"])
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(i_shot)
+
+        F_tot = None
+        # Shape for broadcasting per-particle parameters against the scattering vectors
+        shape = tuple([-1] + [1]*ndim)
+        for (wavelength, cx, cy), i_shots in groups.items():
+            D_detector = shots[i_shots[0]][2]
+            nx                  = D_detector["nx"]
+            ny                  = D_detector["ny"]
+            pixel_size          = D_detector["pixel_size"]
+            detector_distance   = D_detector["distance"]
+
+            # Qmap without rotation
+            if ndim == 2:
+                qmap0 = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=None, order="xyz")
+            else:
+                qmax_i = numpy.sqrt((self.detector.get_q_max(wavelength, pos="edge")**2).sum()) if qmax is None else qmax
+                qn_i = max([nx, ny]) if qn is None else qn
+                # The regular grid of scattering vectors is separable. Only its axis is kept instead of an array of shape (qn, qn, qn, 3)
+                q3d = numpy.linspace(-qmax_i, qmax_i, qn_i)
+            if ndim == 2:
+                q = self.detector.geometry_cache.get_q_abs(wavelength, cx, cy)
+            else:
+                q = numpy.sqrt(q3d[:,numpy.newaxis,numpy.newaxis]**2 + q3d[numpy.newaxis,:,numpy.newaxis]**2 + q3d[numpy.newaxis,numpy.newaxis,:]**2)
+            if F_tot is None:
+                F_tot = numpy.zeros(shape=tuple([len(shots)] + list(q.shape)), dtype=numpy.complex128)
+
+            # Solid angles
+            if self.detector.solid_angle_correction:
+                Omega_p = self.detector.geometry_cache.get_solid_angles(cx, cy)
+            else:
+                Omega_p = pixel_size**2 / detector_distance**2
+
+            # Collect the parameters of all particles in this group of shots
+            spheres   = {}
+            spheroids = []
+            for i_shot in i_shots:
+                D_source, D_particles, D_detector = shots[i_shot]
+                for D_particle in D_particles.values():
+                    p = D_particle["_class_instance"]
+                    # Intensity at interaction point
+                    D_particle["intensity"] = self.source.get_intensity(D_particle["position"], "ph/m2", pulse_energy=D_source["pulse_energy"])
+                    # Primary wave amplitude
+                    F0 = numpy.sqrt(D_particle["intensity"])*2*numpy.pi/wavelength**2
+                    D_particle["F0"] = F0
+                    # Intensity scaling factor
+                    dn = p.get_dn(wavelength)
+                    R = D_particle["diameter"]/2.
+                    V = 4/3.*numpy.pi*R**3
+                    if isinstance(p, condor.particle.ParticleSphere):
+                        K = (F0*V*dn)**2
+                        if p.form_factor_lookup not in spheres:
+                            spheres[p.form_factor_lookup] = []
+                        spheres[p.form_factor_lookup].append((i_shot, K, R, D_particle["position"]))
+                    else:
+                        K = (F0*V*abs(dn))**2
+                        # Geometrical factors
+                        a = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_a(D_particle["diameter"], D_particle["flattening"])
+                        c = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_c(D_particle["diameter"], D_particle["flattening"])
+                        # Spheroid axis before rotation
+                        v0 = numpy.array([0.,1.,0.])
+                        v1 = Rotation(values=D_particle["extrinsic_quaternion"], formalism="quaternion").rotate_vector(v0)
+                        theta = numpy.arcsin(v1[2])
+                        phi   = numpy.arctan2(-v1[0],v1[1])
+                        spheroids.append((i_shot, K, a, c, theta, phi, D_particle["position"]))
+
+            # Evaluate the particles in broadcasted passes over the shot axis
+            for form_factor_lookup, spheres_lookup in spheres.items():
+                for i in range(0, len(spheres_lookup), _BATCH_SIZE):
+                    i_p, K, R, v = [numpy.array(x) for x in zip(*spheres_lookup[i:i+_BATCH_SIZE])]
+                    F = self._get_sphere_form_factor(K.reshape(shape), q, R.reshape(shape), form_factor_lookup, nx, ny, cx, cy, ndim) * numpy.sqrt(Omega_p)
+                    if ndim == 2:
+                        numpy.add.at(F_tot, i_p, _apply_phase_factors(F, v, qmap0))
+                    else:
+                        numpy.add.at(F_tot, i_p, _apply_phase_factors_grid(F, v, q3d))
+            for i in range(0, len(spheroids), _BATCH_SIZE):
+                i_p, K, a, c, theta, phi, v = [numpy.array(x) for x in zip(*spheroids[i:i+_BATCH_SIZE])]
+                F = condor.utils.spheroid_diffraction.F_spheroid_diffraction(K.reshape(shape), qmap0[:,:,0], qmap0[:,:,1], a.reshape(shape), c.reshape(shape),
+                                                                             theta.reshape(shape), phi.reshape(shape)) * numpy.sqrt(Omega_p)
+                numpy.add.at(F_tot, i_p, _apply_phase_factors(F, v, qmap0))
+
+            # Polarization correction
+            if ndim == 2:
+                P = self.detector.geometry_cache.get_polarization_factors(cx, cy, polarization=self.source.polarization)
+                F_tot[i_shots] *= numpy.sqrt(P)
+
+        return self._get_output_many(shots, F_tot, ndim=ndim)
+
+    def _get_output_many(self, shots, F_tot, ndim=2):
+        # Photon detection
+        I_tot, M_tot = self.detector.detect_photons_many(abs(F_tot)**2)
+
+        O = {}
+        O["source"]            = stack_dicts([remove_from_dict(D_source, "_") for D_source, D_particles, D_detector in shots])
+        O["particles"]         = stack_dicts([remove_from_dict(D_particles, "_") for D_source, D_particles, D_detector in shots])
+        O["detector"]          = stack_dicts([remove_from_dict(D_detector, "_") for D_source, D_particles, D_detector in shots])
+
+        O["entry_1"] = {}
+
+        data_1 = {}
+
+        data_1["data_fourier"] = F_tot
+        data_1["data"]         = I_tot
+        data_1["mask"]         = M_tot
+        data_1["full_period_resolution"] = numpy.array([2 * self.detector.get_max_resolution(D_source["wavelength"]) for D_source, D_particles, D_detector in shots])
+
+        O["entry_1"]["data_1"] = data_1
+
+        if ndim == 2 and self.detector.binning is not None:
+            data_2 = []
+            for F, I, M in zip(F_tot, I_tot, M_tot):
+                IXxX, MXxX = self.detector.bin_photons(I, M)
+                FXxX, MXxX = condor.utils.resample.downsample(F, self.detector.binning, mode="integrate",
+                                                              mask2d0=M, bad_bits=PixelMask.PIXEL_IS_IN_MASK, min_N_pixels=1)
+                data_2.append({"data_fourier": FXxX, "data": IXxX, "mask": MXxX})
+            O["entry_1"]["data_2"] = stack_dicts(data_2)
+
+        O = remove_from_dict(O, "_")
+
+        return O
+
+    def _get_next_shot(self):
         # Iterate objects
         D_source    = self.source.get_next()
         D_particles = self._get_next_particles()
         D_detector  = self.detector.get_next()
+        return D_source, D_particles, D_detector
+    
+    def _propagate(self, save_map3d=False, save_qmap=False, ndim=2, qn=None, qmax=None, symmetry=False):
 
+        if ndim not in [2,3]:
+            log_and_raise_error(logger, "ndim = %i is an invalid input. Has to be either 2 or 3." % ndim)
+            
+        log_debug(logger, "Start propagation")
+        
+        D_source, D_particles, D_detector = self._get_next_shot()
+        return self._propagate_shot(D_source, D_particles, D_detector, save_map3d=save_map3d, save_qmap=save_qmap, ndim=ndim, qn=qn, qmax=qmax, symmetry=symmetry)
+
+    def _propagate_shot(self, D_source, D_particles, D_detector, save_map3d=False, save_qmap=False, ndim=2, qn=None, qmax=None, slab=None, symmetry=False, random_state=None):
+        # slab: range (start, stop) of z-indices of the 3D volume that are evaluated (None for the whole volume)
+        # symmetry: use symmetries of map particles to reduce the calculation of a whole 3D volume
+        # random_state: numpy.random.RandomState for the photon noise (None for the global random number generator)
+        
         # Pull out variables
         nx                  = D_detector["nx"]
         ny                  = D_detector["ny"]
@@ -198,11 +716,18 @@ class Experiment:
 
         # Qmap without rotation
         if ndim == 2:
-            qmap0 = self.detector.generate_qmap(wavelength, cx=cx, cy=cy, extrinsic_rotation=None)
+            qmap0 = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=None, order="xyz")
         else:
-            qmax = numpy.sqrt((self.detector.get_q_max(wavelength, pos="edge")**2).sum())
-            qn = max([nx, ny])
-            qmap0 = self.detector.generate_qmap_3d(wavelength, qn=qn, qmax=qmax, extrinsic_rotation=None, order='xyz')
+            if qmax is None:
+                qmax = numpy.sqrt((self.detector.get_q_max(wavelength, pos="edge")**2).sum())
+            if qn is None:
+                qn = max([nx, ny])
+            # The regular grid of scattering vectors is separable. Only its axis is kept instead of an array of shape (qn, qn, qn, 3)
+            q3d = numpy.linspace(-qmax, qmax, qn)
+            if slab is None:
+                slab = (0, qn)
+            q3d_z = q3d[slab[0]:slab[1]]
+            qmap0 = None
             if self.detector.solid_angle_correction:
                 log_and_raise_error(logger, "Carrying out solid angle correction for a simulation of a 3D Fourier volume does not make sense. Please set solid_angle_correction=False for your Detector and try again.")
                 return
@@ -226,26 +751,36 @@ class Experiment:
             if isinstance(p, condor.particle.ParticleSphere) or isinstance(p, condor.particle.ParticleSpheroid) or isinstance(p, condor.particle.ParticleMap):
                 # Solid angles
                 if self.detector.solid_angle_correction:
-                    Omega_p = self.detector.get_all_pixel_solid_angles(cx, cy)
+                    Omega_p = self.detector.geometry_cache.get_solid_angles(cx, cy)
                 else:
                     Omega_p = pixel_size**2 / detector_distance**2
             
+            # INTERPOLATION FROM FOURIER VOLUME
+            if ndim == 2 and self._fourier_volume_sampler is not None and self._fourier_volume_sampler.is_supported(p):
+                qmap = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=extrinsic_rotation, order="zyx")
+                F = F0 * self._fourier_volume_sampler.get_amplitudes(p, D_particle, wavelength, qmap) * numpy.sqrt(Omega_p)
+
             # UNIFORM SPHERE
-            if isinstance(p, condor.particle.ParticleSphere):
+            elif isinstance(p, condor.particle.ParticleSphere):
                 # Refractive index
                 dn = p.get_dn(wavelength)
-                # Scattering vectors
+                # Lengths of scattering vectors
                 if ndim == 2:
-                    qmap = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=None)
+                    q = self.detector.geometry_cache.get_q_abs(wavelength, cx, cy)
                 else:
-                    qmap = qmap0
-                q = numpy.sqrt((qmap**2).sum(axis=ndim))
+                    q = numpy.sqrt(q3d_z[:,numpy.newaxis,numpy.newaxis]**2 + q3d[numpy.newaxis,:,numpy.newaxis]**2 + q3d[numpy.newaxis,numpy.newaxis,:]**2)
+                # The map of scattering vectors is only needed for the output
+                if save_qmap:
+                    if ndim == 2:
+                        qmap = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=None)
+                    else:
+                        qmap = self.detector.generate_qmap_3d(wavelength, qn=qn, qmax=qmax, extrinsic_rotation=None, order="xyz", slab=slab)
                 # Intensity scaling factor
                 R = D_particle["diameter"]/2.
                 V = 4/3.*numpy.pi*R**3
                 K = (F0*V*dn)**2
                 # Pattern
-                F = condor.utils.sphere_diffraction.F_sphere_diffraction(K, q, R) * numpy.sqrt(Omega_p)
+                F = self._get_sphere_form_factor(K, q, R, p.form_factor_lookup, nx, ny, cx, cy, ndim) * numpy.sqrt(Omega_p)
 
             # UNIFORM SPHEROID
             elif isinstance(p, condor.particle.ParticleSpheroid):
@@ -277,45 +812,86 @@ class Experiment:
             # MAP
             elif isinstance(p, condor.particle.ParticleMap):
                 # Resolution
-                dx_required  = self.detector.get_resolution_element_r(wavelength, cx=cx, cy=cy, center_variation=False)
-                dx_suggested = self.detector.get_resolution_element_r(wavelength, center_variation=True)
+                dx_required  = self.detector.geometry_cache.get_resolution_element_r(wavelength, cx=cx, cy=cy, center_variation=False)
+                dx_suggested = self.detector.geometry_cache.get_resolution_element_r(wavelength, center_variation=True)
+                # A rotation that maps the regular 3D grid onto itself is applied to the volume of the unrotated map (regular FFT instead of NFFT)
+                grid_axes = _get_grid_axes(extrinsic_rotation) if (ndim == 3 and qn > 1) else None
+                # Generate map (finer than suggested if the accuracy asks for map oversampling)
+                accuracy = p.get_accuracy_parameters()
+                # Real maps of the materials (cropped to the box around their non-zero values, the transform keeps the origin of the whole map). The Fourier transform is linear, the transforms of the maps are weighted with the refractive indices of the materials.
+                maps, dn, dx, origins = p.get_new_material_maps_cropped(D_particle, dx_required, dx_suggested / accuracy["map_oversampling"], wavelength)
+                log_debug(logger, "Sampling of map: dx_required = %e m, dx_suggested = %e m, dx = %e m" % (dx_required, dx_suggested, dx))
+                if save_map3d:
+                    D_particle["map3d_dn"], D_particle["dx"] = p.get_new_dn_map(D_particle, dx_required, dx_suggested / accuracy["map_oversampling"], wavelength)
+                # Symmetries are only used for whole volumes
+                reduced = ndim == 3 and symmetry and slab == (0, qn) and not save_qmap
+                # Rotated grids are only mapped onto themselves by the inversion. With the Friedel symmetry of the maps (real maps of materials) only the half of the volume with z-indices k >= qn//2 is calculated.
+                phases = [condor.utils.symmetry.get_friedel_phase(m) for m in maps] if (reduced and grid_axes is None and qn > 1) else [None]
+                inversion = None not in phases
                 # Scattering vectors (the nfft requires order z,y,x)
                 if ndim == 2:
                     qmap = self.get_qmap(nx=nx, ny=ny, cx=cx, cy=cy, pixel_size=pixel_size, detector_distance=detector_distance, wavelength=wavelength, extrinsic_rotation=extrinsic_rotation, order="zyx")
+                elif grid_axes is None or save_qmap:
+                    qmap = self.detector.generate_qmap_3d(wavelength=wavelength, qn=qn, qmax=qmax, extrinsic_rotation=extrinsic_rotation, order="zyx", slab=(qn//2, qn) if inversion else slab)
+                if grid_axes is not None:
+                    # Regular grid in units of the NFFT
+                    h = dx * 2*qmax/(qn-1) / (2. * numpy.pi)
+                    if reduced:
+                        transforms = (log_execution_time(logger)(condor.utils.symmetry.nfft_grid_symmetric)(m, h, qn, origins=origins) for m in maps)
+                    else:
+                        # The z-slab of the rotated volume is a slab of the unrotated volume along the axis that is mapped onto z
+                        axis, reverse = grid_axes[0]
+                        ranges = [None, None, None]
+                        ranges[axis] = (qn - slab[1], qn - slab[0]) if reverse else slab
+                        transforms = (log_execution_time(logger)(condor.utils.nfft.nfft_grid)(m, h, qn, ranges=ranges, origins=origins) for m in maps)
+                    fourier_pattern = sum(dn_i * transform for dn_i, transform in zip(dn, transforms))
+                    fourier_pattern = _rotate_grid(fourier_pattern, grid_axes)
+                    x = (numpy.arange(qn) - (qn-1)/2.) * h
+                    if numpy.any((x < -0.5) | (x >= 0.5)):
+                        log_warning(logger, "Scattering vectors exceed the sampling of the map.")
+                        invalid = (x < -0.5) | (x >= 0.5)
+                        fourier_pattern[invalid[slab[0]:slab[1]],:,:] = numpy.nan
+                        fourier_pattern[:,invalid,:] = numpy.nan
+                        fourier_pattern[:,:,invalid] = numpy.nan
+                    F = F0 * fourier_pattern * dx**3 * numpy.sqrt(Omega_p)
                 else:
-                    qmap = self.detector.generate_qmap_3d(wavelength=wavelength, qn=qn, qmax=qmax, extrinsic_rotation=extrinsic_rotation, order="zyx")
-                # Generate map
-                map3d_dn, dx = p.get_new_dn_map(D_particle, dx_required, dx_suggested, wavelength)
-                log_debug(logger, "Sampling of map: dx_required = %e m, dx_suggested = %e m, dx = %e m" % (dx_required, dx_suggested, dx))
-                if save_map3d:
-                    D_particle["map3d_dn"] = map3d_dn
-                    D_particle["dx"] = dx
-                # Rescale and shape qmap for nfft
-                qmap_scaled = dx * qmap / (2. * numpy.pi)
-                qmap_shaped = qmap_scaled.reshape(int(qmap_scaled.size/3), 3)
-                # Check inputs
-                invalid_mask = ~((qmap_shaped>=-0.5) * (qmap_shaped<0.5))
-                if numpy.any(invalid_mask):
-                    qmap_shaped[invalid_mask] = 0.
-                    log_warning(logger, "%i invalid pixel positions." % invalid_mask.sum())
-                log_debug(logger, "Map3d input shape: (%i,%i,%i), number of dimensions: %i, sum %f" % (map3d_dn.shape[0], map3d_dn.shape[1], map3d_dn.shape[2], len(list(map3d_dn.shape)), abs(map3d_dn).sum()))
-                if (numpy.isfinite(abs(map3d_dn))==False).sum() > 0:
-                    log_warning(logger, "There are infinite values in the dn map of the object.")
-                log_debug(logger, "Scattering vectors shape: (%i,%i); Number of dimensions: %i" % (qmap_shaped.shape[0], qmap_shaped.shape[1], len(list(qmap_shaped.shape))))
-                if (numpy.isfinite(qmap_shaped)==False).sum() > 0:
-                    log_warning(logger, "There are infinite values in the scattering vectors.")
-                # NFFT
-                fourier_pattern = log_execution_time(logger)(condor.utils.nfft.nfft)(map3d_dn, qmap_shaped)
-                # Check output - masking in case of invalid values
-                if numpy.any(invalid_mask):
-                    fourier_pattern[invalid_mask.any(axis=1)] = numpy.nan
-                # reshaping
-                fourier_pattern = numpy.reshape(fourier_pattern, tuple(list(qmap_scaled.shape)[:-1]))
-                log_debug(logger, "Generated pattern of shape %s." % str(fourier_pattern.shape))
-                F = F0 * fourier_pattern * dx**3 * numpy.sqrt(Omega_p)
+                    # Rescale and shape qmap for nfft
+                    qmap_scaled = dx * qmap / (2. * numpy.pi)
+                    qmap_shaped = qmap_scaled.reshape(int(qmap_scaled.size/3), 3)
+                    # Check inputs
+                    invalid_mask = ~((qmap_shaped>=-0.5) * (qmap_shaped<0.5))
+                    if numpy.any(invalid_mask):
+                        qmap_shaped[invalid_mask] = 0.
+                        log_warning(logger, "%i invalid pixel positions." % invalid_mask.sum())
+                    log_debug(logger, "Maps input shape: %s, number of maps: %i, sum %f" % (str(maps.shape[1:]), maps.shape[0], abs(maps).sum()))
+                    if (numpy.isfinite(abs(maps))==False).sum() > 0:
+                        log_warning(logger, "There are infinite values in the dn map of the object.")
+                    log_debug(logger, "Scattering vectors shape: (%i,%i); Number of dimensions: %i" % (qmap_shaped.shape[0], qmap_shaped.shape[1], len(list(qmap_shaped.shape))))
+                    if (numpy.isfinite(qmap_shaped)==False).sum() > 0:
+                        log_warning(logger, "There are infinite values in the scattering vectors.")
+                    # NFFT (the plan is kept across shots and the window function is only precomputed again if the scattering vectors change)
+                    nfft_plan = self._get_nfft_plan(maps.shape[1:], qmap_shaped.shape[0], m=accuracy["m"], sigma=accuracy["sigma"])
+                    coordinates_key = (ndim, nx, ny, cx, cy, pixel_size, detector_distance, wavelength, qn, qmax, (qn//2, qn) if inversion else slab, tuple(D_particle["extrinsic_quaternion"]), dx)
+                    if nfft_plan["coordinates_key"] != coordinates_key:
+                        nfft_plan["plan"].set_coordinates(qmap_shaped)
+                        nfft_plan["coordinates_key"] = coordinates_key
+                        nfft_plan["transforms"] = None
+                    # Transforms of the maps (kept as long as the maps and the scattering vectors do not change)
+                    transforms = self._get_nfft_transforms(nfft_plan, maps, origins, qmap_shaped, invalid_mask)
+                    shape = tuple(list(qmap_scaled.shape)[:-1])
+                    if inversion:
+                        fourier_pattern = sum(dn_i * condor.utils.symmetry.expand_volume(transform.reshape(shape), qn, [0], [((False, False, False), None), ((True, True, True), phase)])
+                                              for dn_i, transform, phase in zip(dn, transforms, phases))
+                    else:
+                        fourier_pattern = dn.dot(transforms).reshape(shape)
+                    log_debug(logger, "Generated pattern of shape %s." % str(fourier_pattern.shape))
+                    F = F0 * fourier_pattern * dx**3 * numpy.sqrt(Omega_p)
 
             # ATOMS
             elif isinstance(p, condor.particle.ParticleAtoms):
+                if ndim == 3 and slab != (0, qn):
+                    log_and_raise_error(logger, "Atomic particle models cannot be propagated in slabs of the 3D Fourier volume.")
+                    return
                 # Import here to make other functionalities of Condor independent of spsim
                 import spsim
                 # Check version
@@ -350,18 +926,7 @@ class Experiment:
                     qmap = 2*numpy.pi * qmap_img.image.real
                 else:
                     qmap = 2*numpy.pi * numpy.reshape(qmap_img.image.real, (qn, qn, qn, 3))
-                self._qmap_cache = {
-                    "qmap"              : qmap,
-                    "nx"                : nx,
-                    "ny"                : ny,
-                    "cx"                : cx,
-                    "cy"                : cy,
-                    "pixel_size"        : pixel_size,
-                    "detector_distance" : detector_distance,
-                    "wavelength"        : wavelength,
-                    "extrinsic_rotation": copy.deepcopy(extrinsic_rotation),
-                    "order"             : 'zyx',
-                }   
+                self._qmap_last = qmap
                 spsim.sp_image_free(qmap_img)
                 spsim.free_diffraction_pattern(pat)
                 spsim.free_output_in_options(opts)                
@@ -378,13 +943,13 @@ class Experiment:
                 if ndim == 2:
                     F = F * numpy.exp(-1.j*(v[0]*qmap0[:,:,0]+v[1]*qmap0[:,:,1]+v[2]*qmap0[:,:,2]))
                 else:
-                    F = F * numpy.exp(-1.j*(v[0]*qmap0[:,:,:,0]+v[1]*qmap0[:,:,:,1]+v[2]*qmap0[:,:,:,2]))
+                    F = F * (numpy.exp(-1.j*v[2]*q3d_z)[:,numpy.newaxis,numpy.newaxis] * numpy.exp(-1.j*v[1]*q3d)[numpy.newaxis,:,numpy.newaxis] * numpy.exp(-1.j*v[0]*q3d)[numpy.newaxis,numpy.newaxis,:])
             # Superimpose patterns
             F_tot = F_tot + F
 
         # Polarization correction
         if ndim == 2:
-            P = self.detector.calculate_polarization_factors(cx=cx, cy=cy, polarization=self.source.polarization)
+            P = self.detector.geometry_cache.get_polarization_factors(cx, cy, polarization=self.source.polarization)
         else:
             if self.source.polarization != "ignore":
                 log_and_raise_error(logger, "polarization=\"%s\" for a 3D propagation does not make sense. Set polarization=\"ignore\" in your Source configuration and try again." % self.source.polarization)
@@ -393,7 +958,7 @@ class Experiment:
         F_tot = numpy.sqrt(P) * F_tot
 
         # Photon detection
-        I_tot, M_tot = self.detector.detect_photons(abs(F_tot)**2)
+        I_tot, M_tot = self.detector.detect_photons(abs(F_tot)**2, random_state=random_state)
         
         if ndim == 2:
             M_tot_binary = M_tot == 0        
@@ -438,42 +1003,50 @@ class Experiment:
 
     @log_execution_time(logger)
     def get_qmap(self, nx, ny, cx, cy, pixel_size, detector_distance, wavelength, extrinsic_rotation=None, order="xyz"):
-        calculate = False
-        if self._qmap_cache == {}:
-            calculate = True
-        else:
-            calculate = calculate or nx != self._qmap_cache["nx"]
-            calculate = calculate or ny != self._qmap_cache["ny"]
-            calculate = calculate or cx != self._qmap_cache["cx"]
-            calculate = calculate or cy != self._qmap_cache["cy"]
-            calculate = calculate or pixel_size != self._qmap_cache["pixel_size"]
-            calculate = calculate or detector_distance != self._qmap_cache["detector_distance"]
-            calculate = calculate or wavelength != self._qmap_cache["wavelength"]
-            calculate = calculate or order != self._qmap_cache["order"]
-            if extrinsic_rotation is not None:
-                calculate = calculate or not extrinsic_rotation.is_similar(self._qmap_cache["extrinsic_rotation"])
-        if calculate:
+        """
+        Return the map of scattering vectors for the given detector geometry, wavelength, beam center and sample orientation
+
+        Unrotated maps are kept in a least-recently-used cache that is keyed by the detector geometry, the wavelength, the beam center and the order of the vector coordinates. A rotated map is obtained by a single matrix product with the cached unrotated map. The cache is configured with :meth:`condor.experiment.Experiment.set_qmap_cache_size` and its counters are returned by :meth:`condor.experiment.Experiment.get_qmap_cache_info`.
+        """
+        key = (nx, ny, cx, cy, pixel_size, detector_distance, wavelength, order)
+        qmap0 = self._qmap_cache.get(key)
+        if qmap0 is None:
             log_debug(logger,  "Calculating qmap")
-            self._qmap_cache = {
-                "qmap"              : self.detector.generate_qmap(wavelength, cx=cx, cy=cy, extrinsic_rotation=extrinsic_rotation, order=order),
-                "nx"                : nx,
-                "ny"                : ny,
-                "cx"                : cx,
-                "cy"                : cy,
-                "pixel_size"        : pixel_size,
-                "detector_distance" : detector_distance,
-                "wavelength"        : wavelength,
-                "extrinsic_rotation": copy.deepcopy(extrinsic_rotation),
-                "order"             : order,
-            }            
-        return self._qmap_cache["qmap"]
+            qmap0 = self.detector.generate_qmap(wavelength, cx=cx, cy=cy, extrinsic_rotation=None, order=order)
+            # Protect the cached array from being modified by the caller
+            qmap0.setflags(write=False)
+            self._qmap_cache.put(key, qmap0)
+        if extrinsic_rotation is None:
+            qmap = qmap0
+        else:
+            qmap = condor.utils.scattering_vector.rotate_qmap(qmap0, extrinsic_rotation, order=order)
+        self._qmap_last = qmap
+        return qmap
 
     def get_qmap_from_cache(self):
-        if self._qmap_cache == {} or not "qmap" in self._qmap_cache:
+        """
+        Return the scattering vector map that was calculated last
+        """
+        if self._qmap_last is None:
             log_and_raise_error(logger, "Cache empty!")
             return None
         else:
-            return self._qmap_cache["qmap"]
+            return self._qmap_last
+
+    def set_qmap_cache_size(self, maxsize):
+        """
+        Set the maximum number of unrotated scattering vector maps kept in the cache (see :meth:`condor.experiment.Experiment.get_qmap`)
+
+        Args:
+          :maxsize (int): Maximum number of cached maps. If ``None`` the number of cached maps is not limited
+        """
+        self._qmap_cache.set_maxsize(maxsize)
+
+    def get_qmap_cache_info(self):
+        """
+        Return a dictionary with the numbers of hits, misses and evictions of the scattering vector map cache and its current and maximum size
+        """
+        return self._qmap_cache.get_info()
         
     def get_resolution(self, wavelength = None, cx = None, cy = None, pos="corner", convention="full_period"):
         if wavelength is None:
@@ -575,3 +1148,78 @@ def remove_from_dict(D, startswith="_"):
         if isinstance(v, dict):
            remove_from_dict(D[k], startswith) 
     return D
+
+def stack_dicts(Ds):
+    """
+    Stack a list of (nested) dictionaries to a single dictionary of arrays with a leading axis that indexes the list entries. Missing numerical values are filled with ``nan``
+    """
+    keys = []
+    for D in Ds:
+        for k in D.keys():
+            if k not in keys:
+                keys.append(k)
+    O = {}
+    for k in keys:
+        vs = [D.get(k, None) for D in Ds]
+        present = [v for v in vs if v is not None]
+        if len(present) == 0:
+            O[k] = None
+        elif isinstance(present[0], dict):
+            O[k] = stack_dicts([v if v is not None else {} for v in vs])
+        else:
+            if len(present) < len(vs):
+                fill = numpy.nan * numpy.ones(numpy.shape(present[0]))
+                vs = [fill if v is None else v for v in vs]
+            try:
+                O[k] = numpy.array(vs)
+            except ValueError:
+                # Inhomogeneous shapes
+                O[k] = numpy.empty(len(vs), dtype=object)
+                for i, v in enumerate(vs):
+                    O[k][i] = v
+    return O
+
+def _read_parameters(group, D):
+    # Overwrite the parameters of a shot with the values in a group written by the CXIWriter (stacks of length one)
+    for k in D.keys():
+        if k in group and hasattr(group[k], "shape"):
+            v = group[k][0]
+            if isinstance(v, bytes):
+                v = v.decode('utf8')
+            D[k] = v
+
+def _apply_phase_factors(F, v, qmap0):
+    # F: amplitudes of m particles (leading axis), v: positions of shape (m, 3)
+    if numpy.allclose(v, numpy.zeros_like(v), atol=1E-12):
+        return F
+    return F * numpy.exp(-1.j*numpy.tensordot(v, qmap0, axes=([1],[qmap0.ndim-1])))
+
+def _apply_phase_factors_grid(F, v, q3d):
+    # F: amplitudes of m particles (leading axis) on the regular 3D grid with the axis q3d (order z,y,x), v: positions of shape (m, 3) in order x,y,z
+    if numpy.allclose(v, numpy.zeros_like(v), atol=1E-12):
+        return F
+    e = [numpy.exp(-1.j*v[:,i,numpy.newaxis]*q3d[numpy.newaxis,:]) for i in range(3)]
+    return F * (e[2][:,:,numpy.newaxis,numpy.newaxis] * e[1][:,numpy.newaxis,:,numpy.newaxis] * e[0][:,numpy.newaxis,numpy.newaxis,:])
+
+def _get_grid_axes(extrinsic_rotation, tolerance=1E-10):
+    # Rotations that map the regular 3D grid onto itself are signed permutations of the axes
+    # Returns the axis of the unrotated volume for every axis of the rotated volume (z, y, x) and whether it is reversed, None for any other rotation
+    R = extrinsic_rotation.get_as_rotation_matrix()[::-1,::-1]
+    # The scattering vectors are rotated by the transposed matrix (see condor.utils.scattering_vector.rotate_qmap)
+    S = R.T
+    if not numpy.allclose(S, numpy.round(S), atol=tolerance):
+        return None
+    S = numpy.round(S)
+    if not numpy.all((abs(S) == 1).sum(axis=1) == 1):
+        return None
+    # The value at index k of the rotated volume is the value at index c + S (k - c) of the unrotated volume
+    permutation = abs(S).argmax(axis=1)
+    signs = S[numpy.arange(3), permutation]
+    axes = numpy.argsort(permutation)
+    return [(int(a), bool(signs[a] < 0)) for a in axes]
+
+def _rotate_grid(volume, grid_axes):
+    for a, (axis, reverse) in enumerate(grid_axes):
+        if reverse:
+            volume = numpy.flip(volume, axis=axis)
+    return numpy.ascontiguousarray(volume.transpose([axis for axis, reverse in grid_axes]))
@@ -0,0 +1,182 @@
+# -----------------------------------------------------------------------------------------------------
+# CONDOR
+# Simulator for diffractive single-particle imaging experiments with X-ray lasers
+# http://xfel.icm.uu.se/condor/
+# -----------------------------------------------------------------------------------------------------
+# Copyright 2016 Max Hantke, Filipe R.N.C. Maia, Tomas Ekeberg
+# Condor is distributed under the terms of the BSD 2-Clause License
+# -----------------------------------------------------------------------------------------------------
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------------------------------
+# General note:
+# All variables are in SI units by default. Exceptions explicit by variable name.
+# -----------------------------------------------------------------------------------------------------
+"""
+Libraries of precomputed diffraction patterns for a fixed set of particle orientations
+"""
+
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import os
+import numpy
+import scipy.spatial
+
+import logging
+logger = logging.getLogger(__name__)
+
+from condor.utils.log import log_and_raise_error,log_warning,log_info,log_debug
+
+_INTENSITIES_FILENAME = "intensities.npy"
+_QUATERNIONS_FILENAME = "quaternions.npy"
+
+def create_pattern_library(directory, experiment, quaternions):
+    """
+    Calculate the noiseless intensity patterns of an experiment for a set of particle orientations, store them in a directory and return the library (:class:`condor.library.PatternLibrary`)
+
+    Source, detector and particle parameters are drawn once and shared by all patterns, only the orientation differs. All particles of a shot are rotated by the same quaternion. The patterns are written one by one into a memory-mapped file, the library can therefore be larger than the available memory.
+
+    Args:
+      :directory (str): Directory of the library (created if it does not exist, existing library files are overwritten)
+
+      :experiment: :class:`condor.experiment.Experiment` instance
+
+      :quaternions (array): Array of shape (*n*, 4) of quaternions that define the extrinsic rotations of the particles (see :class:`condor.utils.rotation.Rotation`)
+    """
+    quaternions = numpy.asarray(quaternions, dtype=numpy.float64)
+    if quaternions.ndim != 2 or quaternions.shape[1] != 4:
+        log_and_raise_error(logger, "Quaternions must be given as array of shape (n, 4).")
+        return
+    quaternions = quaternions / numpy.sqrt((quaternions**2).sum(axis=1))[:,numpy.newaxis]
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    D_source, D_particles, D_detector = experiment._get_next_shot()
+    shape = (quaternions.shape[0], D_detector["ny"], D_detector["nx"])
+    log_info(logger, "Calculating pattern library of %i orientations in %s" % (quaternions.shape[0], directory))
+    intensities = numpy.lib.format.open_memmap(os.path.join(directory, _INTENSITIES_FILENAME), mode="w+", dtype=numpy.float64, shape=shape)
+    for i, q in enumerate(quaternions):
+        # Copies because the propagation removes private entries from the parameter dictionaries
+        D_particles_i = dict([(k, dict(v)) for k, v in D_particles.items()])
+        for D_particle in D_particles_i.values():
+            D_particle["extrinsic_quaternion"] = q
+        res = experiment._propagate_shot(dict(D_source), D_particles_i, dict(D_detector))
+        intensities[i] = abs(res["entry_1"]["data_1"]["data_fourier"])**2
+    intensities.flush()
+    del intensities
+    numpy.save(os.path.join(directory, _QUATERNIONS_FILENAME), quaternions)
+    return PatternLibrary(directory, detector=experiment.detector)
+
+
+class PatternLibrary:
+    """
+    Library of noiseless intensity patterns for a fixed set of particle orientations (see :func:`condor.library.create_pattern_library`)
+
+    The patterns are memory-mapped from disk and only read when they are requested. Orientations are looked up with a k-d tree of the unit quaternions of the library. Both signs of every quaternion are indexed because ``q`` and ``-q`` describe the same rotation. The distance of two orientations is the angle of the rotation that maps one onto the other.
+
+    .. code-block:: python
+
+      L = condor.library.create_pattern_library("library", E, quaternions)
+      I_det, M_det = L.get_pattern(condor.utils.rotation.rand_quat())
+
+    Args:
+      :directory (str): Directory of the library
+
+    Kwargs:
+      :detector: :class:`condor.detector.Detector` instance that applies noise and mask to the patterns in :meth:`get_pattern`. If ``None`` only noiseless patterns are available (default ``None``)
+    """
+    def __init__(self, directory, detector=None):
+        self.directory = directory
+        self.detector = detector
+        self._quaternions = numpy.load(os.path.join(directory, _QUATERNIONS_FILENAME))
+        self._intensities = numpy.load(os.path.join(directory, _INTENSITIES_FILENAME), mmap_mode="r")
+        if self._intensities.shape[0] != self._quaternions.shape[0]:
+            log_and_raise_error(logger, "The number of patterns (%i) does not match the number of quaternions (%i) in %s." % (self._intensities.shape[0], self._quaternions.shape[0], directory))
+            return
+        self._tree = scipy.spatial.cKDTree(numpy.concatenate([self._quaternions, -self._quaternions]))
+
+    def __len__(self):
+        return self._quaternions.shape[0]
+
+    def get_quaternions(self):
+        """
+        Return the quaternions of the library as array of shape (*n*, 4)
+        """
+        return self._quaternions
+
+    def get_intensities(self):
+        """
+        Return the memory-mapped stack of noiseless intensity patterns of the library (read-only)
+        """
+        return self._intensities
+
+    def find_nearest(self, quaternion, k=1):
+        """
+        Return the indices of the *k* library orientations that are nearest to the given orientation and their distances (rotation angles in unit radian), both sorted by distance
+
+        Args:
+          :quaternion (array): Quaternion of the orientation
+
+        Kwargs:
+          :k (int): Number of neighbors (default ``1``)
+        """
+        q = numpy.asarray(quaternion, dtype=numpy.float64)
+        q = q / numpy.sqrt((q**2).sum())
+        n = len(self)
+        k = min(k, n)
+        # Both signs of a library quaternion can be among the nearest points only if k is close to n
+        chord, index = self._tree.query(q, k=min(2*k, 2*n))
+        chord = numpy.atleast_1d(chord)
+        index = numpy.atleast_1d(index) % n
+        index, first = numpy.unique(index, return_index=True)
+        order = numpy.argsort(chord[first])[:k]
+        # |q1.q2| = 1 - chord^2/2
+        angles = 2*numpy.arccos(numpy.clip(1. - chord[first][order]**2/2., -1., 1.))
+        return index[order], angles
+
+    def get_intensity(self, quaternion, neighbors=1):
+        """
+        Return the noiseless intensity pattern for the given orientation. The pattern is either the pattern of the nearest library orientation or a blend of the patterns of the nearest library orientations weighted by the inverse of their distance
+
+        Args:
+          :quaternion (array): Quaternion of the orientation
+
+        Kwargs:
+          :neighbors (int): Number of library orientations that are blended (default ``1``)
+        """
+        index, angles = self.find_nearest(quaternion, k=neighbors)
+        if angles[0] < 1E-9 or len(index) == 1:
+            return numpy.array(self._intensities[index[0]])
+        w = 1. / angles
+        w = w / w.sum()
+        return numpy.tensordot(w, self._intensities[index], axes=1)
+
+    def get_pattern(self, quaternion, neighbors=1):
+        """
+        Return the measurement of the intensity pattern for the given orientation (see :meth:`get_intensity`) and its mask. Noise, saturation and mask are applied by :meth:`condor.detector.Detector.detect_photons`
+
+        Args:
+          :quaternion (array): Quaternion of the orientation
+
+        Kwargs:
+          :neighbors (int): Number of library orientations that are blended (default ``1``)
+        """
+        if self.detector is None:
+            log_and_raise_error(logger, "Cannot detect photons without a detector. Open the library with a detector and try again.")
+            return
+        return self.detector.detect_photons(self.get_intensity(quaternion, neighbors=neighbors))
@@ -0,0 +1,164 @@
+# -----------------------------------------------------------------------------------------------------
+# CONDOR
+# Simulator for diffractive single-particle imaging experiments with X-ray lasers
+# http://xfel.icm.uu.se/condor/
+# -----------------------------------------------------------------------------------------------------
+# Copyright 2016 Max Hantke, Filipe R.N.C. Maia, Tomas Ekeberg
+# Condor is distributed under the terms of the BSD 2-Clause License
+# -----------------------------------------------------------------------------------------------------
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------------------------------
+# General note:
+# All variables are in SI units by default. Exceptions explicit by variable name.
+# -----------------------------------------------------------------------------------------------------
+"""
+Parallel simulation of diffraction patterns with a pool of worker processes or threads
+"""
+
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy, copy, threading, collections, multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+from condor.utils.log import log_and_raise_error,log_warning,log_info,log_debug
+import condor.experiment
+
+# Experiment instance of the worker (set once by the pool initializer)
+_worker = threading.local()
+
+def _init_worker(experiment):
+    if isinstance(experiment, dict):
+        experiment = condor.experiment.experiment_from_configdict(experiment)
+    _worker.experiment = experiment
+
+def _init_thread_worker(experiments):
+    # Every thread takes one of the copies that the pool made up front (popping from a deque is atomic)
+    _worker.experiment = experiments.pop()
+
+def _propagate_in_worker(seed, D_source, D_particles, D_detector, kwargs):
+    E = _worker.experiment
+    for D_particle in D_particles.values():
+        D_particle["_class_instance"] = E.particles[D_particle.pop("_particle_key")]
+    # Seeding per shot makes the noise independent of the worker that calculates the shot. The random number generator of the shot is not shared with other threads (the calling thread draws the parameters of the following shots from the global one).
+    return E._propagate_shot(D_source, D_particles, D_detector, random_state=numpy.random.RandomState(seed), **kwargs)
+
+
+class ExperimentPool:
+    """
+    Pool of worker processes (or threads) that propagate the shots of an experiment in parallel
+
+    The experiment is sent to every worker only once, when the pool is started, and the workers are reused for all following calls. The parameters of the shots (orientations, positions, diameters, beam centers, ...) are drawn in the calling thread in the same order as in a serial simulation and the results are returned in that order. Every shot also carries its own seed for the photon noise, with a fixed seed of the global random number generator the results are therefore reproducible and do not depend on the number of workers.
+
+    .. code-block:: python
+
+      with condor.parallel.ExperimentPool(E, workers=64) as pool:
+          results = pool.propagate(1000)
+
+    Args:
+      :experiment: :class:`condor.experiment.Experiment` instance or configuration dictionary (see :meth:`condor.experiment.Experiment.get_conf`)
+
+    Kwargs:
+      :workers (int): Number of workers. If ``None`` the number of processors of the machine is used (default ``None``)
+
+      :processes (bool): If ``True`` the workers are processes, otherwise threads that each work on their own copy of the experiment. Threads avoid copying the experiment and the results between processes and run NFFTs concurrently, because the NFFT releases the GIL (see :func:`condor.utils.nfft.set_num_threads` for the number of threads per transform). The default of this class differs from :meth:`condor.experiment.Experiment.iter_propagate`, which uses threads by default (default ``True``)
+    """
+    def __init__(self, experiment, workers=None, processes=True):
+        import concurrent.futures
+        if isinstance(experiment, dict):
+            self.experiment = condor.experiment.experiment_from_configdict(experiment)
+        else:
+            self.experiment = experiment
+        self._particle_keys = dict([(id(p), k) for k, p in self.experiment.particles.items()])
+        self._processes = processes
+        if processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(experiment,))
+        else:
+            if workers is None:
+                workers = multiprocessing.cpu_count()
+            # Worker threads must not share the caches of the experiment. The executor starts the threads (and runs their initializer) only during submit, while the calling thread draws the shots from the experiment. The copies are therefore made here, before any shot is drawn.
+            experiments = collections.deque([copy.deepcopy(self.experiment) for i in range(workers)])
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=_init_thread_worker, initargs=(experiments,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self, wait=True):
+        """
+        Shut down the worker processes
+
+        Kwargs:
+          :wait (bool): If ``True`` this method returns only after all pending shots have been calculated (default ``True``)
+        """
+        self._executor.shutdown(wait=wait)
+
+    def submit(self, save_map3d=False, save_qmap=False, ndim=2, qn=None, qmax=None):
+        """
+        Draw the parameters of the next shot and submit its propagation to the pool. A :class:`concurrent.futures.Future` is returned, its result is the output dictionary of the shot (see :meth:`condor.experiment.Experiment.propagate`)
+
+        Kwargs:
+          :save_map3d (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+
+          :save_qmap (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+
+          :ndim (int): Number of dimensions of the output, either ``2`` (pattern) or ``3`` (Fourier volume) (default ``2``)
+
+          :qn (int): See :meth:`condor.experiment.Experiment.propagate3d` (default ``None``)
+
+          :qmax (float): See :meth:`condor.experiment.Experiment.propagate3d` (default ``None``)
+        """
+        if ndim not in [2,3]:
+            log_and_raise_error(logger, "ndim = %i is an invalid input. Has to be either 2 or 3." % ndim)
+        D_source, D_particles, D_detector = self.experiment._get_next_shot()
+        # Particle instances are not shipped, the worker looks them up by their key
+        for D_particle in D_particles.values():
+            D_particle["_particle_key"] = self._particle_keys[id(D_particle.pop("_class_instance"))]
+        seed = numpy.random.randint(2**31)
+        kwargs = {"save_map3d" : save_map3d, "save_qmap" : save_qmap, "ndim" : ndim, "qn" : qn, "qmax" : qmax}
+        return self._executor.submit(_propagate_in_worker, seed, D_source, D_particles, D_detector, kwargs)
+
+    def propagate(self, n, save_map3d=False, save_qmap=False):
+        """
+        Propagate ``n`` shots in parallel and return the list of output dictionaries in order (see :meth:`condor.experiment.Experiment.propagate`)
+
+        Args:
+          :n (int): Number of shots
+
+        Kwargs:
+          :save_map3d (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+
+          :save_qmap (bool): See :meth:`condor.experiment.Experiment.propagate_many` (default ``False``)
+        """
+        futures = [self.submit(save_map3d=save_map3d, save_qmap=save_qmap) for i in range(n)]
+        return [f.result() for f in futures]
+
+    def propagate3d(self, n, qn=None, qmax=None):
+        """
+        Propagate ``n`` 3D Fourier volumes in parallel and return the list of output dictionaries in order (see :meth:`condor.experiment.Experiment.propagate3d`)
+
+        Args:
+          :n (int): Number of shots
+        """
+        futures = [self.submit(ndim=3, qn=qn, qmax=qmax) for i in range(n)]
+        return [f.result() for f in futures]
@@ -173,7 +173,7 @@ class AbstractParticle:
         Get configuration in form of a dictionary
         """
         conf = {}
-        conf.update(self._get_conf_rotation())
+        conf.update(self._get_conf_alignment())
         conf.update(self._get_conf_position_variation())
         conf["number"] = self.number
         conf["arrival"]        = self.arrival
@@ -191,7 +191,7 @@ class AbstractParticle:
     def _get_conf_position_variation(self):
         A = {
             "position_variation":        self._position_variation.get_mode(),
-            "position_variation_spread": self._position_variation.get_spread(),
+            "position_spread":           self._position_variation.get_spread(),
             "position_variation_n":      self._position_variation.n
         }
         return A
@@ -373,6 +373,9 @@ class AbstractContinuousParticle(AbstractParticle):
 
     def _get_material_conf(self):
         conf = {}
+        if self.materials is None:
+            conf["material_type"] = None
+            return conf
         for m_i in self.materials:
             conf_i = m_i.get_conf()
             if isinstance(m_i, AtomDensityMaterial):
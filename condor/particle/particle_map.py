@@ -31,7 +31,7 @@
 # -----------------------------------------------------------------------------------------------------
 
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
-import sys
+import sys, os, hashlib
 import numpy
 #from scipy.interpolate import RegularGridInterpolator
 
@@ -46,12 +46,37 @@ from condor.utils.variation import Variation
 import condor.utils.spheroid_diffraction
 import condor.utils.diffraction
 import condor.utils.bodies
+import condor.utils.resample
+import condor.utils.nfft
+from condor.utils.cache import LRUCache
 
 import condor.utils.emdio
 
 from .particle_abstract import AbstractContinuousParticle
 
+# If enabled custom maps are downsampled to the coarsest level of a pyramid of Fourier-cropped maps that is sampled finely enough (see ParticleMap.get_map_pyramid). Disabled by default because it changes the patterns of custom maps (by up to about 5E-3 relative to the maximum)
 ENABLE_MAP_INTERPOLATION = False
+# Ratio of the grid spacings of successive levels of the pyramid and smallest number of samples of a level
+_MAP_PYRAMID_FACTOR = numpy.sqrt(2.)
+_MAP_PYRAMID_MIN_SIZE = 8
+# Factor by which the Nyquist frequency of the chosen level exceeds the largest scattering vector (the spectrum of a cropped map deviates most close to its Nyquist frequency)
+_MAP_PYRAMID_MARGIN = 1.5
+
+# Refractive index maps are cropped to the box around their non-zero values before they are transformed (see ParticleMap.get_new_dn_map_cropped)
+ENABLE_SUPPORT_CROPPING = True
+
+# Default memory budget of the cache of generated maps in bytes
+_MAP_CACHE_MAXBYTES = 2**29
+# Smallest ratio between the rescaled grid spacing of a cached map and the suggested grid spacing for which the cached map is reused (limits the oversampling of smaller particles)
+_MAP_RESCALING_MIN = 0.5
+
+_MAP_ACCURACIES = {
+    # NFFT window cut-off m, NFFT oversampling factor sigma (None: default of the NFFT backend) and oversampling of the map grid
+    # Relative error of the NFFT (NumPy backend, random 40x40x40 map) in parentheses
+    "draft"     : {"m": 3,    "sigma": 1.5,  "map_oversampling": 1.}, # (1E-4)
+    "standard"  : {"m": None, "sigma": None, "map_oversampling": 1.}, # (2E-14)
+    "reference" : {"m": 8,    "sigma": 2.,   "map_oversampling": 2.}, # (2E-14)
+}
 
 class ParticleMap(AbstractContinuousParticle):
     r"""
@@ -100,6 +125,8 @@ class ParticleMap(AbstractContinuousParticle):
       :rotation_mode (str): See :meth:`condor.particle.particle_abstract.AbstractParticle.set_alignment` (default ``None``)
 
       :flattening (float): (Mean) value of :math:`a/c`, takes only effect if ``geometry='spheroid'`` (default ``0.75``)
+
+      :accuracy: See :meth:`set_accuracy` (default ``'standard'``)
     
       :number (float): Expectation value for the number of particles in the interaction volume. (defaukt ``1.``)
 
@@ -132,7 +159,8 @@ class ParticleMap(AbstractContinuousParticle):
                  flattening = 0.75,
                  number = 1., arrival = "synchronised",
                  position = None, position_variation = None, position_spread = None, position_variation_n = None,
-                 material_type = None, massdensity = None, atomic_composition = None, electron_density = None):
+                 material_type = None, massdensity = None, atomic_composition = None, electron_density = None,
+                 accuracy = "standard"):
         # Initialise base class
         AbstractContinuousParticle.__init__(self,
                                             diameter=diameter, diameter_variation=diameter_variation, diameter_spread=diameter_spread, diameter_variation_n=diameter_variation_n,
@@ -151,7 +179,13 @@ class ParticleMap(AbstractContinuousParticle):
         self.flattening = flattening
 
         # Init chache
-        self._cache = {}
+        self._dn_cache = {}
+        self._material_cache = {}
+        self._pyramid = None
+        self._pyramid_directory = None
+        # Generated maps (geometry, diameter, flattening, dx)
+        self._map_cache = LRUCache(maxsize=None, maxbytes=_MAP_CACHE_MAXBYTES)
+        self.set_accuracy(accuracy)
         self._dx_orig                = None
         self._map3d_orig             = None
 
@@ -211,8 +245,76 @@ class ParticleMap(AbstractContinuousParticle):
             conf["dx"]    = dx
         if self.geometry == "spheroid":
             conf["flattening"] = self.flattening
+        conf["accuracy"] = self.accuracy
         return conf
 
+    def set_accuracy(self, accuracy="standard"):
+        """
+        Set the trade-off between speed and accuracy of the propagation
+
+        The accuracy determines the cut-off of the window function (*m*) and the oversampling factor of the FFT grid (*sigma*) of the NFFT, as well as the oversampling of the grid of generated maps relative to the grid spacing that is suggested by the detector geometry. For custom maps the map oversampling selects a finer level of the map pyramid if the pyramid is enabled (see :meth:`get_map_pyramid`).
+
+        Kwargs:
+          :accuracy: Either the name of a tier or a tuple (*m*, *sigma*, *map_oversampling*) of explicit values (*m* and *sigma* may be ``None`` for the defaults of the NFFT backend)
+
+            =============== ======= ======= ================ ============================= ===========================
+            ``accuracy``    *m*     *sigma* map oversampling rel. error of the NFFT [#a]_  rel. error of a sphere [#b]_
+            =============== ======= ======= ================ ============================= ===========================
+            ``'draft'``     3       1.5     1                1E-4                          1E-2 (3x faster)
+            ``'standard'``  default default 1                2E-14                         1E-2
+            ``'reference'`` 8       2       2                2E-14                         3E-3
+            =============== ======= ======= ================ ============================= ===========================
+
+            .. [#a] Measured with the NumPy backend for a random map of 40x40x40 voxels against the direct evaluation of the Fourier sum
+
+            .. [#b] Measured for the amplitudes of a sphere map (100 nm, wavelength 1 nm, 256x256 pixels) against the analytical solution
+
+            (default ``'standard'``)
+        """
+        if isinstance(accuracy, str):
+            if accuracy not in _MAP_ACCURACIES:
+                log_and_raise_error(logger, "accuracy=\"%s\" is invalid. Choose one of the following: %s or a tuple (m, sigma, map_oversampling)." % (accuracy, ", ".join(["\"%s\"" % a for a in _MAP_ACCURACIES.keys()])))
+                return
+        else:
+            if len(accuracy) != 3:
+                log_and_raise_error(logger, "accuracy=%s is invalid. An explicit accuracy has to be a tuple (m, sigma, map_oversampling)." % str(accuracy))
+                return
+            m, sigma, map_oversampling = accuracy
+            if (m is not None and (int(m) != m or m < 1)) or (sigma is not None and sigma <= 1.) or map_oversampling < 1.:
+                log_and_raise_error(logger, "accuracy=%s is invalid. m has to be a positive integer, sigma larger than 1 and map_oversampling at least 1." % str(accuracy))
+                return
+            accuracy = tuple(accuracy)
+        self.accuracy = accuracy
+        # Generated maps have to be sampled again
+        self._map_cache.clear()
+        self._material_cache = {}
+
+    def get_accuracy_parameters(self):
+        """
+        Return the accuracy parameters as a dictionary with the keys ``'m'``, ``'sigma'`` and ``'map_oversampling'`` (see :meth:`set_accuracy`)
+        """
+        if isinstance(self.accuracy, str):
+            return dict(_MAP_ACCURACIES[self.accuracy])
+        else:
+            return dict(zip(["m", "sigma", "map_oversampling"], self.accuracy))
+
+    def set_map_cache_size(self, maxbytes):
+        """
+        Set the memory budget of the cache of generated maps (geometries other than ``'custom'``)
+
+        Generated maps are cached for every combination of geometry, diameter, flattening and grid spacing. When the budget is exceeded the least recently used maps are evicted. The most recently generated map is always kept.
+
+        Args:
+          :maxbytes (int): Maximum memory of all cached maps in bytes. If ``None`` the memory is not limited
+        """
+        self._map_cache.set_maxbytes(maxbytes)
+
+    def get_map_cache_info(self):
+        """
+        Return a dictionary with the numbers of hits, misses and evictions of the cache of generated maps, the number of cached maps and their current and maximum memory in bytes
+        """
+        return self._map_cache.get_info()
+
     def get_next(self):
         """
         Iterate the parameters and return them as a dictionary
@@ -257,7 +359,7 @@ class ParticleMap(AbstractContinuousParticle):
             if len(s) == 3:
                 n_mat = len(self.materials)
                 s = numpy.array([n_mat] + list(s))
-                _map3d = numpy.array(n_mat*[map3d], dtype=numpy.float64)
+                _map3d = numpy.broadcast_to(numpy.array(map3d, dtype=numpy.float64), tuple(s))
             else:
                 if s[0] != len(self.materials):
                     log_and_raise_error(logger, "The first dimension of the map (%i) does not equal the number of specified materials (%i)." % (s[0], len(self.materials)))
@@ -265,7 +367,7 @@ class ParticleMap(AbstractContinuousParticle):
                 _map3d = numpy.asarray(map3d, dtype=numpy.float64)
         self._map3d_orig = _map3d
         self._dx_orig    = dx
-        self._set_cache(_map3d, dx, geometry="custom")
+        self._pyramid    = None
 
     def set_custom_geometry_by_h5file(self, map3d_filename, map3d_dataset, dx):
         """
@@ -365,17 +467,104 @@ class ParticleMap(AbstractContinuousParticle):
           :dx_suggested (float): Suggested resolution (grid spacing) of the map. If the map has a very high resolution it will be interpolated to a the suggested resolution value
 
           :photon_wavelength (float): Photon wavelength in unit meter 
+
+        As long as the map and the photon wavelength do not change the same (read-only) array is returned. Callers can therefore detect an unchanged map by its identity and reuse quantities derived from it (e.g. the oversampled spectrum of the NFFT).
         """
         m,dx = self.get_new_map(O=O, dx_required=dx_required, dx_suggested=dx_suggested)
+        if self._dn_cache and self._dn_cache["map3d"] is m and self._dn_cache["photon_wavelength"] == photon_wavelength:
+            return self._dn_cache["dn"],dx
         if self.materials is not None:
             dn = numpy.zeros(shape=(m.shape[1], m.shape[2], m.shape[3]), dtype=numpy.complex128)
             for mat_i, m_i in zip(self.materials, m):
                 dn_i = mat_i.get_dn(photon_wavelength=photon_wavelength)
                 dn += m_i * dn_i
         else:
-            dn = m[0]    
+            dn = numpy.array(m[0])
+        # Protect the cached array from being modified by the caller
+        dn.setflags(write=False)
+        self._dn_cache = {
+            "map3d"             : m,
+            "photon_wavelength" : photon_wavelength,
+            "dn"                : dn,
+        }
         return dn,dx
 
+    def get_new_dn_map_cropped(self, O, dx_required, dx_suggested, photon_wavelength):
+        """
+        Return the refractive index map of :meth:`condor.particle.particle_map.ParticleMap.get_new_dn_map` cropped to the box around its non-zero values (see :func:`condor.utils.nfft.crop_to_support`), the grid spacing and the map indices of the origin of the transform in the cropped map
+
+        The box is determined only once per map. As long as the map and the photon wavelength do not change the same (read-only) array is returned. If ``condor.particle.particle_map.ENABLE_SUPPORT_CROPPING`` is ``False`` the map is not cropped.
+
+        Args:
+          :O (dict): Parameter dictionary as returned from :meth:`condor.particle.particle_map.get_next`
+
+          :dx_required (float): Required resolution (grid spacing) of the map
+
+          :dx_suggested (float): Suggested resolution (grid spacing) of the map
+
+          :photon_wavelength (float): Photon wavelength in unit meter
+        """
+        dn,dx = self.get_new_dn_map(O=O, dx_required=dx_required, dx_suggested=dx_suggested, photon_wavelength=photon_wavelength)
+        if not ENABLE_SUPPORT_CROPPING:
+            return dn,dx,tuple([N//2 for N in dn.shape])
+        if "cropped" not in self._dn_cache:
+            cropped, origins = condor.utils.nfft.crop_to_support(dn)
+            if cropped.shape != dn.shape:
+                log_debug(logger, "Cropped map of shape %s to its support of shape %s." % (str(dn.shape), str(cropped.shape)))
+                cropped = numpy.ascontiguousarray(cropped)
+                cropped.setflags(write=False)
+            self._dn_cache["cropped"] = (cropped, origins)
+        cropped, origins = self._dn_cache["cropped"]
+        return cropped,dx,origins
+
+    def get_new_material_maps_cropped(self, O, dx_required, dx_suggested, photon_wavelength):
+        """
+        Return the refractive index map of :meth:`condor.particle.particle_map.ParticleMap.get_new_dn_map_cropped` decomposed into distinct maps and their complex refractive indices for the given photon wavelength
+
+        The refractive index map equals the sum of the maps weighted by the refractive indices. Maps that several materials share are returned only once with the sum of the refractive indices of these materials. The Fourier transform is linear, the transforms of the maps can therefore be reused for other photon wavelengths and materials as long as the maps do not change (the same read-only array is returned).
+
+        Args:
+          :O (dict): Parameter dictionary as returned from :meth:`condor.particle.particle_map.get_next`
+
+          :dx_required (float): Required resolution (grid spacing) of the map
+
+          :dx_suggested (float): Suggested resolution (grid spacing) of the map
+
+          :photon_wavelength (float): Photon wavelength in unit meter
+
+        Returns the maps (array of shape (*M*, ...)), the complex refractive indices (array of length *M*), the grid spacing and the map indices of the origin of the transform in the cropped maps.
+        """
+        m,dx = self.get_new_map(O=O, dx_required=dx_required, dx_suggested=dx_suggested)
+        if not self._material_cache or self._material_cache["map3d"] is not m:
+            maps = _get_distinct_maps(m)
+            if self.materials is None:
+                # The first map is the refractive index map (see get_new_dn_map)
+                maps = maps[:1]
+            if ENABLE_SUPPORT_CROPPING:
+                cropped, origins = condor.utils.nfft.crop_to_support(maps, axes=range(1, maps.ndim))
+                origins = origins[1:]
+            else:
+                cropped, origins = maps, tuple([N//2 for N in maps.shape[1:]])
+            if cropped.shape != maps.shape:
+                log_debug(logger, "Cropped maps of shape %s to their support of shape %s." % (str(maps.shape), str(cropped.shape)))
+            # Read-only view that does not affect the cached map
+            cropped = numpy.ascontiguousarray(cropped).view()
+            cropped.setflags(write=False)
+            self._material_cache = {
+                "map3d"   : m,
+                "maps"    : cropped,
+                "origins" : origins,
+            }
+        maps = self._material_cache["maps"]
+        if self.materials is None:
+            dn = numpy.ones(1, dtype=numpy.complex128)
+        else:
+            dn = numpy.array([mat.get_dn(photon_wavelength=photon_wavelength) for mat in self.materials], dtype=numpy.complex128)
+            if maps.shape[0] != dn.shape[0]:
+                # One map that all materials share
+                dn = numpy.array([dn.sum()])
+        return maps, dn, dx, self._material_cache["origins"]
+
     def get_current_map(self):
         """
         Return the current map
@@ -388,6 +577,59 @@ class ParticleMap(AbstractContinuousParticle):
 
         """
         return self._map3d_orig, self._dx_orig
+
+    def set_map_pyramid_directory(self, directory=None):
+        """
+        Set a directory in which the levels of the map pyramid of a custom map are stored (see :meth:`get_map_pyramid`)
+
+        The levels are stored in a file whose name contains a hash of the original map and its grid spacing. If the file exists the levels are read instead of being calculated again, e.g. by another process or in a later run.
+
+        Kwargs:
+          :directory (str): Directory of the stored pyramids. If ``None`` the pyramid is only kept in memory (default ``None``)
+        """
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._pyramid_directory = directory
+
+    def get_map_pyramid(self):
+        """
+        Return the pyramid of downsampled versions of the original custom map as a list of tuples (*map*, *dx*) from the original map to the coarsest level
+
+        The levels are downsampled by cropping the spectrum of the original map (alias-free, see :func:`condor.utils.resample.fourier_crop`). The grid spacing grows by a factor of :math:`\\sqrt{2}` from one level to the next (down to 8 samples along every dimension). For every shot the coarsest level that is sampled finely enough is transformed (see :meth:`get_new_map`) if ``condor.particle.particle_map.ENABLE_MAP_INTERPOLATION`` is ``True`` (opt-in, the patterns then deviate from those of the original map by up to about 5E-3 relative to the maximum). The pyramid is calculated once and kept in memory (and on disk, see :meth:`set_map_pyramid_directory`).
+        """
+        if self._map3d_orig is None:
+            log_and_raise_error(logger, "The map pyramid is only available for custom maps.")
+            return
+        if self._pyramid is None:
+            N = self._map3d_orig.shape[-1]
+            sizes = []
+            n = N / _MAP_PYRAMID_FACTOR
+            while int(round(n)) >= _MAP_PYRAMID_MIN_SIZE:
+                if int(round(n)) not in sizes + [N]:
+                    sizes.append(int(round(n)))
+                n /= _MAP_PYRAMID_FACTOR
+            # A map that all materials share is downsampled (and stored) only once
+            m_orig = _get_distinct_maps(self._map3d_orig)
+            filename = None
+            if self._pyramid_directory is not None:
+                h = hashlib.sha1(numpy.ascontiguousarray(m_orig).tobytes())
+                h.update(repr((self._map3d_orig.shape, str(self._map3d_orig.dtype), self._dx_orig, sizes)).encode())
+                filename = os.path.join(self._pyramid_directory, "map_pyramid_%s.npz" % h.hexdigest())
+            if filename is not None and os.path.exists(filename):
+                log_debug(logger, "Reading map pyramid from %s." % filename)
+                with numpy.load(filename) as f:
+                    maps = [f["level_%i" % (i+1)] for i in range(len(sizes))]
+            else:
+                log_debug(logger, "Calculating map pyramid with %i levels." % (len(sizes)+1))
+                maps = condor.utils.resample.fourier_crop(m_orig, sizes)
+                if filename is not None:
+                    # Written under a temporary name first, an interrupted write does not leave a corrupt file behind
+                    tmp = filename[:-len(".npz")] + ".%i.tmp.npz" % os.getpid()
+                    numpy.savez(tmp, **dict([("level_%i" % (i+1), m) for i, m in enumerate(maps)]))
+                    os.rename(tmp, filename)
+            maps = [numpy.broadcast_to(m, self._map3d_orig.shape[:1] + m.shape[1:]) if m.shape[0] != self._map3d_orig.shape[0] else m for m in maps]
+            self._pyramid = [(self._map3d_orig, self._dx_orig)] + [(m, self._dx_orig * N / float(n)) for m, n in zip(maps, sizes)]
+        return self._pyramid
     
     def _get_map3d(self, O = None, dx_required = None, dx_suggested = None): 
         if O is not None:
@@ -396,37 +638,24 @@ class ParticleMap(AbstractContinuousParticle):
             m,dx = self.get_current_map()
         return m, dx
 
-    def _set_cache(self, map3d, dx, geometry, diameter=None, flattening=None):
-        self._cache = {
-            "map3d"      : map3d,
-            "dx"         : dx,
-            "geometry"   : geometry,
-            "diameter"   : diameter,
-            "flattening" : flattening,
-        }
-    
-    def _is_map_in_cache(self, O, dx_required):
-        # Empty cache?
-        if not self._cache:
-            return False
-        # Custom map?
-        elif O["geometry"] == "custom":
-            return False
-        # Correct geometry?
-        elif self._cache["geometry"] != O["geometry"]:
-            return False
-        # Correct size?
-        elif abs(self._cache["diameter"] - O["diameter"]) > 1E-10:
-            return False
-        # Correct spheroid flattening?
-        elif O["geometry"] == "spheroid":
-            if abs(self._cache["flattening"] - O["flattening"]) > 1E-10:
-                return False
-        # Sufficient resolution?
-        elif self._cache["dx"] > dx_required:
-            return False
+    def _get_map_from_cache(self, O, dx_required, dx_suggested):
+        # Generated map of the same geometry and spheroid flattening whose grid spacing rescaled to the diameter is fine enough but not much finer than suggested (key: geometry, diameter, flattening, dx)
+        def match(key):
+            geometry, diameter, flattening, dx = key
+            dx_rescaled = dx * O["diameter"] / diameter
+            return (geometry == O["geometry"] and (geometry != "spheroid" or abs(flattening - O["flattening"]) <= 1E-10) and
+                    (dx_rescaled <= dx_required or numpy.isclose(dx_rescaled/dx_required, 1.)) and dx_rescaled >= _MAP_RESCALING_MIN * dx_suggested)
+        return self._map_cache.find(match)
+
+    def _get_largest_diameter(self):
+        # Largest diameter that is expected from the diameter variation (three standard deviations above the mean for a normal distribution)
+        mode = self._diameter_variation.get_mode()
+        if mode in ["uniform", "range"]:
+            return self.diameter_mean + self._diameter_variation.get_spread()/2.
+        elif mode == "normal":
+            return self.diameter_mean + 3*self._diameter_variation.get_spread()
         else:
-            return True
+            return self.diameter_mean
         
     def get_new_map(self, O, dx_required, dx_suggested):
         """
@@ -439,88 +668,77 @@ class ParticleMap(AbstractContinuousParticle):
           :dx_required (float): Required resolution (grid spacing) of the map. An error is raised if the resolution of the map has too low resolution
 
           :dx_suggested (float): Suggested resolution (grid spacing) of the map. If the map has a very high resolution it will be interpolated to a the suggested resolution value
+
+        Maps of the geometries ``'icosahedron'``, ``'sphere'``, ``'spheroid'`` and ``'cube'`` are generated at the largest diameter that is expected from the diameter variation (upper limit of ``'uniform'`` and ``'range'``, three standard deviations above the mean for ``'normal'``) and are cached (see :meth:`set_map_cache_size`). Maps of other diameters are served from the cache by rescaling the grid spacing as long as the rescaled spacing is fine enough and not finer than half the suggested spacing, like for custom maps. A new map is only generated otherwise.
+
+        Custom maps that are sampled much finer than necessary are replaced by the coarsest level of a pyramid of downsampled maps (see :meth:`get_map_pyramid`) whose Nyquist frequency exceeds the largest scattering vector by a factor of 1.5. The level is chosen for the largest expected diameter, the same map is then used for all shots.
         """
         
         if O["geometry"] in ["icosahedron", "sphere", "spheroid", "cube"]:
             
-            if not self._is_map_in_cache(O, dx_required):
+            cached = self._get_map_from_cache(O, dx_required, dx_suggested)
+
+            if cached is None:
 
+                # Canonical map at the largest diameter that is expected from the diameter variation. Maps of smaller particles are served by rescaling its grid spacing.
+                diameter = max(O["diameter"], self._get_largest_diameter())
+                if O["diameter"] / diameter < _MAP_RESCALING_MIN:
+                    diameter = O["diameter"]
                 dx = dx_suggested
                 n_mat = len(self.materials)
                 
                 if O["geometry"] == "icosahedron":
-                    m_tmp = self._get_map_icosahedron(O["diameter"]/2., dx)
+                    m_tmp = self._get_map_icosahedron(diameter/2., dx)
 
                 elif O["geometry"] == "spheroid":
-                    a = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_a(O["diameter"],O["flattening"])
-                    c = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_c(O["diameter"],O["flattening"])
+                    a = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_a(diameter,O["flattening"])
+                    c = condor.utils.spheroid_diffraction.to_spheroid_semi_diameter_c(diameter,O["flattening"])
                     m_tmp = self._get_map_spheroid(a, c, dx)
 
                 elif O["geometry"] == "sphere":
-                    m_tmp = self._get_map_sphere(O["diameter"]/2., dx)
+                    m_tmp = self._get_map_sphere(diameter/2., dx)
 
                 elif O["geometry"] == "cube":
-                    m_tmp = self._get_map_cube(O["diameter"], dx)
+                    m_tmp = self._get_map_cube(diameter, dx)
 
                 else:
                     log_and_raise_error(logger, "Particle map geometry \"%s\" is not implemented. Change your configuration and try again." % O["geometry"])
                     sys.exit(1)
 
-                m = numpy.array(n_mat * [m_tmp])
-                    
-                self._set_cache(map3d=m,
-                                dx=dx,
-                                geometry=O["geometry"],
-                                diameter=O["diameter"],
-                                flattening=(None if O["geometry"] != "spheroid" else O["flattening"]))
+                # All materials share the same map (a read-only view instead of copies)
+                m = numpy.broadcast_to(m_tmp, (n_mat,) + m_tmp.shape)
+
+                evictions = self._map_cache.evictions
+                self._map_cache.put((O["geometry"], diameter, (None if O["geometry"] != "spheroid" else O["flattening"]), dx), (m, dx, diameter))
+                if self._map_cache.evictions > evictions:
+                    log_debug(logger, "Evicted %i map(s) from the cache (memory budget %s bytes)." % (self._map_cache.evictions - evictions, str(self._map_cache.maxbytes)))
 
             else:
 
                 log_debug(logger, "No need for calculating a new map. Reading map from cache.")
-                m  = self._cache["map3d"]
-                dx = self._cache["dx"]
+                m, dx, diameter = cached
+
+            # The map of a particle of another size is the same array with a rescaled grid spacing
+            dx = dx * O["diameter"] / diameter
 
         elif O["geometry"] == "custom":
 
             rescale_factor = O["diameter"] / self.diameter_mean
-            dx_rescaled = self._cache["dx"] * rescale_factor
             
-            # Current map too coarsely sampled?
+            # Original map too coarsely sampled?
+            dx_rescaled = self._dx_orig * rescale_factor
             if (dx_rescaled/dx_required > 1.) and not numpy.isclose(dx_rescaled/dx_required, 1.):
+                log_and_raise_error(logger, "Resolution of given custom map is insufficient for simulation. Required is at most %e m vs. provided %e m." % (dx_required, dx_rescaled))
+                sys.exit(1)
 
-                # Cached map (original) also too coarsely sampled? 
-                if self._dx_orig/dx_required > 1. and not numpy.isclose(self._dx_orig/dx_required, 1.):
-                    # Not fine enough -> exit
-                    log_and_raise_error(logger, "Resolution of given custom map is insufficient for simulation. Required is at most %e m vs. provided %e m." % (dx_required, self._dx_orig))
-                    sys.exit(1)
-                else:
-                    # Change back to original fine map
-                    self._set_cache(map3d=self._map3d_orig,
-                                    dx=self._dx_orig,
-                                    geometry="custom")
-                    
-            # Can we downsample current map?
-            # MAX: We would do this only for performance reasons but have not found a good way of downsampling without introducing artifacts
-            #if (dx_suggested/dx_rescaled >= 2.) and (dx_suggested/self._dx_orig >= 2.) and ENABLE_MAP_INTERPOLATION:
-            #    print("ENABLE_MAP_INTERPOLATION=%i" % ENABLE_MAP_INTERPOLATION)
-            #    N1 = self._map3d_orig.shape[0]
-            #    m1 = numpy.zeros(shape=(N1,N1,N1), dtype=numpy.float64)
-            #    m1[:self._map3d_orig.shape[0],:self._map3d_orig.shape[0],:self._map3d_orig.shape[0]] = self._map3d_orig[:,:,:]
-            #    fm1 = numpy.fft.fftshift(numpy.fft.ifftn(m1))
-            #    N1 = m1.shape[0]
-            #    N2 = int(numpy.ceil(N1 * self._dx_orig / dx_suggested))
-            #    x1 = numpy.linspace(-0.5,0.5,N2)*(1-0.5/N2)
-            #    Z,Y,X = numpy.meshgrid(x1,x1,x1,indexing="ij")
-            #    coords = numpy.array([[z,y,x] for z,y,x in zip(Z.ravel(),Y.ravel(),X.ravel())])
-            #    m2 = abs(numpy.fft.fftshift(condor.utils.nfft.nfft(fm1,coords).reshape((N2,N2,N2))))
-            #    #from pylab import *
-            #    #imsave("m1.png", m1.sum(0))
-            #    #imsave("m2.png", m2.sum(0))
-            #    self._dx    = self._dx_orig * float(N1)/float(N2)
-            #    self._map3d = m2 / m2.sum() * m1.sum()
-
-            m  = self._cache["map3d"]
-            dx = rescale_factor * self._cache["dx"]
+            # Coarsest grid spacing of the pyramid level with a margin. The level is chosen for the largest expected diameter, all shots of the particle then use the same map.
+            dx_max = min([dx_required, dx_suggested]) / _MAP_PYRAMID_MARGIN / (max(O["diameter"], self._get_largest_diameter()) / self.diameter_mean)
+            if ENABLE_MAP_INTERPOLATION and self._dx_orig * _MAP_PYRAMID_FACTOR <= dx_max:
+                m, dx = [(m, dx) for m, dx in self.get_map_pyramid() if dx <= dx_max or numpy.isclose(dx/dx_max, 1.)][-1]
+            else:
+                # The pyramid is not calculated if the original map is not much finer than necessary
+                m, dx = self._map3d_orig, self._dx_orig
+            dx = rescale_factor * dx
             
         return m,dx
                 
@@ -577,3 +795,9 @@ class ParticleMap(AbstractContinuousParticle):
         d = Dmax[temp]
         m[temp] = 0.5-d
         return numpy.asarray(m, dtype=numpy.float64)
+
+def _get_distinct_maps(m):
+    # Maps that all materials share are broadcast along the material axis (stride 0), only the first one is distinct
+    if m.shape[0] > 1 and m.strides[0] == 0:
+        return m[:1]
+    return m
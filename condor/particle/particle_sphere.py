@@ -33,6 +33,11 @@
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
 import numpy
 
+import logging
+logger = logging.getLogger(__name__)
+
+from condor.utils.log import log_and_raise_error,log_warning,log_info,log_debug
+
 from .particle_abstract import AbstractContinuousParticle
 
 class ParticleSphere(AbstractContinuousParticle):
@@ -76,13 +81,16 @@ class ParticleSphere(AbstractContinuousParticle):
       :atomic_composition (dict): See :meth:`condor.particle.particle_abstract.AbstractContinuousParticle.set_material` (default ``None``)
 
       :electron_density (float): See :meth:`condor.particle.particle_abstract.AbstractContinuousParticle.set_material` (default ``None``)
+
+      :form_factor_lookup (str): See :meth:`condor.particle.particle_sphere.ParticleSphere.set_form_factor_lookup` (default ``None``)
     """
 
     def __init__(self,
                  diameter, diameter_variation = None, diameter_spread = None, diameter_variation_n = None,
                  number = 1., arrival = "synchronised",
                  position = None, position_variation = None, position_spread = None, position_variation_n = None,
-                 material_type = None, massdensity = None, atomic_composition = None, electron_density = None): 
+                 material_type = None, massdensity = None, atomic_composition = None, electron_density = None,
+                 form_factor_lookup = None): 
 
         # Initialise base class
         AbstractContinuousParticle.__init__(self,
@@ -91,6 +99,21 @@ class ParticleSphere(AbstractContinuousParticle):
                                             number=number, arrival=arrival,
                                             position=position, position_variation=position_variation, position_spread=position_spread, position_variation_n=position_variation_n,
                                             material_type=material_type, massdensity=massdensity, atomic_composition=atomic_composition, electron_density=electron_density)
+        self.set_form_factor_lookup(form_factor_lookup)
+
+    def set_form_factor_lookup(self, form_factor_lookup=None):
+        """
+        Set whether the diffraction pattern is evaluated analytically or interpolated from a table of the sphere form factor
+
+        The tabulated form factor depends only on the product of the length of the scattering vector and the sphere radius. One table therefore serves all diameters and detector geometries and the pattern of every shot is interpolated from the cached lengths of the scattering vectors (see :class:`condor.utils.sphere_diffraction.SphereFormFactorTable`). If the beam center lies in the middle of the detector only one quadrant of the pattern is interpolated and mirrored.
+
+        Kwargs:
+          :form_factor_lookup (str): If ``None`` the form factor is evaluated analytically. Otherwise the accuracy of the table, either ``'draft'``, ``'standard'`` or ``'reference'`` (see :func:`condor.utils.sphere_diffraction.get_sphere_form_factor_table`) (default ``None``)
+        """
+        if form_factor_lookup not in [None, "draft", "standard", "reference"]:
+            log_and_raise_error(logger, "form_factor_lookup=\"%s\" is invalid. Choose either None, \"draft\", \"standard\" or \"reference\"." % form_factor_lookup)
+            return
+        self.form_factor_lookup = form_factor_lookup
         
     def get_next(self):
         """
@@ -100,7 +123,7 @@ class ParticleSphere(AbstractContinuousParticle):
         O["particle_model"] = "sphere"
         return O
 
-    def get_conf(sef):
+    def get_conf(self):
         """
         Get configuration in form of a dictionary. Another identically configured ParticleMap instance can be initialised by:
 
@@ -109,7 +132,12 @@ class ParticleSphere(AbstractContinuousParticle):
           conf = P0.get_conf()                 # P0: already existing ParticleSphere instance
           P1 = condor.ParticleSpheroid(**conf) # P1: new ParticleSphere instance with the same configuration as P0  
         """
-        return AbstractContinuousParticle.get_conf(self)
+        conf = AbstractContinuousParticle.get_conf(self)
+        # Spheres have no orientation
+        for k in ["rotation_values", "rotation_formalism", "rotation_mode"]:
+            conf.pop(k)
+        conf["form_factor_lookup"] = self.form_factor_lookup
+        return conf
 
     def get_dn(self, photon_wavelength):
         if self.materials is None:
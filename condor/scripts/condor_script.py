@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
 import argparse
+import contextlib
 import os
 import condor
 import condor.utils.cxiwriter
@@ -18,6 +19,7 @@ def main():
     parser.add_argument('-d', '--debug', dest='debug',  action='store_true', help='debugging mode (even more output than in verbose mode)', default=False)
     parser.add_argument('-t', '--measure-time', dest='measure_time',  action='store_true', help='Measure execution time', default=False)
     parser.add_argument('-r', '--number-of-repetitions', metavar='number_of_repetitions', type=int, help="number of repetitions (for time measurements)", default=1)
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, help="number of worker processes for parallel simulation", default=1)
     args = parser.parse_args()
     if not os.path.exists("./condor.conf"):
         parser.error("Cannot find configuration file \"condor.conf\" in current directory.")
@@ -48,14 +50,21 @@ def main():
         #with PyCallGraph(output=GraphvizOutput(),config=config):
         
         W = condor.utils.cxiwriter.CXIWriter("./condor.cxi")
-        for i in range(args.number_of_patterns):
-            t1 = time.time()
-            res = E.propagate()
-            t2 = time.time()
-            W.write(res)
-            t3 = time.time()
-            t_exec.append(t2 - t1)
-            t_write.append(t3 - t2)
+        if args.workers > 1:
+            # At most two shots per worker are calculated ahead of the writer, finished results are dropped after they are written
+            results = E.iter_propagate(args.number_of_patterns, prefetch=2*args.workers, workers=args.workers, processes=True)
+        else:
+            results = (E.propagate() for i in range(args.number_of_patterns))
+        # The workers are shut down also if writing fails
+        with contextlib.closing(results):
+            for i in range(args.number_of_patterns):
+                t1 = time.time()
+                res = next(results)
+                t2 = time.time()
+                W.write(res)
+                t3 = time.time()
+                t_exec.append(t2 - t1)
+                t_write.append(t3 - t2)
         W.close()
 
     t4 = time.time()
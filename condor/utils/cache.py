@@ -0,0 +1,209 @@
+# -----------------------------------------------------------------------------------------------------
+# CONDOR
+# Simulator for diffractive single-particle imaging experiments with X-ray lasers
+# http://xfel.icm.uu.se/condor/
+# -----------------------------------------------------------------------------------------------------
+# Copyright 2016 Max Hantke, Filipe R.N.C. Maia, Tomas Ekeberg
+# Condor is distributed under the terms of the BSD 2-Clause License
+# -----------------------------------------------------------------------------------------------------
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------------------------------
+# General note:
+# All variables are in SI units by default. Exceptions explicit by variable name.
+# -----------------------------------------------------------------------------------------------------
+"""
+Caching of intermediate results that are expensive to recalculate
+"""
+
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import collections, threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .log import log_and_raise_error,log_warning,log_info,log_debug
+
+class LRUCache:
+    """
+    Least-recently-used cache with counters for hits, misses and evictions
+
+    The cache is thread-safe. Cached entries are not pickled (a pickled or copied cache starts empty).
+
+    In addition to the number of entries the memory of the cached values can be limited. The size of a value is given by its attribute ``nbytes`` (arrays, without the repetitions of broadcast arrays) or by the sum of the sizes of its items (tuples and lists), other values do not count. The most recently stored entry is always kept, even if it exceeds the memory budget alone.
+
+    Kwargs:
+      :maxsize (int): Maximum number of entries. If ``None`` the number of entries is not limited (default ``8``)
+
+      :maxbytes (int): Maximum memory of all cached values in bytes. If ``None`` the memory is not limited (default ``None``)
+    """
+    def __init__(self, maxsize=8, maxbytes=None):
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self.maxbytes = None
+        self.set_maxsize(maxsize)
+        self.set_maxbytes(maxbytes)
+        self.reset_counters()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_entries"] = collections.OrderedDict()
+        state["_nbytes"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def set_maxsize(self, maxsize):
+        """
+        Set the maximum number of entries (least recently used entries are evicted if necessary)
+
+        Args:
+          :maxsize (int): Maximum number of entries. If ``None`` the number of entries is not limited
+        """
+        if maxsize is not None and maxsize < 0:
+            log_and_raise_error(logger, "maxsize = %i is invalid. The maximum number of cache entries must not be negative." % maxsize)
+            return
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def set_maxbytes(self, maxbytes):
+        """
+        Set the maximum memory of all cached values (least recently used entries are evicted if necessary)
+
+        Args:
+          :maxbytes (int): Maximum memory in bytes. If ``None`` the memory is not limited
+        """
+        if maxbytes is not None and maxbytes < 0:
+            log_and_raise_error(logger, "maxbytes = %i is invalid. The memory budget of the cache must not be negative." % maxbytes)
+            return
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def reset_counters(self):
+        """
+        Set the counters for hits, misses and evictions back to zero
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for ``key`` and mark it as most recently used. If there is no entry for ``key`` return ``default``
+
+        Args:
+          :key: Hashable key
+
+        Kwargs:
+          :default: Value returned on a cache miss (default ``None``)
+        """
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+            else:
+                self.misses += 1
+                return default
+
+    def find(self, match, default=None):
+        """
+        Return the cached value of the most recently used entry whose key satisfies ``match`` and mark it as most recently used. If there is no such entry return ``default``
+
+        Args:
+          :match: Function that takes a key and returns ``True`` for a matching entry
+
+        Kwargs:
+          :default: Value returned on a cache miss (default ``None``)
+        """
+        with self._lock:
+            for key in reversed(self._entries):
+                if match(key):
+                    return self.get(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Store ``value`` for ``key`` as most recently used entry
+
+        Args:
+          :key: Hashable key
+
+          :value: Value to be cached
+        """
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= _get_nbytes(self._entries.pop(key))
+            self._entries[key] = value
+            self._nbytes += _get_nbytes(value)
+            self._evict()
+
+    def get_info(self):
+        """
+        Return a dictionary with the number of hits, misses and evictions, the maximum and current number of entries and the maximum and current memory of the cached values
+        """
+        with self._lock:
+            return {
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evictions" : self.evictions,
+                "maxsize"   : self.maxsize,
+                "currsize"  : len(self._entries),
+                "maxbytes"  : self.maxbytes,
+                "currbytes" : self._nbytes,
+            }
+
+    def _evict(self):
+        while (self.maxsize is not None and len(self._entries) > self.maxsize) or \
+              (self.maxbytes is not None and self._nbytes > self.maxbytes and len(self._entries) > 1):
+            key, value = self._entries.popitem(last=False)
+            self._nbytes -= _get_nbytes(value)
+            self.evictions += 1
+
+def _get_nbytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum([_get_nbytes(v) for v in value])
+    strides = getattr(value, "strides", None)
+    if strides is not None and 0 in strides:
+        # Arrays that are broadcast along some axes (numpy.broadcast_to) hold only one element along these axes in memory
+        value = value[tuple([0 if s == 0 else slice(None) for s in strides])]
+    return getattr(value, "nbytes", 0)
@@ -0,0 +1,675 @@
+# -----------------------------------------------------------------------------------------------------
+# CONDOR
+# Simulator for diffractive single-particle imaging experiments with X-ray lasers
+# http://xfel.icm.uu.se/condor/
+# -----------------------------------------------------------------------------------------------------
+# Copyright 2016 Max Hantke, Filipe R.N.C. Maia, Tomas Ekeberg
+# Condor is distributed under the terms of the BSD 2-Clause License
+# -----------------------------------------------------------------------------------------------------
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------------------------------
+# General note:
+# All variables are in SI units by default. Exceptions explicit by variable name.
+# -----------------------------------------------------------------------------------------------------
+"""
+Non-equispaced fast Fourier transform (NFFT)
+
+Two backends are available:
+
+  - ``'c'``: C extension :mod:`condor.utils._nfft` that wraps the `NFFT library <https://www-user.tu-chemnitz.de/~potts/nfft/>`_ (only if Condor was built against libnfft3)
+
+  - ``'numpy'``: Vectorised implementation in NumPy (oversampled FFT and Kaiser-Bessel gridding)
+
+By default (backend ``'auto'``) the C extension is used if it is available and the NumPy implementation otherwise. The default can be changed with the environment variable ``CONDOR_NFFT_BACKEND`` or by :func:`condor.utils.nfft.set_backend`.
+
+The FFTs of the C backend are planned by FFTW with the lowest planner effort by default. Plans of a higher effort can be stored persistently in a wisdom file (opt-in, see :func:`condor.utils.nfft.set_wisdom_directory`). If the environment variable ``CONDOR_NFFT_WISDOM_DIR`` is set the wisdom store in this directory is enabled at import.
+
+The transform of a map :math:`\\hat{f}` with shape :math:`(N_1, ..., N_d)` at the points :math:`x_j \\in [-0.5, 0.5)^d` is defined as
+
+.. math::
+
+  f(x_j) = \\sum_k \\hat{f}_k \\exp(-2 \\pi i \\, k \\cdot x_j)
+
+with the frequencies :math:`k_i = -N_i/2, ..., N_i/2 - 1` (map index minus :math:`N_i/2`, rounded down).
+"""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy, os
+
+import logging
+logger = logging.getLogger(__name__)
+
+from condor.utils.log import log,log_and_raise_error,log_warning,log_info,log_debug
+
+try:
+    import condor.utils._nfft as _nfft
+except ImportError:
+    _nfft = None
+
+_BACKENDS = ["auto", "c", "numpy"]
+
+# Window parameters of the NumPy backend: window cut-off (m) and oversampling factor (sigma)
+# The cut-off is the one of the C backend so that both backends reach the same accuracy
+_NUMPY_M = 8
+_NUMPY_SIGMA = 2.
+# Upper limit for the size of the temporary arrays of the gridding step (in bytes)
+_NUMPY_CHUNK_BYTES = 64*1024**2
+
+_backend = os.environ.get("CONDOR_NFFT_BACKEND", "auto")
+if _backend not in _BACKENDS:
+    log_warning(logger, "CONDOR_NFFT_BACKEND=%s is invalid and ignored. Choose one of the following: %s." % (_backend, ", ".join(_BACKENDS)))
+    _backend = "auto"
+
+# Name of the FFTW wisdom file in the wisdom directory
+_WISDOM_FILENAME = "fftw_wisdom"
+_wisdom = {
+    "directory"      : None,
+    # Map shapes and numbers of threads that were planned since the wisdom was loaded
+    "planned"        : set(),
+}
+
+def set_wisdom_directory(directory=None, planner_effort="measure"):
+    """
+    Enable (or disable) the persistent FFTW wisdom store of the C backend
+
+    Wisdom is the record of the FFT plans that FFTW found to be fastest for a given map shape and number of threads. The wisdom file in the given directory is loaded immediately and written again whenever a plan for a new map shape or a new number of threads has been created. Wisdom of concurrent jobs that share the directory is merged. Only the first job pays for the planner effort, all later jobs use the stored plans. The wisdom store has no effect on the NumPy backend.
+
+    Kwargs:
+      :directory (str): Directory of the wisdom file. If ``None`` the wisdom store is disabled and the planner effort is reset to ``'estimate'`` (default ``None``)
+
+      :planner_effort (str): Effort of the FFTW planner, either ``'estimate'``, ``'measure'``, ``'patient'`` or ``'exhaustive'`` (default ``'measure'``)
+    """
+    if _nfft is None:
+        log_warning(logger, "FFTW wisdom is not used because the C backend is not available.")
+        return
+    if directory is None:
+        _nfft.set_planner_effort("estimate")
+        _wisdom["directory"] = None
+        return
+    _nfft.set_planner_effort(planner_effort)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    _wisdom["directory"] = directory
+    _wisdom["planned"] = set()
+    filename = os.path.join(directory, _WISDOM_FILENAME)
+    if os.path.exists(filename):
+        if _nfft.import_wisdom(filename):
+            log_debug(logger, "Loaded FFTW wisdom from %s." % filename)
+        else:
+            log_warning(logger, "Could not load FFTW wisdom from %s." % filename)
+
+def get_wisdom_directory():
+    """
+    Return the directory of the FFTW wisdom store (``None`` if the wisdom store is disabled)
+    """
+    return _wisdom["directory"]
+
+def preplan(shapes, nthreads=None):
+    """
+    Plan the FFTs for a list of expected map shapes ahead of time and store them in the wisdom file (see :func:`condor.utils.nfft.set_wisdom_directory`)
+
+    Args:
+      :shapes (list): List of map shapes
+
+    Kwargs:
+      :nthreads (int): Number of threads. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+    """
+    if _nfft is None or _wisdom["directory"] is None:
+        log_warning(logger, "Nothing to plan because the wisdom store is not enabled for the C backend.")
+        return
+    _check_num_threads(nthreads)
+    for shape in shapes:
+        # The FFT does not depend on the number of points
+        _nfft.Plan(tuple(shape), 1, nthreads=nthreads)
+        _note_plan(tuple(shape), nthreads)
+
+def _note_plan(shape, nthreads):
+    # Write the wisdom after plans for a new map shape or number of threads
+    if _wisdom["directory"] is None:
+        return
+    key = (tuple(shape), _nfft.get_num_threads() if nthreads is None else nthreads)
+    if key in _wisdom["planned"]:
+        return
+    _wisdom["planned"].add(key)
+    filename = os.path.join(_wisdom["directory"], _WISDOM_FILENAME)
+    # Merge the wisdom of other jobs and replace the file atomically
+    if os.path.exists(filename):
+        _nfft.import_wisdom(filename)
+    filename_tmp = "%s.%i.tmp" % (filename, os.getpid())
+    if _nfft.export_wisdom(filename_tmp):
+        getattr(os, "replace", os.rename)(filename_tmp, filename)
+        log_debug(logger, "Saved FFTW wisdom to %s." % filename)
+    else:
+        log_warning(logger, "Could not save FFTW wisdom to %s." % filename)
+
+if os.environ.get("CONDOR_NFFT_WISDOM_DIR"):
+    set_wisdom_directory(os.environ["CONDOR_NFFT_WISDOM_DIR"])
+
+def set_backend(backend="auto"):
+    """
+    Set the backend for all following transforms
+
+    Kwargs:
+      :backend (str): Either ``'auto'`` (C extension if available, NumPy otherwise), ``'c'`` or ``'numpy'`` (default ``'auto'``)
+    """
+    global _backend
+    if backend not in _BACKENDS:
+        log_and_raise_error(logger, "backend=%s is invalid. Choose one of the following: %s." % (backend, ", ".join(_BACKENDS)))
+        return
+    if backend == "c" and _nfft is None:
+        log_and_raise_error(logger, "The C backend is not available because Condor was built without the NFFT library.")
+        return
+    _backend = backend
+
+def get_backend():
+    """
+    Return the backend that is used for transforms (either ``'c'`` or ``'numpy'``)
+    """
+    if _backend == "auto":
+        return "c" if _nfft is not None else "numpy"
+    else:
+        return _backend
+
+def is_c_backend_available():
+    """
+    Return ``True`` if the C extension for the NFFT library is available
+    """
+    return _nfft is not None
+
+def set_num_threads(nthreads):
+    """
+    Set the number of threads used by all following transforms that do not specify the number of threads themselves. Only the C backend (built with thread support) uses threads
+
+    Args:
+      :nthreads (int): Number of threads. If ``None`` the OpenMP default (``OMP_NUM_THREADS``) is used
+    """
+    _check_num_threads(nthreads)
+    if _nfft is not None:
+        _nfft.set_num_threads(nthreads)
+
+def get_num_threads():
+    """
+    Return the number of threads used by transforms that do not specify the number of threads themselves
+    """
+    if get_backend() == "c":
+        return _nfft.get_num_threads()
+    else:
+        return 1
+
+def nfft(real_space, coordinates=None, nthreads=None, m=None, sigma=None):
+    """
+    Return the Fourier transform of a map at arbitrary points
+
+    Args:
+      :real_space (array): Map of arbitrary dimension *d*
+
+    Kwargs:
+      :coordinates (array): Array of shape (*N*, *d*) (or (*N*,) for 1D maps) of the points where the Fourier transform is evaluated. Coordinates are expected in the interval [-0.5, 0.5) (default ``None``)
+
+      :nthreads (int): Number of threads. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+
+      :m (int): Cut-off of the window function (number of grid points on either side of a point). If ``None`` the default of the backend is used (default ``None``)
+
+      :sigma (float): Oversampling factor of the FFT grid. If ``None`` the default of the backend is used (default ``None``)
+    """
+    real_space, coordinates = _check_input(real_space, coordinates)
+    _check_num_threads(nthreads)
+    _check_window(m, sigma)
+    if get_backend() == "c":
+        out = _nfft.nfft(real_space, coordinates, nthreads=nthreads, **_get_c_window_kwargs(m, sigma))
+        _note_plan(real_space.shape, nthreads)
+        return out
+    else:
+        return _NumpyPlan(real_space.shape, coordinates.shape[0], m=m, sigma=sigma).transform_map(real_space, coordinates)
+
+def nfft_many(maps, coordinates=None, nthreads=None, m=None, sigma=None):
+    """
+    Return the Fourier transforms of a stack of maps at the same points
+
+    Quantities that depend only on the coordinates (the window function) are calculated only once for all maps.
+
+    Args:
+      :maps (array): Array of shape (*M*, ...) of *M* maps of arbitrary dimension *d* (or a sequence of maps of the same shape)
+
+    Kwargs:
+      :coordinates (array): Array of shape (*N*, *d*) (or (*N*,) for 1D maps) of the points where the Fourier transforms are evaluated. Coordinates are expected in the interval [-0.5, 0.5) (default ``None``)
+
+      :nthreads (int): Number of threads. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+
+      :m (int): Cut-off of the window function (number of grid points on either side of a point). If ``None`` the default of the backend is used (default ``None``)
+
+      :sigma (float): Oversampling factor of the FFT grid. If ``None`` the default of the backend is used (default ``None``)
+
+    Returns an array of shape (*M*, *N*) with one row per map.
+    """
+    try:
+        maps = numpy.asarray(maps, dtype=numpy.complex128)
+    except (TypeError, ValueError):
+        log(logger, "Invalid input to nfft_many.", lvl="ERROR", exception=ValueError)
+    if maps.ndim < 2:
+        log(logger, "Maps must be given as array of dimensions [NUMBER_OF_MAPS, ...].", lvl="ERROR", exception=ValueError)
+    real_space, coordinates = _check_input(maps[0], coordinates)
+    _check_num_threads(nthreads)
+    _check_window(m, sigma)
+    if get_backend() == "c":
+        out = numpy.empty((maps.shape[0], coordinates.shape[0]), dtype=numpy.complex128)
+        plan = _nfft.Plan(real_space.shape, coordinates.shape[0], nthreads=nthreads, **_get_c_window_kwargs(m, sigma))
+        _note_plan(real_space.shape, nthreads)
+        plan.set_coordinates(coordinates)
+        for i in range(maps.shape[0]):
+            plan.set_map(maps[i])
+            plan.transform(out=out[i])
+        return out
+    else:
+        plan = _NumpyPlan(real_space.shape, coordinates.shape[0], m=m, sigma=sigma)
+        plan.set_coordinates(coordinates)
+        plan.set_maps(maps)
+        return plan.transform_many().reshape(maps.shape[0], coordinates.shape[0])
+
+def nfft_grid(real_space, spacing, n, ranges=None, origins=None):
+    r"""
+    Return the Fourier transform of a map on a regular grid of points (the same transform as :func:`condor.utils.nfft.nfft`)
+
+    Along every dimension the grid has *n* points :math:`x_k = (k - (n-1)/2)\,h` that are centered around zero, with the grid spacing *h*. The transform is separable and is carried out along one dimension after the other as chirp-z transform (Bluestein's algorithm), i.e. as a convolution with zero-padded FFTs of efficient lengths. The result is exact for any grid spacing and no window function is needed.
+
+    Args:
+      :real_space (array): Map of arbitrary dimension
+
+      :spacing (float): Grid spacing *h*
+
+      :n (int): Number of grid points along every dimension
+
+    Kwargs:
+      :ranges (list): Ranges ``(start, stop)`` of grid indices per dimension that are evaluated (``None`` for all indices of a dimension). If ``None`` the whole grid is evaluated (default ``None``)
+
+      :origins (list): Map index of the origin of the transform per dimension (may lie outside of the map, see :func:`condor.utils.nfft.crop_to_support`). If ``None`` the origin lies at the index :math:`N_i/2` (rounded down) like in :func:`condor.utils.nfft.nfft` (default ``None``)
+
+    Returns an array of shape (*n*, ..., *n*) with the dimensions of the map (or with the lengths of the given ranges).
+    """
+    try:
+        out = numpy.asarray(real_space, dtype=numpy.complex128)
+    except (TypeError, ValueError):
+        log(logger, "Invalid input to nfft_grid.", lvl="ERROR", exception=ValueError)
+    n = int(n)
+    if n < 1:
+        log(logger, "The number of grid points must be positive.", lvl="ERROR", exception=ValueError)
+    if ranges is None:
+        ranges = [None] * out.ndim
+    if len(ranges) != out.ndim:
+        log(logger, "The number of ranges (%i) does not match the number of dimensions of the map (%i)." % (len(ranges), out.ndim), lvl="ERROR", exception=ValueError)
+    ranges = [(0, n) if r is None else tuple(r) for r in ranges]
+    if origins is None:
+        origins = [N // 2 for N in out.shape]
+    if len(origins) != out.ndim:
+        log(logger, "The number of origins (%i) does not match the number of dimensions of the map (%i)." % (len(origins), out.ndim), lvl="ERROR", exception=ValueError)
+    for start, stop in ranges:
+        if not 0 <= start < stop <= n:
+            log(logger, "Invalid range (%s, %s) of grid indices." % (str(start), str(stop)), lvl="ERROR", exception=ValueError)
+    # Dimensions with the shortest ranges first keeps the intermediate arrays small
+    for axis in sorted(range(out.ndim), key=lambda axis: ranges[axis][1] - ranges[axis][0]):
+        start, stop = ranges[axis]
+        # Index k of the range lies at k - (n-1)/2 + start grid spacings
+        out = _chirp_z(out, float(spacing), stop - start, (n - 1) / 2. - start, origins[axis], axis)
+    return out
+
+def _chirp_z(a, h, n, c, j0, axis):
+    # y_k = sum_j a_j exp(-2 pi i h (k - c) (j - j0)) for k = 0, ..., n-1
+    # Substituting k j = (k^2 + j^2 - (k-j)^2)/2 turns the sum into a convolution with the chirp exp(i pi h m^2)
+    N = a.shape[axis]
+    L = _next_fast_len(N + n - 1)
+    j = numpy.arange(N)
+    k = numpy.arange(n)
+    m = numpy.arange(-(N - 1), n)
+    pre = numpy.exp(1.j*numpy.pi*h*(2*c*j - j**2))
+    post = numpy.exp(-1.j*numpy.pi*h*(k**2 - 2*k*j0 + 2*c*j0))
+    chirp = numpy.zeros(L, dtype=numpy.complex128)
+    chirp[:len(m)] = numpy.exp(1.j*numpy.pi*h*m**2)
+    chirp_hat = numpy.fft.fft(chirp)
+    a = numpy.moveaxis(a, axis, -1)
+    shape = a.shape[:-1]
+    a = a.reshape(-1, N)
+    out = numpy.empty((a.shape[0], n), dtype=numpy.complex128)
+    # Rows of the padded convolution are transformed in chunks to limit the size of temporary arrays
+    chunk = max(1, _NUMPY_CHUNK_BYTES // (16 * L))
+    for i0 in range(0, a.shape[0], chunk):
+        i1 = min(i0 + chunk, a.shape[0])
+        b = numpy.fft.fft(a[i0:i1] * pre, n=L, axis=-1)
+        b *= chirp_hat
+        out[i0:i1] = numpy.fft.ifft(b, axis=-1)[:,N-1:N-1+n] * post
+    return numpy.moveaxis(out.reshape(shape + (n,)), -1, axis)
+
+def crop_to_support(real_space, axes=None):
+    """
+    Return a map cropped to a box that contains all of its non-zero values and the map indices of the origin of the transform in the cropped map
+
+    Along every dimension the box is extended to the smallest length without prime factors other than 2, 3 and 5 that has the parity of the length of the map, and it is placed symmetrically around the non-zero values as far as the map allows. A map that is centered on its grid therefore stays centered. Dimensions where the box would not be shorter than the map are not cropped.
+
+    The transform of the map equals the transform of the cropped map with the returned origins (see :func:`condor.utils.nfft.nfft_grid`) or, equivalently, the transform of the cropped map with the default origins times the phase factors of :func:`condor.utils.nfft.get_origin_phase`.
+
+    Args:
+      :real_space (array): Map of arbitrary dimension
+
+    Kwargs:
+      :axes (list): Dimensions that are cropped. The other dimensions (e.g. the index of a stack of maps) are kept whole. If ``None`` all dimensions are cropped (default ``None``)
+
+    Returns the cropped map (a view of the map) and a tuple with the origin index per dimension. A map without non-zero values is not cropped.
+    """
+    m = numpy.asarray(real_space)
+    support = m != 0
+    slices = []
+    origins = []
+    axes = range(m.ndim) if axes is None else list(axes)
+    for axis, N in enumerate(m.shape):
+        size = N
+        if axis in axes:
+            # Indices along this axis that have any non-zero value
+            k = numpy.flatnonzero(support.any(axis=tuple([a for a in range(m.ndim) if a != axis])))
+            if len(k):
+                size = _next_fast_len_parity(k[-1] - k[0] + 1, N % 2)
+        if size >= N:
+            slices.append(slice(None))
+            origins.append(N // 2)
+            continue
+        start = int(min(max(k[0] - (size - (k[-1] - k[0] + 1)) // 2, 0), N - size))
+        slices.append(slice(start, start + size))
+        origins.append(N // 2 - start)
+    return m[tuple(slices)], tuple(origins)
+
+def get_origin_phase(coordinates, shape, origins):
+    """
+    Return the phase factors :math:`\\exp(-2 \\pi i \\, x_j \\cdot s)` that turn the transform of a map with the origin at the map indices :math:`N_i/2` (rounded down) into the transform with the origin at other indices :math:`o_i`, with the shift :math:`s_i = N_i/2 - o_i`
+
+    Args:
+      :coordinates (array): Array of shape (*N*, *d*) (or (*N*,) for 1D maps) of the points where the transform is evaluated
+
+      :shape (tuple): Shape of the map
+
+      :origins (tuple): Map index of the origin per dimension (see :func:`condor.utils.nfft.crop_to_support`)
+    """
+    shift = numpy.array([N // 2 - o for N, o in zip(shape, origins)], dtype=numpy.float64)
+    x = numpy.asarray(coordinates, dtype=numpy.float64).reshape(-1, len(shift))
+    return numpy.exp(-2.j*numpy.pi*x.dot(shift))
+
+def _next_fast_len_parity(n, parity):
+    # Smallest integer >= n with the given parity and without prime factors other than 2, 3 and 5
+    m = n + ((n - parity) % 2)
+    while True:
+        r = m
+        for p in [2, 3, 5]:
+            while r % p == 0:
+                r //= p
+        if r == 1:
+            return m
+        m += 2
+
+def _check_window(m, sigma):
+    if m is not None and (int(m) != m or m < 1):
+        log(logger, "The window cut-off m must be a positive integer.", lvl="ERROR", exception=ValueError)
+    if sigma is not None and sigma <= 1.:
+        log(logger, "The oversampling factor sigma must be larger than 1.", lvl="ERROR", exception=ValueError)
+
+def _get_c_window_kwargs(m, sigma):
+    # The C extension uses the defaults of the NFFT library for values that are not positive
+    return {"m": 0 if m is None else int(m), "sigma": 0. if sigma is None else float(sigma)}
+
+def _check_num_threads(nthreads):
+    if nthreads is not None and nthreads < 1:
+        log(logger, "The number of threads must be at least 1.", lvl="ERROR", exception=ValueError)
+
+def _check_input(real_space, coordinates):
+    if coordinates is None:
+        log(logger, "Coordinates are missing.", lvl="ERROR", exception=ValueError)
+    try:
+        real_space = numpy.asarray(real_space, dtype=numpy.complex128)
+        coordinates = numpy.asarray(coordinates, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        log(logger, "Invalid input to nfft.", lvl="ERROR", exception=ValueError)
+    if real_space.ndim == 0:
+        log(logger, "Input array can't be 0 dimensional.", lvl="ERROR", exception=ValueError)
+    if real_space.ndim == 1 and coordinates.ndim == 1:
+        coordinates = coordinates[:,numpy.newaxis]
+    if coordinates.ndim != 2 or coordinates.shape[1] != real_space.ndim:
+        log(logger, "Coordinates must be given as array of dimensions [NUMBER_OF_POINTS, NUMBER_OF_DIMENSIONS] of [NUMBER_OF_POINTS for 1D transforms.", lvl="ERROR", exception=ValueError)
+    return real_space, coordinates
+
+class Plan:
+    """
+    Persistent NFFT plan for maps of a given shape and a given number of points
+
+    Map and coordinates are set independently and are kept across transforms. Quantities that depend only on the coordinates (the window function) are only calculated again if new coordinates are set. The backend is chosen when the plan is created (see :func:`condor.utils.nfft.set_backend`). A plan can be used by one thread at a time.
+
+    Args:
+      :shape (tuple): Shape of the map
+
+      :number_of_points (int): Number of points where the Fourier transform is evaluated
+
+    Kwargs:
+      :nthreads (int): Number of threads of the FFT. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+
+      :m (int): Cut-off of the window function (number of grid points on either side of a point). If ``None`` the default of the backend is used (default ``None``)
+
+      :sigma (float): Oversampling factor of the FFT grid. If ``None`` the default of the backend is used (default ``None``)
+    """
+    def __init__(self, shape, number_of_points, nthreads=None, m=None, sigma=None):
+        _check_window(m, sigma)
+        self.backend = get_backend()
+        if self.backend == "c":
+            self._plan = _nfft.Plan(tuple(shape), number_of_points, nthreads=nthreads, **_get_c_window_kwargs(m, sigma))
+            _note_plan(tuple(shape), nthreads)
+        else:
+            self._plan = _NumpyPlan(tuple(shape), number_of_points, m=m, sigma=sigma)
+        self.shape = tuple(shape)
+        self.number_of_points = number_of_points
+        self._maps = None
+
+    def set_coordinates(self, coordinates):
+        """
+        Set the points where the Fourier transform is evaluated
+
+        Args:
+          :coordinates (array): Array of shape (*N*, *d*) (or (*N*,) for 1D maps) with *N* equal to the number of points of the plan
+        """
+        self._plan.set_coordinates(coordinates)
+
+    def set_map(self, real_space):
+        """
+        Set the map that is transformed
+
+        Args:
+          :real_space (array): Map with the shape of the plan
+        """
+        self._maps = None
+        self._plan.set_map(real_space)
+
+    def set_maps(self, maps):
+        """
+        Set a stack of maps that are transformed at the same points (see :meth:`condor.utils.nfft.Plan.transform_many`)
+
+        Args:
+          :maps (array): Array of shape (*M*, ...) of *M* maps with the shape of the plan
+        """
+        if self.backend == "c":
+            # The C backend transforms one map after the other
+            maps = numpy.asarray(maps)
+            if maps.shape[1:] != self.shape:
+                log(logger, "Shape of the maps does not match the shape of the plan.", lvl="ERROR", exception=ValueError)
+            self._maps = maps
+        else:
+            self._maps = None
+            self._plan.set_maps(maps)
+
+    def transform(self, out=None, nthreads=None):
+        """
+        Return the Fourier transform of the map at the coordinates of the plan
+
+        Kwargs:
+          :out (array): C-contiguous complex128 array of length *N* into which the result is written. If ``None`` a new array is returned (default ``None``)
+
+          :nthreads (int): Number of threads. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+        """
+        return self._plan.transform(out=out, nthreads=nthreads)
+
+    def transform_many(self, out=None, nthreads=None):
+        """
+        Return the Fourier transforms of the maps of :meth:`condor.utils.nfft.Plan.set_maps` at the coordinates of the plan as array of shape (*M*, *N*)
+
+        Kwargs:
+          :out (array): C-contiguous complex128 array of shape (*M*, *N*) into which the result is written. If ``None`` a new array is returned (default ``None``)
+
+          :nthreads (int): Number of threads. If ``None`` the setting of :func:`condor.utils.nfft.set_num_threads` is used (default ``None``)
+        """
+        if self.backend == "c":
+            if self._maps is None:
+                log_and_raise_error(logger, "Maps have to be set with set_maps before the transform.")
+                return
+            if out is None:
+                out = numpy.empty((self._maps.shape[0], self.number_of_points), dtype=numpy.complex128)
+            for i in range(self._maps.shape[0]):
+                self._plan.set_map(numpy.ascontiguousarray(self._maps[i], dtype=numpy.complex128))
+                self._plan.transform(out=out[i], nthreads=nthreads)
+            return out
+        out = self._plan.transform_many(out=out, nthreads=nthreads)
+        return out.reshape(-1, self.number_of_points)
+
+
+def _next_fast_len(n):
+    # Smallest even integer >= n without prime factors other than 2, 3 and 5
+    return _next_fast_len_parity(n, 0)
+
+class _NumpyPlan:
+    """
+    NFFT in NumPy: deconvolution with the Fourier transform of the Kaiser-Bessel window, oversampled FFT and interpolation with the window (in chunks of points)
+    """
+    def __init__(self, shape, number_of_points, m=None, sigma=None):
+        self.shape = tuple([int(N) for N in shape])
+        self.number_of_points = int(number_of_points)
+        self.ndim = len(self.shape)
+        if m is None:
+            self.m = _NUMPY_M
+        else:
+            self.m = int(m)
+        self.sigma = _NUMPY_SIGMA if sigma is None else float(sigma)
+        # Oversampled grid
+        self.n = tuple([_next_fast_len(int(numpy.ceil(self.sigma*N))) for N in self.shape])
+        # Shape parameter of the window
+        self._b = [numpy.pi*(2. - float(N)/n) for N, n in zip(self.shape, self.n)]
+        self._x = None
+        self._g = None
+
+    def _phi(self, v, b):
+        # Kaiser-Bessel window as a function of the distance v to the grid point in units of the grid spacing (zero outside [-m, m])
+        s2 = self.m**2 - v**2
+        inside = s2 > 0
+        s = numpy.sqrt(numpy.where(inside, s2, 1.))
+        phi = numpy.where(inside, numpy.sinh(b*s)/s, 0.) / numpy.pi
+        return numpy.where(s2 == 0, b/numpy.pi, phi)
+
+    def _phi_hat(self, N, n, b):
+        # Fourier transform of the window at the frequencies of the map (times n)
+        k = numpy.arange(N) - N//2
+        return numpy.i0(self.m*numpy.sqrt(b**2 - (2*numpy.pi*k/n)**2))
+
+    def set_coordinates(self, coordinates):
+        x = numpy.asarray(coordinates, dtype=numpy.float64)
+        if self.ndim == 1 and x.ndim == 1:
+            x = x[:,numpy.newaxis]
+        if x.ndim != 2 or x.shape[1] != self.ndim:
+            log(logger, "Coordinates must be given as array of dimensions [NUMBER_OF_POINTS, NUMBER_OF_DIMENSIONS] of [NUMBER_OF_POINTS for 1D transforms.", lvl="ERROR", exception=ValueError)
+        if x.shape[0] != self.number_of_points:
+            log(logger, "Number of coordinates does not match the number of points of the plan.", lvl="ERROR", exception=ValueError)
+        self._x = x
+
+    def set_map(self, real_space):
+        a = numpy.asarray(real_space, dtype=numpy.complex128)
+        if a.shape != self.shape:
+            log(logger, "Shape of the map does not match the shape of the plan.", lvl="ERROR", exception=ValueError)
+        self.set_maps(a[numpy.newaxis])
+
+    def set_maps(self, maps):
+        a = numpy.asarray(maps, dtype=numpy.complex128)
+        if a.shape[1:] != self.shape:
+            log(logger, "Shape of the maps does not match the shape of the plan.", lvl="ERROR", exception=ValueError)
+        # Release the spectrum of the previous maps before the new one is calculated
+        self._g = None
+        # Deconvolution
+        g_hat = a.copy()
+        for d, (N, n, b) in enumerate(zip(self.shape, self.n, self._b)):
+            s = [1]*(self.ndim+1)
+            s[d+1] = N
+            g_hat /= self._phi_hat(N, n, b).reshape(s)
+        # Zero-padding to the oversampled grid (frequency k at index k mod n)
+        g = numpy.zeros((a.shape[0],) + self.n, dtype=numpy.complex128)
+        g[numpy.ix_(numpy.arange(a.shape[0]), *[(numpy.arange(N) - N//2) % n for N, n in zip(self.shape, self.n)])] = g_hat
+        del g_hat
+        self._g = numpy.fft.fftn(g, axes=tuple(range(1, self.ndim+1))).reshape(a.shape[0], -1)
+
+    def _get_window(self, i0, i1):
+        # Indices of the grid points and weights of the window for the points i0 to i1, one pair of shape (points, K) per dimension
+        K = 2*self.m + 2
+        window = []
+        for d, (n, b) in enumerate(zip(self.n, self._b)):
+            u = self._x[i0:i1,d] * n
+            l = numpy.floor(u).astype(numpy.intp)[:,numpy.newaxis] + (numpy.arange(K) - self.m)[numpy.newaxis,:]
+            window.append((l % n, self._phi(u[:,numpy.newaxis] - l, b)))
+        return window
+
+    def transform(self, out=None, nthreads=None):
+        if self._g is not None and self._g.shape[0] != 1:
+            log_and_raise_error(logger, "More than one map is set. Use transform_many instead.")
+            return
+        return self.transform_many(out=out, nthreads=nthreads)
+
+    def transform_many(self, out=None, nthreads=None):
+        _check_num_threads(nthreads)
+        if self._x is None or self._g is None:
+            log_and_raise_error(logger, "Map and coordinates have to be set before the transform.")
+            return
+        M = self._g.shape[0]
+        if out is None:
+            out = numpy.empty(self.number_of_points if M == 1 else (M, self.number_of_points), dtype=numpy.complex128)
+        elif out.dtype != numpy.complex128 or not out.flags.c_contiguous or not out.flags.writeable or out.size != M*self.number_of_points:
+            log(logger, "Output must be a writeable C-contiguous complex128 array with one element per point and map.", lvl="ERROR", exception=ValueError)
+        out_flat = out.reshape(M, self.number_of_points)
+        K = 2*self.m + 2
+        strides = [int(numpy.prod(self.n[d+1:])) for d in range(self.ndim)]
+        # Gathered grid values and their indices (16 and 8 bytes per map and window point) bound the size of a chunk
+        chunk = max(1, _NUMPY_CHUNK_BYTES // ((16 * M + 8) * K**self.ndim))
+        for i0 in range(0, self.number_of_points, chunk):
+            i1 = min(i0 + chunk, self.number_of_points)
+            # The window is calculated for the points of the chunk only so that the memory stays bounded
+            window = self._get_window(i0, i1)
+            # Linear indices of the grid points in the window around every point, shape (points, K, ..., K)
+            index = 0
+            for d in range(self.ndim):
+                s = [i1-i0] + [1]*self.ndim
+                s[d+1] = K
+                index = index + (window[d][0] * strides[d]).reshape(s)
+            # The indices are shared by all maps
+            G = numpy.take(self._g, index, axis=1)
+            # Contract the window dimensions one after the other (the window is separable)
+            for d in range(self.ndim-1, -1, -1):
+                G = numpy.matmul(G.reshape(M, i1-i0, -1, K), window[d][1][:,:,numpy.newaxis])
+            out_flat[:,i0:i1] = G.reshape(M, i1-i0)
+        return out
+
+    def transform_map(self, real_space, coordinates):
+        self.set_map(real_space)
+        self.set_coordinates(coordinates)
+        return self.transform()
@@ -20,18 +20,190 @@
 #include <nfft3util.h>
 #endif
 
+// Number of threads used if not specified per call (0: OpenMP default, e.g. from OMP_NUM_THREADS)
+static int default_num_threads = 0;
 
+static int parse_num_threads(PyObject *nthreads_obj, int *nthreads)
+{
+  if (nthreads_obj == NULL || nthreads_obj == Py_None) {
+    *nthreads = default_num_threads;
+    return 0;
+  }
+  long n = PyLong_AsLong(nthreads_obj);
+  if (n == -1 && PyErr_Occurred()) {
+    return -1;
+  }
+  if (n < 1) {
+    PyErr_SetString(PyExc_ValueError, "The number of threads must be at least 1.\n");
+    return -1;
+  }
+  *nthreads = (int) n;
+  return 0;
+}
+
+// Set the number of OpenMP threads of the calling thread and return the previous setting
+static int push_num_threads(int nthreads)
+{
+  #if defined(ENABLE_THREADS)
+  int previous = omp_get_max_threads();
+  if (nthreads > 0) {
+    omp_set_num_threads(nthreads);
+  }
+  return previous;
+  #else
+  return 1;
+  #endif
+}
+
+static void pop_num_threads(int previous)
+{
+  #if defined(ENABLE_THREADS)
+  omp_set_num_threads(previous);
+  #endif
+}
+
+PyDoc_STRVAR(set_num_threads__doc__, "set_num_threads(nthreads)\n\nSet the number of threads that are used by all following transforms that do not specify the number of threads themselves.\nIf nthreads is None the OpenMP default (OMP_NUM_THREADS) is used. Without thread support this setting has no effect.");
+static PyObject *set_num_threads(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *nthreads_obj;
+  static char *kwlist[] = {"nthreads", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &nthreads_obj)) {
+    return NULL;
+  }
+  int nthreads = 0;
+  if (nthreads_obj != Py_None && parse_num_threads(nthreads_obj, &nthreads) < 0) {
+    return NULL;
+  }
+  default_num_threads = nthreads;
+  Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(get_num_threads__doc__, "get_num_threads()\n\nReturn the number of threads that are used by transforms that do not specify the number of threads themselves.");
+static PyObject *get_num_threads(PyObject *self, PyObject *args)
+{
+  #if defined(ENABLE_THREADS)
+  return PyLong_FromLong(default_num_threads > 0 ? default_num_threads : omp_get_max_threads());
+  #else
+  return PyLong_FromLong(1);
+  #endif
+}
+
+// Planner flags of the FFTW plans of all following plans (set_planner_effort)
+static unsigned planner_flags = FFTW_ESTIMATE;
+
+// Initialise a plan like nfft_init but plan the FFT with the planner flags set by set_planner_effort.
+// The window cut-off m and the oversampling factor sigma of the FFT grid replace the defaults of nfft_init if they are positive.
+// All other parameters are taken from a probe plan with a single point such that the accuracy does not depend on the planner effort.
+static void init_plan(nfft_plan *plan, int ndim, int *dims, int number_of_points, int m, double sigma)
+{
+  if (planner_flags == FFTW_ESTIMATE && m <= 0 && sigma <= 0) {
+    nfft_init(plan, ndim, dims, number_of_points);
+    return;
+  }
+  nfft_plan probe;
+  int n[NPY_MAXDIMS];
+  int dim;
+  nfft_init(&probe, ndim, dims, 1);
+  for (dim = 0; dim < ndim; ++dim) {
+    // Even size of the oversampled grid
+    n[dim] = sigma > 0 ? 2*((int) ceil(sigma*dims[dim]/2.)) : probe.n[dim];
+  }
+  if (m <= 0) {
+    m = probe.m;
+  }
+  // As of NFFT 3.3, "nfft_flags" has been renamed to "flags" 
+  #if NFFT_VERSION_ABOVE_3_3==1
+  unsigned flags = probe.flags;
+  #else
+  unsigned flags = probe.nfft_flags;
+  #endif
+  nfft_finalize(&probe);
+  nfft_init_guru(plan, ndim, dims, number_of_points, n, m, flags, planner_flags | FFTW_DESTROY_INPUT);
+}
+
+static int check_window(int m, double sigma)
+{
+  if (m < 0 || (sigma != 0 && sigma <= 1.)) {
+    PyErr_SetString(PyExc_ValueError, "The window cut-off must be positive and the oversampling factor must be larger than 1.\n");
+    return -1;
+  }
+  return 0;
+}
+
+static const char *planner_effort_names[] = {"estimate", "measure", "patient", "exhaustive", NULL};
+static const unsigned planner_effort_flags[] = {FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT, FFTW_EXHAUSTIVE};
+
+PyDoc_STRVAR(set_planner_effort__doc__, "set_planner_effort(effort)\n\nSet the effort of the FFTW planner for all following plans ('estimate', 'measure', 'patient' or 'exhaustive').\nHigher efforts find faster FFTs but take longer to plan unless the plan is known from imported wisdom.");
+static PyObject *set_planner_effort(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  const char *effort;
+  static char *kwlist[] = {"effort", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s", kwlist, &effort)) {
+    return NULL;
+  }
+  int i;
+  for (i = 0; planner_effort_names[i] != NULL; ++i) {
+    if (strcmp(effort, planner_effort_names[i]) == 0) {
+      planner_flags = planner_effort_flags[i];
+      Py_RETURN_NONE;
+    }
+  }
+  PyErr_SetString(PyExc_ValueError, "Invalid planner effort. Choose one of the following: estimate, measure, patient, exhaustive.\n");
+  return NULL;
+}
+
+PyDoc_STRVAR(get_planner_effort__doc__, "get_planner_effort()\n\nReturn the effort of the FFTW planner.");
+static PyObject *get_planner_effort(PyObject *self, PyObject *args)
+{
+  int i;
+  for (i = 0; planner_effort_names[i] != NULL; ++i) {
+    if (planner_flags == planner_effort_flags[i]) {
+      break;
+    }
+  }
+  return Py_BuildValue("s", planner_effort_names[i]);
+}
+
+PyDoc_STRVAR(import_wisdom__doc__, "import_wisdom(filename)\n\nMerge the FFTW wisdom from a file into the current wisdom. Return True on success.");
+static PyObject *import_wisdom(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  const char *filename;
+  static char *kwlist[] = {"filename", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s", kwlist, &filename)) {
+    return NULL;
+  }
+  return PyBool_FromLong(fftw_import_wisdom_from_filename(filename));
+}
+
+PyDoc_STRVAR(export_wisdom__doc__, "export_wisdom(filename)\n\nWrite the current FFTW wisdom to a file. Return True on success.");
+static PyObject *export_wisdom(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  const char *filename;
+  static char *kwlist[] = {"filename", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s", kwlist, &filename)) {
+    return NULL;
+  }
+  return PyBool_FromLong(fftw_export_wisdom_to_filename(filename));
+}
 
-PyDoc_STRVAR(nfft__doc__, "nfft(real_space, coordinates)\n\nCalculate nfft from arbitrary dimensional array.\nreal_space should be an array (or any object that can trivially be converted to one.\ncoordinates should be a NxD array where N is the number of points where the Fourier transform should be evaluated and D is the dimensionality of the input array");
+PyDoc_STRVAR(nfft__doc__, "nfft(real_space, coordinates, nthreads=None, m=0, sigma=0)\n\nCalculate nfft from arbitrary dimensional array.\nreal_space should be an array (or any object that can trivially be converted to one.\ncoordinates should be a NxD array where N is the number of points where the Fourier transform should be evaluated and D is the dimensionality of the input array\nnthreads is the number of threads (if None the setting of set_num_threads is used).\nm (window cut-off) and sigma (oversampling factor) replace the defaults of the NFFT library if they are positive.\nThe GIL is released during the transform.");
 static PyObject *nfft(PyObject *self, PyObject *args, PyObject *kwargs)
 {
   PyObject *in_obj, *coord_obj;
+  PyObject *nthreads_obj = Py_None;
+  int nthreads;
 
-  static char *kwlist[] = {"real_space", "coordinates", NULL};
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO", kwlist, &in_obj, &coord_obj)) {
+  int m = 0;
+  double sigma = 0.;
+
+  static char *kwlist[] = {"real_space", "coordinates", "nthreads", "m", "sigma", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|Oid", kwlist, &in_obj, &coord_obj, &nthreads_obj, &m, &sigma)) {
     PyErr_SetString(PyExc_ValueError, "Cannot parse input to nfft.\n");
     return NULL;
   }
+  if (parse_num_threads(nthreads_obj, &nthreads) < 0 || check_window(m, sigma) < 0) {
+    return NULL;
+  }
   
   PyObject *coord_array = PyArray_FROM_OTF(coord_obj, NPY_DOUBLE, NPY_IN_ARRAY);
   PyObject *in_array = PyArray_FROM_OTF(in_obj, NPY_COMPLEX128, NPY_IN_ARRAY);
@@ -44,6 +216,8 @@ static PyObject *nfft(PyObject *self, PyObject *args, PyObject *kwargs)
 
   int ndim = PyArray_NDIM(in_array);
   if (ndim <= 0) {
+    Py_XDECREF(coord_array);
+    Py_XDECREF(in_array);
     PyErr_SetString(PyExc_ValueError, "Input array can't be 0 dimensional\n");
     return NULL;
   }
@@ -65,27 +239,28 @@ static PyObject *nfft(PyObject *self, PyObject *args, PyObject *kwargs)
     total_number_of_pixels *= dims[dim];
   }
 
-  #if defined(ENABLE_THREADS)
-  printf("nthreads = %d (OMP_NUM_THREADS=%s)\n", nfft_get_num_threads(), getenv("OMP_NUM_THREADS"));
-  fftw_init_threads();
-  #endif
+  int previous_num_threads = push_num_threads(nthreads);
 
-  nfft_init(&my_plan, ndim, dims, number_of_points);
+  // Planning (FFTW) is not thread-safe and stays protected by the GIL
+  init_plan(&my_plan, ndim, dims, number_of_points, m, sigma);
   memcpy(my_plan.f_hat, PyArray_DATA(in_array), total_number_of_pixels*sizeof(fftw_complex));
   memcpy(my_plan.x, PyArray_DATA(coord_array), ndim*number_of_points*sizeof(double));
 
   // As of NFFT 3.3, "nfft_flags" has been renamed to "flags" 
   #if NFFT_VERSION_ABOVE_3_3==1
-  if (my_plan.flags &PRE_PSI) {
-    nfft_precompute_one_psi(&my_plan);
-  }
+  int precompute_psi = my_plan.flags &PRE_PSI;
   #else
-  if (my_plan.nfft_flags &PRE_PSI) {
-    nfft_precompute_one_psi(&my_plan);
-  }
+  int precompute_psi = my_plan.nfft_flags &PRE_PSI;
   #endif
 
+  Py_BEGIN_ALLOW_THREADS
+  if (precompute_psi) {
+    nfft_precompute_one_psi(&my_plan);
+  }
   nfft_trafo(&my_plan);
+  Py_END_ALLOW_THREADS
+
+  pop_num_threads(previous_num_threads);
 
   npy_intp out_dim[] = {number_of_points};
   PyObject *out_array = (PyObject *)PyArray_SimpleNew(1, out_dim, NPY_COMPLEX128);
@@ -95,18 +270,326 @@ static PyObject *nfft(PyObject *self, PyObject *args, PyObject *kwargs)
   
   nfft_finalize(&my_plan);
 
-  #if defined(ENABLE_THREADS)
-  fftw_cleanup_threads();
-  #endif
-
   Py_XDECREF(coord_array);
   Py_XDECREF(in_array);
   
   return out_array;
 }
 
+// Persistent plan
+
+typedef struct {
+  PyObject_HEAD
+  nfft_plan plan;
+  int initialized;
+  int ndim;
+  int dims[NPY_MAXDIMS];
+  int total_number_of_pixels;
+  int number_of_points;
+  int coordinates_set;
+  int map_set;
+  int psi_precomputed;
+  int busy;
+} Plan;
+
+static void Plan_dealloc(Plan *self)
+{
+  if (self->initialized) {
+    nfft_finalize(&self->plan);
+  }
+  Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *Plan_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+  Plan *self = (Plan *)type->tp_alloc(type, 0);
+  if (self != NULL) {
+    self->initialized = 0;
+    self->ndim = 0;
+    self->total_number_of_pixels = 0;
+    self->number_of_points = 0;
+    self->coordinates_set = 0;
+    self->map_set = 0;
+    self->psi_precomputed = 0;
+    self->busy = 0;
+  }
+  return (PyObject *)self;
+}
+
+static int Plan_init(Plan *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *shape_obj;
+  int number_of_points;
+  PyObject *nthreads_obj = Py_None;
+  int nthreads;
+
+  int m = 0;
+  double sigma = 0.;
+
+  static char *kwlist[] = {"shape", "number_of_points", "nthreads", "m", "sigma", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oi|Oid", kwlist, &shape_obj, &number_of_points, &nthreads_obj, &m, &sigma)) {
+    return -1;
+  }
+  if (parse_num_threads(nthreads_obj, &nthreads) < 0 || check_window(m, sigma) < 0) {
+    return -1;
+  }
+  if (self->initialized) {
+    PyErr_SetString(PyExc_RuntimeError, "Plan is already initialized.\n");
+    return -1;
+  }
+
+  PyObject *shape_seq = PySequence_Fast(shape_obj, "Shape must be a sequence of integers.\n");
+  if (shape_seq == NULL) {
+    return -1;
+  }
+  int ndim = (int) PySequence_Fast_GET_SIZE(shape_seq);
+  if (ndim <= 0 || ndim > NPY_MAXDIMS) {
+    Py_DECREF(shape_seq);
+    PyErr_SetString(PyExc_ValueError, "Invalid number of dimensions of the map.\n");
+    return -1;
+  }
+  int dim;
+  int total_number_of_pixels = 1;
+  for (dim = 0; dim < ndim; ++dim) {
+    long n = PyLong_AsLong(PySequence_Fast_GET_ITEM(shape_seq, dim));
+    if (n <= 0) {
+      Py_DECREF(shape_seq);
+      if (!PyErr_Occurred()) {
+        PyErr_SetString(PyExc_ValueError, "All dimensions of the map must be positive.\n");
+      }
+      return -1;
+    }
+    self->dims[dim] = (int) n;
+    total_number_of_pixels *= (int) n;
+  }
+  Py_DECREF(shape_seq);
+  if (number_of_points <= 0) {
+    PyErr_SetString(PyExc_ValueError, "The number of points must be positive.\n");
+    return -1;
+  }
+
+  self->ndim = ndim;
+  self->total_number_of_pixels = total_number_of_pixels;
+  self->number_of_points = number_of_points;
+  // The number of threads of the FFT is fixed when it is planned
+  int previous_num_threads = push_num_threads(nthreads);
+  init_plan(&self->plan, ndim, self->dims, number_of_points, m, sigma);
+  pop_num_threads(previous_num_threads);
+  self->initialized = 1;
+  return 0;
+}
+
+PyDoc_STRVAR(Plan_set_coordinates__doc__, "set_coordinates(coordinates)\n\nSet the points where the Fourier transform is evaluated.\ncoordinates should be a NxD array where N is the number of points of the plan and D is the dimensionality of the map.\nThe window function is precomputed once at the next transform and reused until new coordinates are set.");
+static PyObject *Plan_set_coordinates(Plan *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *coord_obj;
+  static char *kwlist[] = {"coordinates", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &coord_obj)) {
+    return NULL;
+  }
+  if (self->busy) {
+    PyErr_SetString(PyExc_RuntimeError, "Plan is in use by another thread.\n");
+    return NULL;
+  }
+  PyObject *coord_array = PyArray_FROM_OTF(coord_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  if (coord_array == NULL) {
+    PyErr_SetString(PyExc_ValueError, "Invalid coordinates.\n");
+    return NULL;
+  }
+  int ndim = self->ndim;
+  if ((PyArray_NDIM((PyArrayObject *)coord_array) != 2 || PyArray_DIM((PyArrayObject *)coord_array, 1) != ndim) && (ndim != 1 || PyArray_NDIM((PyArrayObject *)coord_array) != 1)) {
+    Py_DECREF(coord_array);
+    PyErr_SetString(PyExc_ValueError, "Coordinates must be given as array of dimensions [NUMBER_OF_POINTS, NUMBER_OF_DIMENSIONS] of [NUMBER_OF_POINTS for 1D transforms.\n");
+    return NULL;
+  }
+  if (PyArray_DIM((PyArrayObject *)coord_array, 0) != self->number_of_points) {
+    Py_DECREF(coord_array);
+    PyErr_SetString(PyExc_ValueError, "Number of coordinates does not match the number of points of the plan.\n");
+    return NULL;
+  }
+  memcpy(self->plan.x, PyArray_DATA((PyArrayObject *)coord_array), ndim*self->number_of_points*sizeof(double));
+  Py_DECREF(coord_array);
+  self->coordinates_set = 1;
+  self->psi_precomputed = 0;
+  Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(Plan_set_map__doc__, "set_map(real_space)\n\nSet the map that is transformed. The shape of real_space must match the shape of the plan.");
+static PyObject *Plan_set_map(Plan *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *in_obj;
+  static char *kwlist[] = {"real_space", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &in_obj)) {
+    return NULL;
+  }
+  if (self->busy) {
+    PyErr_SetString(PyExc_RuntimeError, "Plan is in use by another thread.\n");
+    return NULL;
+  }
+  PyObject *in_array = PyArray_FROM_OTF(in_obj, NPY_COMPLEX128, NPY_ARRAY_IN_ARRAY);
+  if (in_array == NULL) {
+    PyErr_SetString(PyExc_ValueError, "Invalid map.\n");
+    return NULL;
+  }
+  int dim;
+  int valid = PyArray_NDIM((PyArrayObject *)in_array) == self->ndim;
+  for (dim = 0; valid && dim < self->ndim; ++dim) {
+    valid = PyArray_DIM((PyArrayObject *)in_array, dim) == self->dims[dim];
+  }
+  if (!valid) {
+    Py_DECREF(in_array);
+    PyErr_SetString(PyExc_ValueError, "Shape of the map does not match the shape of the plan.\n");
+    return NULL;
+  }
+  memcpy(self->plan.f_hat, PyArray_DATA((PyArrayObject *)in_array), self->total_number_of_pixels*sizeof(fftw_complex));
+  Py_DECREF(in_array);
+  self->map_set = 1;
+  Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(Plan_transform__doc__, "transform(out=None, nthreads=None)\n\nCalculate the Fourier transform of the map at the coordinates of the plan.\nIf out is given the result is written into this C-contiguous complex128 array of length N and out is returned.\nnthreads is the number of threads (if None the setting of set_num_threads is used).\nThe GIL is released during the transform.");
+static PyObject *Plan_transform(Plan *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *out_obj = Py_None;
+  PyObject *nthreads_obj = Py_None;
+  int nthreads;
+  static char *kwlist[] = {"out", "nthreads", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|OO", kwlist, &out_obj, &nthreads_obj)) {
+    return NULL;
+  }
+  if (parse_num_threads(nthreads_obj, &nthreads) < 0) {
+    return NULL;
+  }
+  if (self->busy) {
+    PyErr_SetString(PyExc_RuntimeError, "Plan is in use by another thread.\n");
+    return NULL;
+  }
+  if (!self->coordinates_set || !self->map_set) {
+    PyErr_SetString(PyExc_RuntimeError, "Map and coordinates have to be set before the transform.\n");
+    return NULL;
+  }
+  PyObject *out_array;
+  if (out_obj == Py_None) {
+    npy_intp out_dim[] = {self->number_of_points};
+    out_array = (PyObject *)PyArray_SimpleNew(1, out_dim, NPY_COMPLEX128);
+    if (out_array == NULL) {
+      return NULL;
+    }
+  } else {
+    if (!PyArray_Check(out_obj) ||
+        PyArray_TYPE((PyArrayObject *)out_obj) != NPY_COMPLEX128 ||
+        !PyArray_IS_C_CONTIGUOUS((PyArrayObject *)out_obj) ||
+        !PyArray_ISWRITEABLE((PyArrayObject *)out_obj) ||
+        PyArray_SIZE((PyArrayObject *)out_obj) != self->number_of_points) {
+      PyErr_SetString(PyExc_ValueError, "Output must be a writeable C-contiguous complex128 array with one element per point.\n");
+      return NULL;
+    }
+    Py_INCREF(out_obj);
+    out_array = out_obj;
+  }
+
+  // As of NFFT 3.3, "nfft_flags" has been renamed to "flags" 
+  #if NFFT_VERSION_ABOVE_3_3==1
+  int precompute_psi = (self->plan.flags &PRE_PSI) && !self->psi_precomputed;
+  #else
+  int precompute_psi = (self->plan.nfft_flags &PRE_PSI) && !self->psi_precomputed;
+  #endif
+
+  // The plan must not be modified by other Python threads while the GIL is released
+  self->busy = 1;
+  int previous_num_threads = push_num_threads(nthreads);
+  Py_BEGIN_ALLOW_THREADS
+  if (precompute_psi) {
+    nfft_precompute_one_psi(&self->plan);
+  }
+  nfft_trafo(&self->plan);
+  Py_END_ALLOW_THREADS
+  pop_num_threads(previous_num_threads);
+  self->busy = 0;
+  self->psi_precomputed = 1;
+
+  memcpy(PyArray_DATA((PyArrayObject *)out_array), self->plan.f, self->number_of_points*sizeof(fftw_complex));
+  return out_array;
+}
+
+static PyObject *Plan_get_shape(Plan *self, void *closure)
+{
+  PyObject *shape = PyTuple_New(self->ndim);
+  int dim;
+  for (dim = 0; dim < self->ndim; ++dim) {
+    PyTuple_SET_ITEM(shape, dim, PyLong_FromLong(self->dims[dim]));
+  }
+  return shape;
+}
+
+static PyObject *Plan_get_number_of_points(Plan *self, void *closure)
+{
+  return PyLong_FromLong(self->number_of_points);
+}
+
+static PyMethodDef Plan_methods[] = {
+  {"set_coordinates", (PyCFunction)Plan_set_coordinates, METH_VARARGS|METH_KEYWORDS, Plan_set_coordinates__doc__},
+  {"set_map", (PyCFunction)Plan_set_map, METH_VARARGS|METH_KEYWORDS, Plan_set_map__doc__},
+  {"transform", (PyCFunction)Plan_transform, METH_VARARGS|METH_KEYWORDS, Plan_transform__doc__},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef Plan_getset[] = {
+  {"shape", (getter)Plan_get_shape, NULL, "Shape of the map", NULL},
+  {"number_of_points", (getter)Plan_get_number_of_points, NULL, "Number of points where the Fourier transform is evaluated", NULL},
+  {NULL, NULL, NULL, NULL, NULL}
+};
+
+PyDoc_STRVAR(Plan__doc__, "Plan(shape, number_of_points, nthreads=None, m=0, sigma=0)\n\nPersistent NFFT plan for maps of a given shape and a given number of points.\nMap and coordinates are set independently (set_map, set_coordinates) and are kept across transforms.\nThe window function is only precomputed again if new coordinates are set.\nnthreads is the number of threads of the FFT (if None the setting of set_num_threads is used).\nm (window cut-off) and sigma (oversampling factor) replace the defaults of the NFFT library if they are positive.\nA plan can be used by one thread at a time.");
+static PyTypeObject PlanType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "_nfft.Plan",               /* tp_name */
+  sizeof(Plan),               /* tp_basicsize */
+  0,                          /* tp_itemsize */
+  (destructor)Plan_dealloc,   /* tp_dealloc */
+  0,                          /* tp_print */
+  0,                          /* tp_getattr */
+  0,                          /* tp_setattr */
+  0,                          /* tp_reserved */
+  0,                          /* tp_repr */
+  0,                          /* tp_as_number */
+  0,                          /* tp_as_sequence */
+  0,                          /* tp_as_mapping */
+  0,                          /* tp_hash  */
+  0,                          /* tp_call */
+  0,                          /* tp_str */
+  0,                          /* tp_getattro */
+  0,                          /* tp_setattro */
+  0,                          /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,         /* tp_flags */
+  Plan__doc__,                /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  Plan_methods,               /* tp_methods */
+  0,                          /* tp_members */
+  Plan_getset,                /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  (initproc)Plan_init,        /* tp_init */
+  0,                          /* tp_alloc */
+  Plan_new,                   /* tp_new */
+};
+
 static PyMethodDef NfftMethods[] = {
   {"nfft", (PyCFunction)nfft, METH_VARARGS|METH_KEYWORDS, nfft__doc__},
+  {"set_num_threads", (PyCFunction)set_num_threads, METH_VARARGS|METH_KEYWORDS, set_num_threads__doc__},
+  {"get_num_threads", (PyCFunction)get_num_threads, METH_NOARGS, get_num_threads__doc__},
+  {"set_planner_effort", (PyCFunction)set_planner_effort, METH_VARARGS|METH_KEYWORDS, set_planner_effort__doc__},
+  {"get_planner_effort", (PyCFunction)get_planner_effort, METH_NOARGS, get_planner_effort__doc__},
+  {"import_wisdom", (PyCFunction)import_wisdom, METH_VARARGS|METH_KEYWORDS, import_wisdom__doc__},
+  {"export_wisdom", (PyCFunction)export_wisdom, METH_VARARGS|METH_KEYWORDS, export_wisdom__doc__},
   {NULL, NULL, 0, NULL}
 };
 
@@ -128,12 +611,20 @@ static PyMethodDef NfftMethods[] = {
   ob = Py_InitModule3(name, methods, doc);
 #endif
 
-MOD_INIT(nfft)
+MOD_INIT(_nfft)
 {
   import_array();
   PyObject *m;
-  MOD_DEF(m, "nfft", "Nonequispaced FFT tools.", NfftMethods)
+  if (PyType_Ready(&PlanType) < 0)
+    return MOD_ERROR_VAL;
+  MOD_DEF(m, "_nfft", "Nonequispaced FFT tools.", NfftMethods)
   if (m == NULL)
     return MOD_ERROR_VAL;
+  Py_INCREF(&PlanType);
+  PyModule_AddObject(m, "Plan", (PyObject *)&PlanType);
+  #if defined(ENABLE_THREADS)
+  // Initialised once for the lifetime of the module (plans persist across calls)
+  fftw_init_threads();
+  #endif
   return MOD_SUCCESS_VAL(m);  
 }
@@ -117,3 +117,29 @@ def downsample(array2d0,factor0,mode="pick",mask2d0=None,bad_bits=None,min_N_pix
                 BM[BN >= min_N_pixels] = BM[BN >= min_N_pixels] & ~bad_bits
             B[BN >= min_N_pixels] = B[BN >= min_N_pixels] * factor*factor /numpy.float64(BN[BN >= min_N_pixels])
             return [B.reshape((Ny_new,Nx_new)),BM.reshape((Ny_new,Nx_new))]
+
+def fourier_crop(map3d, sizes):
+    """
+    Return maps that are downsampled by cropping the spectrum of a map (alias-free downsampling)
+
+    The spectrum is cropped to the lowest frequencies in the last three dimensions of the map. A map with *N* samples along every dimension and grid spacing *dx* is downsampled to *n* samples with grid spacing *dx N / n*. The sample with index *N//2* and the downsampled sample with index *n//2* lie at the same position and the sum of the map times the voxel volume is preserved.
+
+    Args:
+      :map3d (array): Map with three equal (last) spatial dimensions. Leading dimensions (e.g. materials) are downsampled independently
+
+      :sizes (list): Numbers of samples *n* of the downsampled maps along every dimension (each not larger than *N*)
+
+    Returns a list of downsampled maps (real if the map is real).
+    """
+    map3d = numpy.asarray(map3d)
+    N = map3d.shape[-1]
+    axes = (-3, -2, -1)
+    maps = [numpy.empty(map3d.shape[:-3] + (n, n, n), dtype=map3d.dtype) for n in sizes]
+    # One transform per leading index to limit the size of temporary arrays
+    for i in numpy.ndindex(map3d.shape[:-3]):
+        F = numpy.fft.fftshift(numpy.fft.fftn(numpy.fft.ifftshift(map3d[i], axes=axes), axes=axes), axes=axes)
+        for n, m in zip(sizes, maps):
+            c = slice(N//2 - n//2, N//2 - n//2 + n)
+            m_i = numpy.fft.fftshift(numpy.fft.ifftn(numpy.fft.ifftshift(F[c, c, c], axes=axes), axes=axes), axes=axes) * (float(n)/N)**3
+            m[i] = m_i if numpy.iscomplexobj(m) else m_i.real
+    return maps
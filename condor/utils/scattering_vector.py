@@ -99,16 +99,15 @@ def generate_qmap(X,Y,pixel_size,detector_distance,wavelength,extrinsic_rotation
     else:
         log_and_raise_error(logger, "Indexing with order=%s is invalid." % order)
     if extrinsic_rotation is not None:
-        log_debug(logger, "Applying qmap rotation.")
-        intrinsic_rotation = copy.deepcopy(extrinsic_rotation)
-        intrinsic_rotation.invert()
-        qmap = intrinsic_rotation.rotate_vectors(qmap.ravel(), order=order).reshape(qmap.shape)
+        qmap = rotate_qmap(qmap, extrinsic_rotation, order=order)
     return qmap
 
-def generate_qmap_3d(qn, qmax, extrinsic_rotation=None, order='xyz'):
+def generate_qmap_3d(qn, qmax, extrinsic_rotation=None, order='xyz', slab=None):
     q = numpy.linspace(-qmax, qmax, qn)
-    Qz, Qy, Qx = numpy.meshgrid(q, q, q, indexing='ij')
-    qmap = numpy.zeros(shape=(qn, qn, qn, 3), dtype='float')
+    # Optionally only a slab of z-indices (start, stop)
+    qz = q if slab is None else q[slab[0]:slab[1]]
+    Qz, Qy, Qx = numpy.meshgrid(qz, q, q, indexing='ij')
+    qmap = numpy.zeros(shape=(len(qz), qn, qn, 3), dtype='float')
     if order == 'xyz':
         qmap[:, :, :, 0] = Qx[:, :, :]
         qmap[:, :, :, 1] = Qy[:, :, :]
@@ -121,12 +120,30 @@ def generate_qmap_3d(qn, qmax, extrinsic_rotation=None, order='xyz'):
         log_and_raise_error(logger, "order=\'%s\' is not a recognised argument for this function." % str(order))
         return
     if extrinsic_rotation is not None:
-        log_debug(logger, "Applying qmap rotation.")
-        intrinsic_rotation = copy.deepcopy(extrinsic_rotation)
-        intrinsic_rotation.invert()
-        qmap = intrinsic_rotation.rotate_vectors(qmap.ravel(), order=order).reshape(qmap.shape)
+        qmap = rotate_qmap(qmap, extrinsic_rotation, order=order)
     return qmap
 
+def rotate_qmap(qmap, extrinsic_rotation, order="xyz"):
+    r"""
+    Return the scattering vector map for a rotated sample. The scattering vectors are rotated by the inverse of the extrinsic rotation of the sample, this is carried out by a single matrix product
+
+    Args:
+      :qmap (array): Scattering vector map with the vector coordinates along the last axis
+
+      :extrinsic_rotation (:class:`condor.utils.rotation.Rotation`): Extrinsic rotation of the sample
+
+    Kwargs:
+      :order (str): Order of scattering vector coordinates in the array. Choose either ``'xyz'`` or ``'zyx'`` (default ``'xyz'``)
+    """
+    log_debug(logger, "Applying qmap rotation.")
+    # For row vectors v the product v R equals (R^-1 v)^T
+    R = extrinsic_rotation.get_as_rotation_matrix()
+    if order == "zyx":
+        R = R[::-1,::-1]
+    elif order != "xyz":
+        log_and_raise_error(logger, "Indexing with order=%s is invalid." % order)
+    return qmap.dot(R)
+
 def generate_rpix_3d(qn, qmax, wavelength, detector_distance, pixel_size):
     R_Ewald = 2*numpy.pi/wavelength
     qmap = generate_qmap_3d(qn, qmax)
@@ -32,6 +32,12 @@
 
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
 import numpy
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .log import log_and_raise_error
 
 from .scattering_vector import generate_qmap
 
@@ -83,6 +89,158 @@ Args:
   :r (float): :math:`r`: See :func:`condor.utils.sphere_diffraction.F_sphere_diffraction`
 """
 
+def _f_sphere(s):
+    # Normalised form factor f(s) = 3 (sin(s) - s cos(s)) / s^3 and its derivative (series expansion for small s)
+    s = numpy.asarray(s, dtype=numpy.float64)
+    f = numpy.empty_like(s)
+    df = numpy.empty_like(s)
+    small = s < 0.1
+    ss = s[small]
+    f[small] = 1 - ss**2/10. + ss**4/280. - ss**6/15120.
+    df[small] = -ss/5. + ss**3/70. - ss**5/2520.
+    sl = s[~small]
+    sin = numpy.sin(sl)
+    cos = numpy.cos(sl)
+    f[~small] = 3*(sin-sl*cos)/sl**3
+    df[~small] = 3*((sl**2-3)*sin+3*sl*cos)/sl**4
+    return f, df
+
+class SphereFormFactorTable:
+    r"""
+    Tabulated normalised form factor :math:`f(s)` of a homogeneous sphere as a function of :math:`s = qr` (see :func:`condor.utils.sphere_diffraction.F_sphere_diffraction`)
+
+    Because :math:`f` depends only on the product of the length of the scattering vector and the sphere radius one table serves all sphere sizes and detector geometries. The table is extended automatically if larger values of :math:`s` are requested. It only grows and can be shared between threads.
+
+    Kwargs:
+      :interpolation (str): Interpolation between table entries, either ``'linear'`` or ``'cubic'`` (cubic Hermite interpolation with analytical derivatives) (default ``'cubic'``)
+
+      :ds (float): Spacing of the table entries in :math:`s` (default ``0.05``)
+    """
+    def __init__(self, interpolation="cubic", ds=0.05):
+        if interpolation not in ["linear", "cubic"]:
+            log_and_raise_error(logger, "interpolation=\"%s\" is invalid. Choose either \"linear\" or \"cubic\"." % interpolation)
+            return
+        self.interpolation = interpolation
+        self.ds = float(ds)
+        self._coefficients = None
+        self._lock = threading.Lock()
+        self._extend(100.)
+
+    def _get_s_max(self, C):
+        return (C[0].shape[0]-1) * self.ds
+
+    def _extend(self, s_max):
+        with self._lock:
+            # A concurrent call for a smaller s_max must not replace a larger table that another thread has already checked against
+            if self._coefficients is not None:
+                s_max = max(s_max, self._get_s_max(self._coefficients))
+            self._coefficients = self._calculate_coefficients(s_max)
+
+    def _calculate_coefficients(self, s_max):
+        # Polynomial coefficients (lowest order first) for every interval [s_i, s_i+1] in the local variable t = (s - s_i) / ds
+        n = int(numpy.ceil(s_max / self.ds)) + 1
+        s = numpy.arange(n+1) * self.ds
+        f, df = _f_sphere(s)
+        if self.interpolation == "linear":
+            C = [f[:-1], f[1:]-f[:-1]]
+        else:
+            f0, f1 = f[:-1], f[1:]
+            d0, d1 = df[:-1]*self.ds, df[1:]*self.ds
+            C = [f0, d0, 3*(f1-f0)-2*d0-d1, 2*(f0-f1)+d0+d1]
+        # One contiguous array per order makes the gathers cheap
+        return [numpy.ascontiguousarray(c) for c in C]
+
+    def get_s_max(self):
+        """
+        Return the maximum value of :math:`s` covered by the current table
+        """
+        return self._get_s_max(self._coefficients)
+
+    def f(self, s):
+        r"""
+        Return the interpolated normalised form factor :math:`f(s)`
+
+        Args:
+          :s (float/array): :math:`s = qr` (non-negative)
+        """
+        s = numpy.asarray(s, dtype=numpy.float64)
+        s_max = s.max() if s.size > 0 else 0.
+        # The coefficients are read once, the size check and the gathers use the same table
+        C = self._coefficients
+        if s_max >= self._get_s_max(C):
+            self._extend(2*s_max)
+            C = self._coefficients
+        x = s * (1./self.ds)
+        i = x.astype(numpy.intp)
+        # Local variable t = x - i, polynomial evaluated in place (Horner scheme)
+        x -= i
+        f = numpy.take(C[-1], i)
+        for c in C[-2::-1]:
+            f *= x
+            f += numpy.take(c, i)
+        return f
+
+_SPHERE_FORM_FACTOR_TABLE_ACCURACIES = {
+    # Maximum absolute error of f (f(0) = 1) in parentheses
+    "draft"     : {"interpolation": "linear", "ds": 1E-2}, # (3E-6)
+    "standard"  : {"interpolation": "cubic",  "ds": 5E-2}, # (2E-9)
+    "reference" : {"interpolation": "cubic",  "ds": 1E-2}, # (3E-12)
+}
+_sphere_form_factor_tables = {}
+
+def get_sphere_form_factor_table(accuracy="standard"):
+    """
+    Return the shared :class:`condor.utils.sphere_diffraction.SphereFormFactorTable` instance for the given accuracy
+
+    Kwargs:
+      :accuracy (str): Accuracy of the table
+
+        ============== ============= ========== =====================
+        ``accuracy``   Interpolation Spacing    Maximum error of *f*
+        ============== ============= ========== =====================
+        ``'draft'``    linear        0.01       3E-6
+        ``'standard'`` cubic         0.05       2E-9
+        ``'reference'``cubic         0.01       3E-12
+        ============== ============= ========== =====================
+
+        (default ``'standard'``)
+    """
+    if accuracy not in _SPHERE_FORM_FACTOR_TABLE_ACCURACIES:
+        log_and_raise_error(logger, "accuracy=\"%s\" is invalid. Choose one of the following: %s." % (accuracy, ", ".join(["\"%s\"" % a for a in _SPHERE_FORM_FACTOR_TABLE_ACCURACIES.keys()])))
+        return
+    if accuracy not in _sphere_form_factor_tables:
+        # Threads that create a table concurrently all return the one that was stored first
+        _sphere_form_factor_tables.setdefault(accuracy, SphereFormFactorTable(**_SPHERE_FORM_FACTOR_TABLE_ACCURACIES[accuracy]))
+    return _sphere_form_factor_tables[accuracy]
+
+def F_sphere_diffraction_lookup(K, q, r, accuracy="standard", mirror=False):
+    r"""
+    Scattering amplitude from homogeneous sphere interpolated from a table of the form factor (see :func:`condor.utils.sphere_diffraction.F_sphere_diffraction` and :class:`condor.utils.sphere_diffraction.SphereFormFactorTable`)
+
+    Args:
+      :K (float/array): Intensity scaling factor (an array has to be broadcastable against ``q``)
+
+      :q (float/array): Length of scattering vector in unit inverse meter
+
+      :r (float/array): Sphere radius in unit meter (an array has to be broadcastable against ``q``)
+
+    Kwargs:
+      :accuracy (str): Accuracy of the table (see :func:`condor.utils.sphere_diffraction.get_sphere_form_factor_table`) (default ``'standard'``)
+
+      :mirror (bool): If ``True`` the map ``q`` is assumed to be symmetric under mirroring of both of its last two axes (i.e. the beam center lies in the middle of the detector). Then only one quadrant is interpolated and mirrored (default ``False``)
+    """
+    table = get_sphere_form_factor_table(accuracy)
+    q = numpy.asarray(q)
+    if mirror and q.ndim >= 2:
+        ny, nx = q.shape[-2:]
+        hy, hx = (ny+1)//2, (nx+1)//2
+        F = numpy.sqrt(abs(K)) * table.f(q[...,:hy,:hx] * r)
+        F = numpy.concatenate([F, F[...,:ny-hy,:][...,::-1,:]], axis=-2)
+        F = numpy.concatenate([F, F[...,:,:nx-hx][...,:,::-1]], axis=-1)
+        return F
+    else:
+        return numpy.sqrt(abs(K)) * table.f(q * r)
+
 #Fringe_sphere_diffraction = None
 
 #def get_sphere_diffraction_formula(p,D,wavelength,X=None,Y=None):
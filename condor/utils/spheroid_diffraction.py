@@ -41,52 +41,81 @@ _g_spheroid_diffraction = lambda q_x, q_y, theta, phi: numpy.arccos((numpy.cos(t
 _H_spheroid_diffraction = lambda q_x, q_y, a, c,theta, phi: numpy.sqrt(a**2*numpy.sin(_g_spheroid_diffraction(q_x,q_y,theta,phi))**2+c**2*numpy.cos(_g_spheroid_diffraction(q_x,q_y,theta,phi))**2)
 _qH_spheroid_diffraction = lambda q_x, q_y ,a, c,theta, phi: _q_spheroid_diffraction(q_x,q_y)*_H_spheroid_diffraction(q_x,q_y,a,c,theta,phi)
 _F_spheroid_diffraction = lambda K, q_x, q_y, a, c, theta, phi: numpy.sqrt(abs(K))*3.*(numpy.sin(_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi))-_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi)*numpy.cos(_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi)))/(_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi)**3+numpy.finfo("float64").eps)
-F_spheroid_diffraction = lambda K, q_x, q_y, a, c, theta, phi: (_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi)**6 < numpy.finfo("float64").resolution)*numpy.sqrt(abs(K)) + (_qH_spheroid_diffraction(q_x,q_y,a,c,theta,phi)**6 >= numpy.finfo("float64").resolution)*_F_spheroid_diffraction(K,q_x,q_y,a,c,theta,phi)
-r"""
-Scattering amplitude from homogeneous spheroid (ref. [Feigin1987]_, [Hamzeh1974]_)
 
-The rotation axis is alligned parallel to the the :math:`y`-axis before the rotations by :math:`theta` and :math:`phi` are applied (see below).
+def _qH_spheroid_diffraction_fused(q_x, q_y, a, c, theta, phi):
+    eps = numpy.finfo("float64").eps
+    q_x = numpy.asarray(q_x, dtype=numpy.float64)
+    q_y = numpy.asarray(q_y, dtype=numpy.float64)
+    # Length and direction of the scattering vectors (once per pixel)
+    q = numpy.sqrt(q_x**2+q_y**2)
+    e_x = q_x/(q+eps)
+    e_y = q_y/(q+eps)
+    # Squared cosine of the angle g between scattering vector and spheroid axis (once per pixel and particle)
+    cos_theta = numpy.cos(theta)*(1-eps)
+    u = (cos_theta*numpy.cos(phi))*e_y
+    u -= (cos_theta*numpy.sin(phi))*e_x
+    u *= u
+    # H^2 = a^2 sin^2(g) + c^2 cos^2(g) = a^2 + (c^2 - a^2) cos^2(g)
+    a2 = numpy.asarray(a)**2
+    qH = numpy.sqrt(u*(numpy.asarray(c)**2-a2)+a2)
+    qH *= q
+    return qH
 
-.. math::
+def F_spheroid_diffraction(K, q_x, q_y, a, c, theta, phi):
+    r"""
+    Scattering amplitude from homogeneous spheroid (ref. [Feigin1987]_, [Hamzeh1974]_)
 
-  F(\vec{q}) = \sqrt{K} \cdot f(\vec{q})
+    The rotation axis is alligned parallel to the the :math:`y`-axis before the rotations by :math:`theta` and :math:`phi` are applied (see below).
 
-  f(\vec{q}) = \frac{ 3 \left[\sin(qH(\vec{q})) - qH \cos(qH(\vec{q})) \right]}{ (qH(\vec{q}))^3}
+    .. math::
 
-  H(\vec{q}) = \sqrt{a^2 \sin^2(g(\vec{q}))+c^2 \cos^2(g(\vec{q}))}
+      F(\vec{q}) = \sqrt{K} \cdot f(\vec{q})
 
-  g(\vec{q}) = \arccos\left( \frac{ -q_x \cos(\theta) sin(\phi) + q_y \cos(\theta) cos(\phi) }{ q } \right)
+      f(\vec{q}) = \frac{ 3 \left[\sin(qH(\vec{q})) - qH \cos(qH(\vec{q})) \right]}{ (qH(\vec{q}))^3}
 
-:math:`I_0`: Primary intensity on the sample in unit number of photons per square meter
+      H(\vec{q}) = \sqrt{a^2 \sin^2(g(\vec{q}))+c^2 \cos^2(g(\vec{q}))}
 
-:math:`\rho_e`: Electron density in unit number of electrons per cubic meter
+      g(\vec{q}) = \arccos\left( \frac{ -q_x \cos(\theta) sin(\phi) + q_y \cos(\theta) cos(\phi) }{ q } \right)
 
-:math:`p`: Pixel size (i.e. edge length) in unit meter
+    :math:`I_0`: Primary intensity on the sample in unit number of photons per square meter
 
-:math:`D`: Detector distance in unit meter
+    :math:`\rho_e`: Electron density in unit number of electrons per cubic meter
 
-:math:`r_0`: Classical electron radius in unit meter
+    :math:`p`: Pixel size (i.e. edge length) in unit meter
 
-:math:`V_{a,c}`: Spheroid volume in unit cubic meter
+    :math:`D`: Detector distance in unit meter
 
-Args:
-  :K (float): Intensity scaling factor :math:`K = I_0 \left(\rho_e \frac{p}{D} r_0 V_{a,c}\right)^2`
+    :math:`r_0`: Classical electron radius in unit meter
 
-  :q_x (float/array): :math:`q_x`: :math:`x`-coordinate of scattering vector in unit inverse meter
+    :math:`V_{a,c}`: Spheroid volume in unit cubic meter
 
-  :q_y (float/array): :math:`q_y`: :math:`y`-coordinate of scattering vector in unit inverse meter
+    The term :math:`qH` is evaluated only once per pixel and particle. The particle parameters ``K``, ``a``, ``c``, ``theta`` and ``phi`` can be arrays that broadcast against the scattering vector maps. For instance, arrays of shape (N, 1, 1) evaluate the patterns of N spheroids with different sizes, flattenings and orientations on 2D maps ``q_x`` and ``q_y`` in one pass and return an array of shape (N, ny, nx).
 
-  :a (float): :math:`a`: radius perpendicular to the rotation axis of the ellipsoid in unit meter
+    Args:
+      :K (float/array): Intensity scaling factor :math:`K = I_0 \left(\rho_e \frac{p}{D} r_0 V_{a,c}\right)^2`
 
-  :c (float): :math:`c`: radius along the rotation axis of the ellipsoid in unit meter
+      :q_x (float/array): :math:`q_x`: :math:`x`-coordinate of scattering vector in unit inverse meter
 
-  :theta (float): :math:`\theta`: extrinisc rotation around :math:`x`-axis (1st, counter clockwise / right hand rule)
+      :q_y (float/array): :math:`q_y`: :math:`y`-coordinate of scattering vector in unit inverse meter
 
-  :phi (float): :math:`\phi`: extrinsic rotation around :math:`z`-axis (2nd, counter clockwise / right hand rule)
-"""
+      :a (float/array): :math:`a`: radius perpendicular to the rotation axis of the ellipsoid in unit meter
+
+      :c (float/array): :math:`c`: radius along the rotation axis of the ellipsoid in unit meter
+
+      :theta (float/array): :math:`\theta`: extrinisc rotation around :math:`x`-axis (1st, counter clockwise / right hand rule)
+
+      :phi (float/array): :math:`\phi`: extrinsic rotation around :math:`z`-axis (2nd, counter clockwise / right hand rule)
+    """
+    # qH is evaluated only once and shared by both branches
+    qH = _qH_spheroid_diffraction_fused(q_x, q_y, a, c, theta, phi)
+    qH3 = qH**3
+    F = numpy.sin(qH) - qH*numpy.cos(qH)
+    F *= 3.
+    F /= qH3+numpy.finfo("float64").eps
+    F = numpy.where(qH3**2 < numpy.finfo("float64").resolution, 1., F)
+    return numpy.sqrt(abs(K))*F
 
-_I_spheroid_diffraction = lambda K, qX, qY, a, c, theta, phi: abs(K)*(3.*(numpy.sin(_qH_spheroid_diffraction(qX,qY,a,c,theta,phi))-_qH_spheroid_diffraction(qX,qY,a,c,theta,phi)*numpy.cos(_qH_spheroid_diffraction(qX,qY,a,c,theta,phi)))/(_qH_spheroid_diffraction(qX,qY,a,c,theta,phi)**3+numpy.finfo("float64").eps))**2
-I_spheroid_diffraction = lambda K, qX, qY, a, c, theta, phi: (_qH_spheroid_diffraction(qX,qY,a,c,theta,phi)**6 < numpy.finfo("float64").resolution)*abs(K) + (_qH_spheroid_diffraction(qX,qY,a,c,theta,phi)**6 >= numpy.finfo("float64").resolution)*_I_spheroid_diffraction(K,qX,qY,a,c,theta,phi)
+I_spheroid_diffraction = lambda K, qX, qY, a, c, theta, phi: abs(F_spheroid_diffraction(K, qX, qY, a, c, theta, phi))**2
 r"""
 Scattering Intensity from homogeneous spheroid
 
@@ -0,0 +1,206 @@
+# -----------------------------------------------------------------------------------------------------
+# CONDOR
+# Simulator for diffractive single-particle imaging experiments with X-ray lasers
+# http://xfel.icm.uu.se/condor/
+# -----------------------------------------------------------------------------------------------------
+# Copyright 2016 Max Hantke, Filipe R.N.C. Maia, Tomas Ekeberg
+# Condor is distributed under the terms of the BSD 2-Clause License
+# -----------------------------------------------------------------------------------------------------
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------------------------------
+# General note:
+# All variables are in SI units by default. Exceptions explicit by variable name.
+# -----------------------------------------------------------------------------------------------------
+"""
+Symmetries of 3D Fourier volumes on the regular grid of scattering vectors
+
+The volume :math:`F(q) = \\sum_x \\rho(x) \\exp(-i q \\cdot x)` of a map :math:`\\rho` that is centered on its grid (center at index :math:`(N-1)/2`) inherits every reflection :math:`r` of the map through its center, :math:`\\rho(r x) = \\rho(x) \\Rightarrow F(r q) = F(q)`. If the map is real up to a global phase :math:`c` (one material without or with absorption) the volume is in addition Hermitian, :math:`F(-q) = c/c^* \\, F^*(q)` (Friedel symmetry).
+
+The regular grid :math:`q_k = (k - (n-1)/2) \\, \\delta q` is mapped onto itself by reflections :math:`k \\rightarrow n-1-k` along any of its axes. The volume is therefore only calculated on the half, quarter or octant of the grid that is not related to the rest by one of these reflections (see :func:`condor.utils.symmetry.get_reduced_axes`) and is expanded to the whole grid with array reflections (see :func:`condor.utils.symmetry.expand_volume`).
+
+Rotational symmetries that do not map the grid onto itself (such as the five-fold axes of an icosahedron) are not used.
+"""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import itertools
+import numpy
+
+import logging
+logger = logging.getLogger(__name__)
+
+from condor.utils.log import log_and_raise_error
+import condor.utils.nfft
+
+def get_friedel_phase(map3d, tolerance=1E-10):
+    """
+    Return the phase factor :math:`c/c^*` of the Friedel symmetry :math:`F(-q) = c/c^* \\, F^*(q)` of the Fourier transform of a map, or ``None`` if the map is not real up to a global phase :math:`c`
+
+    Args:
+      :map3d (array): 3D map
+
+    Kwargs:
+      :tolerance (float): Largest deviation from a real map relative to the largest absolute value of the map (default ``1E-10``)
+    """
+    m = numpy.asarray(map3d)
+    if not numpy.iscomplexobj(m):
+        return 1.
+    # Value of largest absolute value (plane by plane to avoid temporary copies of the whole map)
+    c = 0.
+    for plane in m.reshape((-1,) + m.shape[-2:]):
+        a = abs(plane)
+        i = a.argmax()
+        if a.flat[i] > abs(c):
+            c = plane.flat[i]
+    if c == 0:
+        return 1.
+    atol = tolerance * abs(c)
+    c = c / abs(c)
+    for plane in m.reshape((-1,) + m.shape[-2:]):
+        if abs((plane / c).imag).max() > atol:
+            return None
+    return c / numpy.conj(c)
+
+def get_reflections(map3d, tolerance=1E-10):
+    """
+    Return the reflections of the regular grid of scattering vectors under which the Fourier transform of a map is invariant
+
+    Every reflection is a tuple ``(flips, phase)``. ``flips`` are three booleans that indicate which axes of the grid are reflected (axis order of the map). If ``phase`` is ``None`` the volume is invariant under the reflection, :math:`F(r q) = F(q)`, otherwise the reflection involves the Friedel symmetry, :math:`F(r q) = \\mathrm{phase} \\, F^*(q)`. The identity is always included.
+
+    Args:
+      :map3d (array): 3D map that is centered on its grid
+
+    Kwargs:
+      :tolerance (float): Largest deviation relative to the largest absolute value of the map (default ``1E-10``)
+    """
+    m = numpy.asarray(map3d)
+    if m.ndim != 3:
+        log_and_raise_error(logger, "Symmetries can only be determined for 3D maps (map3d.ndim = %i)." % m.ndim)
+    atol = tolerance * max([abs(plane).max() for plane in m])
+    # Reflections of the map form a group, products of reflections that were found already are not checked again
+    plain = [(False, False, False)]
+    for flips in sorted(itertools.product([False, True], repeat=3), key=sum)[1:]:
+        if flips in plain:
+            continue
+        if _is_invariant(m, flips, atol):
+            plain += [tuple([f != g for f, g in zip(flips, other)]) for other in plain]
+    reflections = [(flips, None) for flips in plain]
+    phase = get_friedel_phase(m, tolerance=tolerance) if len(plain) < 8 else None
+    if phase is not None:
+        # Combination of a reflection of the map with the inversion of the Friedel symmetry
+        for flips in plain:
+            inverted = tuple([not f for f in flips])
+            if inverted not in plain:
+                reflections.append((inverted, phase))
+    return reflections
+
+def _is_invariant(m, flips, atol):
+    # Plane by plane along the first axis to avoid temporary copies of the whole map and to stop at the first mismatch
+    s = tuple([slice(None, None, -1) if f else slice(None) for f in flips[1:]])
+    N = m.shape[0]
+    for k in range((N+1)//2 if flips[0] else N):
+        d = m[N-1-k if flips[0] else k][s] - m[k]
+        if abs(d.real).max() > atol or (numpy.iscomplexobj(d) and abs(d.imag).max() > atol):
+            return False
+    return True
+
+def get_reduced_axes(reflections):
+    """
+    Return the largest set of axes along which only the non-negative half of the grid has to be calculated
+
+    Along the returned axes the volume is calculated only for the indices ``k >= n//2`` (see :func:`condor.utils.symmetry.expand_volume`). Every combination of half-spaces along these axes has to be reached by one of the reflections.
+
+    Args:
+      :reflections (list): Reflections as returned by :func:`condor.utils.symmetry.get_reflections`
+    """
+    for size in [3, 2, 1]:
+        for axes in itertools.combinations(range(3), size):
+            patterns = set([tuple([flips[a] for a in axes]) for flips, phase in reflections])
+            if len(patterns) == 2**size:
+                return list(axes)
+    return []
+
+def expand_volume(volume, n, axes, reflections):
+    """
+    Expand a volume that was calculated on the non-negative half of the grid along some axes to the whole grid
+
+    Args:
+      :volume (array): Complex 3D volume with ``n - n//2`` planes (indices ``k >= n//2``) along the given axes and ``n`` planes along the other axes
+
+      :n (int): Number of grid points along every axis of the expanded volume
+
+      :axes (list): Reduced axes (see :func:`condor.utils.symmetry.get_reduced_axes`)
+
+      :reflections (list): Reflections as returned by :func:`condor.utils.symmetry.get_reflections`
+    """
+    h = n//2
+    expanded = numpy.empty(shape=(n, n, n), dtype=numpy.complex128)
+    for pattern in itertools.product([False, True], repeat=len(axes)):
+        flips, phase = [(flips, phase) for flips, phase in reflections if tuple([flips[a] for a in axes]) == pattern][0]
+        # Part of the grid with negative indices along the reduced axes that are reflected
+        target = [slice(None)] * 3
+        source = [slice(None)] * 3
+        for a in range(3):
+            if a in axes:
+                target[a] = slice(0, h) if flips[a] else slice(h, n)
+                # For odd n the plane k = n//2 (q = 0) is not reflected
+                source[a] = slice(None, 0 if n % 2 else None, -1) if flips[a] else slice(None)
+            elif flips[a]:
+                source[a] = slice(None, None, -1)
+        v = volume[tuple(source)]
+        expanded[tuple(target)] = v if phase is None else phase * numpy.conj(v)
+    return expanded
+
+def nfft_grid_symmetric(real_space, spacing, n, origins=None, tolerance=1E-10):
+    """
+    Return the Fourier transform of a 3D map on a regular grid of points (the same as :func:`condor.utils.nfft.nfft_grid`) that is calculated only on the part of the grid that is not related to the rest by a symmetry of the map (see :func:`condor.utils.symmetry.get_reflections`)
+
+    Args:
+      :real_space (array): 3D map that is centered on its grid
+
+      :spacing (float): Grid spacing *h*
+
+      :n (int): Number of grid points along every dimension
+
+    Kwargs:
+      :origins (list): Map index of the origin of the transform per dimension. If ``None`` the origin lies at the index *N*/2 (rounded down) (default ``None``)
+
+      :tolerance (float): Largest deviation from a symmetry relative to the largest absolute value of the map (default ``1E-10``)
+    """
+    m = numpy.asarray(real_space)
+    if origins is None:
+        origins = [N // 2 for N in m.shape]
+    reflections = get_reflections(m, tolerance=tolerance)
+    axes = get_reduced_axes(reflections)
+    volume = condor.utils.nfft.nfft_grid(m, spacing, n, ranges=[(n//2, n) if a in axes else None for a in range(3)], origins=origins)
+    if not axes:
+        return volume
+    # The symmetries hold for the transform with the origin at the center (N-1)/2 of the map. Along axes where the origin lies elsewhere (e.g. at N//2 for an even number of samples) the phase ramp of the shift is removed before the expansion and applied again afterwards.
+    x = (numpy.arange(n) - (n-1)/2.) * spacing
+    ramps = [numpy.exp(-2.j*numpy.pi*x*((N-1)/2. - o)) for N, o in zip(m.shape, origins)]
+    shifted = [(m.shape[a]-1)/2. != origins[a] for a in range(3)]
+    for a in range(3):
+        if shifted[a]:
+            ramp = ramps[a][n//2:] if a in axes else ramps[a]
+            volume *= numpy.conj(ramp).reshape([-1 if b == a else 1 for b in range(3)])
+    volume = expand_volume(volume, n, axes, reflections)
+    for a in range(3):
+        if shifted[a]:
+            volume *= ramps[a].reshape([-1 if b == a else 1 for b in range(3)])
+    return volume
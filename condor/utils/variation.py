@@ -148,19 +148,22 @@ class Variation:
             if number_of_dimensions != len(self._spread):
                 log_and_raise_error(logger, "Specified number of dimensions (%i) and length of spread array (%i) do not match." % (number_of_dimensions, len(spread)))
                 
-    def _get_grid(self):
+    def get_grid(self):
+        """
+        Return the grid of deviations that is iterated in mode ``'range'`` as an array of shape (number_of_dimensions, number of grid points). In all other modes ``None`` is returned
+        """
         mode = self.get_mode()
         if mode == "range":
+            if numpy.isscalar(self.n):
+                n = [self.n]*self._number_of_dimensions
+            else:
+                n = self.n
             if self._number_of_dimensions == 1:
-                return numpy.array([numpy.linspace(-self._spread/2.,self._spread/2.,n)])
+                return numpy.array([numpy.linspace(-self._spread[0]/2.,self._spread[0]/2.,n[0])])
             elif self._number_of_dimensions == 2:
-                Y,X = numpy.meshgrid(numpy.linspace(-self._spread[0]/2.,self._spread[0]/2.,n),numpy.linspace(-self._spread[1]/2.,self._spread[1]/2.,n),indexing="ij")
+                Y,X = numpy.meshgrid(numpy.linspace(-self._spread[0]/2.,self._spread[0]/2.,n[0]),numpy.linspace(-self._spread[1]/2.,self._spread[1]/2.,n[1]),indexing="ij")
                 return numpy.array([Y.flatten(),X.flatten()])
             elif self._number_of_dimensions == 3:
-                if numpy.isscalar(self.n):
-                    n = [self.n]*3
-                else:
-                    n = self.n
                 Z,Y,X = numpy.meshgrid(numpy.linspace(-self._spread[0]/2.,self._spread[0]/2.,n[0]),
                                        numpy.linspace(-self._spread[1]/2.,self._spread[1]/2.,n[1]),
                                        numpy.linspace(-self._spread[2]/2.,self._spread[2]/2.,n[2]),indexing="ij")
@@ -191,35 +194,39 @@ class Variation:
         else:
             return self._spread[0]
     
-    def get(self, v0):
+    def get(self, v0, random_state=None):
         """
         Get next value(s)
 
         Args:
           :v0 (float/int/array): Value(s) without variational deviation
+
+        Kwargs:
+          :random_state: :class:`numpy.random.RandomState` instance from which the random values are drawn. If ``None`` the global random number generator of NumPy is used (default ``None``)
         """
         if self._number_of_dimensions == 1:
-            v1 = self._get_values_for_one_dim(v0,0)
+            v1 = self._get_values_for_one_dim(v0,0,random_state)
         else:
             v1 = []
             for dim in range(self._number_of_dimensions):
-                v1.append(self._get_values_for_one_dim(v0[dim],dim))
+                v1.append(self._get_values_for_one_dim(v0[dim],dim,random_state))
             v1 = numpy.array(v1)
         self._i += 1        
         return v1
         
-    def _get_values_for_one_dim(self,v0,dim):
+    def _get_values_for_one_dim(self,v0,dim,random_state=None):
+        r = numpy.random if random_state is None else random_state
         if self._mode is None:
             v1 = v0
         elif self._mode == "normal":
-            v1 = numpy.random.normal(v0,self._spread[dim]) if (self._spread[dim] > 0) else v0
+            v1 = r.normal(v0,self._spread[dim]) if (self._spread[dim] > 0) else v0
         elif self._mode == "normal_poisson":
-            v1 = numpy.random.normal(numpy.random.poisson(v0),self._spread[dim])
+            v1 = r.normal(r.poisson(v0),self._spread[dim])
         elif self._mode == "poisson":
-            v1 = numpy.random.poisson(v0)
+            v1 = r.poisson(v0)
         elif self._mode == "uniform":
-            v1 = numpy.random.uniform(v0-self._spread[dim]/2.,v0+self._spread[dim]/2.) if (self._spread[dim] > 0) else v0
+            v1 = r.uniform(v0-self._spread[dim]/2.,v0+self._spread[dim]/2.) if (self._spread[dim] > 0) else v0
         elif self._mode == "range":
-            g = self._get_grid()
+            g = self.get_grid()
             v1 = v0 + g[dim,self._i % g.shape[1]]
         return v1
@@ -103,8 +103,9 @@ class _Command:
                 extra_link_args[0] += ',-rpath,%s' % d
                 extra_link_args[0] += ',-L,%s' % d
 
+        # The extension is optional because condor.utils.nfft falls back to a NumPy implementation if the NFFT library is not available
         return Extension(
-            "condor.utils.nfft",
+            "condor.utils._nfft",
             sources=[os.path.join('condor', 'utils', 'nfftmodule.c')],
             library_dirs=library_dirs,
             libraries=libraries,
@@ -112,6 +113,7 @@ class _Command:
             define_macros=define_macros,
             runtime_library_dirs=runtime_library_dirs,
             extra_link_args=extra_link_args,
+            optional=True,
         )
         
     def _run(self):
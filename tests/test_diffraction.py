@@ -1,5 +1,7 @@
 import unittest
-from condor.utils import diffraction
+import numpy
+import condor
+from condor.utils import diffraction, sphere_diffraction, spheroid_diffraction
 
 class TestCaseDiffraction(unittest.TestCase):
     def test_recolution(self):
@@ -22,3 +24,60 @@ class TestCaseDiffraction(unittest.TestCase):
         nypx_expected  = 0.01
         nypx = diffraction.nyquist_pixel_size(wavelength, detector_distance, particle_size)
         self.assertAlmostEqual(nypx/1E-3 , nypx_expected/1E-3, 1)
+
+    def test_sphere_form_factor_lookup(self):
+        # Compare the tabulated form factor with the analytical expression (which is inaccurate for small q*r because of cancellation)
+        s = numpy.linspace(0.1, 500., 1000001)
+        f = sphere_diffraction.F_sphere_diffraction(1., s, 1.)
+        for accuracy, tolerance in [("draft", 5E-6), ("standard", 5E-9), ("reference", 1E-11)]:
+            f_lookup = sphere_diffraction.F_sphere_diffraction_lookup(1., s, 1., accuracy=accuracy)
+            self.assertLess(abs(f_lookup - f).max(), tolerance)
+        # Patterns of a sphere with varying diameter and centered beam (lookup mirrors the quadrants)
+        det = condor.Detector(distance=0.2, pixel_size=300E-6, nx=65, ny=64)
+        F = []
+        for form_factor_lookup in [None, "reference"]:
+            par = condor.ParticleSphere(diameter=200E-9, diameter_variation="uniform", diameter_spread=100E-9, material_type="water", form_factor_lookup=form_factor_lookup)
+            src = condor.Source(wavelength=0.5E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+            E = condor.Experiment(src, {"particle_sphere" : par}, det)
+            numpy.random.seed(0)
+            F.append(numpy.array([E.propagate()["entry_1"]["data_1"]["data_fourier"] for i in range(3)]))
+        numpy.testing.assert_allclose(F[1], F[0], rtol=0, atol=1E-5*abs(F[0]).max())
+
+    def test_sphere_form_factor_table_threads(self, n=8):
+        # The table is shared between threads and only grows
+        import threading
+        table = sphere_diffraction.SphereFormFactorTable()
+        table._extend(1000.)
+        table._extend(10.)
+        self.assertGreaterEqual(table.get_s_max(), 1000.)
+        table = sphere_diffraction.SphereFormFactorTable()
+        s = [numpy.linspace(0.1, 100.*2**i, 10001) for i in range(n)]
+        f = [None]*n
+        def work(i):
+            f[i] = table.f(s[i])
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for s_i, f_i in zip(s, f):
+            self.assertLess(abs(f_i - sphere_diffraction.F_sphere_diffraction(1., s_i, 1.)).max(), 5E-9)
+
+    def test_spheroid_diffraction_batched(self, N=8):
+        # Compare the fused kernel with the expression built from the reference lambdas, for several spheroids in one broadcasted pass
+        Y, X = numpy.mgrid[-32:32,-48:48] * 1E7
+        rng = numpy.random.RandomState(0)
+        K, a, c, theta, phi = [rng.rand(N) for i in range(5)]
+        a = 50E-9 + 50E-9*a
+        c = 50E-9 + 50E-9*c
+        theta *= numpy.pi
+        phi *= 2*numpy.pi
+        F = spheroid_diffraction.F_spheroid_diffraction(K[:,None,None], X, Y, a[:,None,None], c[:,None,None], theta[:,None,None], phi[:,None,None])
+        self.assertEqual(F.shape, (N, 64, 96))
+        for i in range(N):
+            qH = spheroid_diffraction._qH_spheroid_diffraction(X, Y, a[i], c[i], theta[i], phi[i])
+            F_ref = numpy.sqrt(K[i])*3*(numpy.sin(qH)-qH*numpy.cos(qH))/(qH**3+numpy.finfo("float64").eps)
+            F_ref[qH**6 < numpy.finfo("float64").resolution] = numpy.sqrt(K[i])
+            numpy.testing.assert_allclose(F[i], F_ref, rtol=0, atol=1E-12*numpy.sqrt(K[i]))
+            I = spheroid_diffraction.I_spheroid_diffraction(K[i], X, Y, a[i], c[i], theta[i], phi[i])
+            numpy.testing.assert_allclose(I, F_ref**2, rtol=0, atol=1E-12*K[i])
@@ -0,0 +1,491 @@
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy
+import logging
+logger = logging.getLogger('condor')
+logger.setLevel("WARNING")
+
+import condor
+
+
+def _get_experiment(noise="poisson"):
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=64, ny=48, cx=30, cy=21, center_variation="uniform", center_spread_x=2., center_spread_y=2., noise=noise)
+    par_sphere   = condor.ParticleSphere(diameter=100E-9, diameter_variation="uniform", diameter_spread=20E-9, number=2, arrival="random", material_type="water",
+                                         position_variation="normal", position_spread=[100E-9, 100E-9, 0.])
+    par_spheroid = condor.ParticleSpheroid(diameter=80E-9, flattening=0.7, rotation_formalism="random", material_type="water")
+    return condor.Experiment(src, {"particle_sphere" : par_sphere, "particle_spheroid" : par_spheroid}, det)
+
+def test_propagate_many(n=5):
+    """
+    Compare the batched propagation of many shots with the propagation of the same shots one by one
+    """
+    E = _get_experiment()
+    numpy.random.seed(0)
+    res = E.propagate_many(n)
+    F_many = res["entry_1"]["data_1"]["data_fourier"]
+    assert F_many.shape == (n, 48, 64)
+    assert res["entry_1"]["data_1"]["data"].shape == (n, 48, 64)
+    assert res["entry_1"]["data_1"]["mask"].shape == (n, 48, 64)
+    assert res["detector"]["cx"].shape == (n,)
+    E = _get_experiment()
+    numpy.random.seed(0)
+    shots = [E._get_next_shot() for i in range(n)]
+    for i, shot in enumerate(shots):
+        F = E._propagate_shot(*shot)["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(F_many[i], F, rtol=1E-10, atol=1E-10*abs(F).max())
+
+def test_propagate3d_many(n=3):
+    """
+    Compare the batched propagation of many 3D Fourier volumes of spheres with the propagation of the same shots one by one
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=16, ny=16, solid_angle_correction=False, noise=None)
+    par = condor.ParticleSphere(diameter=100E-9, number=2, arrival="random", material_type="water", position_variation="normal", position_spread=[100E-9, 50E-9, 30E-9])
+    E = condor.Experiment(src, {"particle_sphere" : par}, det)
+    numpy.random.seed(0)
+    F_many = E._propagate_many(n, ndim=3, qn=9)["entry_1"]["data_1"]["data_fourier"]
+    numpy.random.seed(0)
+    for i in range(n):
+        F = E._propagate_shot(*E._get_next_shot(), ndim=3, qn=9)["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(F_many[i], F, rtol=0, atol=1E-10*abs(F).max())
+
+def test_save_qmap_sphere(n=3):
+    """
+    Check that shots of spheres can be propagated with scattering vectors in the output
+    """
+    E = _get_experiment(noise=None)
+    E.propagate(save_qmap=True)
+    assert E.propagate_many(n, save_qmap=True)["entry_1"]["data_1"]["data"].shape == (n, 48, 64)
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=16, ny=16, solid_angle_correction=False, noise=None)
+    E = condor.Experiment(src, {"particle_sphere" : condor.ParticleSphere(diameter=100E-9, material_type="water")}, det)
+    assert E._propagate(save_qmap=True, ndim=3, qn=8)["entry_1"]["data_1"]["data_fourier"].shape == (8, 8, 8)
+
+def test_detect_photons_many(n=4):
+    """
+    Compare the detection of a stack of patterns with the detection of the patterns one by one
+    """
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=16, ny=12, noise="poisson", saturation_level=50.)
+    I = numpy.random.random((n, 12, 16)) * 100.
+    numpy.random.seed(0)
+    I_many, M_many = det.detect_photons_many(I)
+    numpy.random.seed(0)
+    I_one, M_one = zip(*[det.detect_photons(I_i) for I_i in I])
+    numpy.testing.assert_array_equal(I_many, numpy.array(I_one))
+    numpy.testing.assert_array_equal(M_many, numpy.array(M_one))
+    assert I_many.max() <= 50.
+    assert (M_many & condor.utils.pixelmask.PixelMask.PIXEL_IS_SATURATED).any()
+
+def test_experiment_pool(n=6):
+    """
+    Check that the results of the process pool do not depend on the number of workers
+    """
+    import condor.parallel
+    data = []
+    for workers in [1, 3]:
+        numpy.random.seed(1)
+        with condor.parallel.ExperimentPool(_get_experiment(), workers=workers) as pool:
+            res = pool.propagate(n)
+        assert len(res) == n
+        data.append(numpy.array([r["entry_1"]["data_1"]["data"] for r in res]))
+    numpy.testing.assert_array_equal(data[0], data[1])
+    # Configuration dictionary instead of Experiment instance
+    numpy.random.seed(1)
+    with condor.parallel.ExperimentPool(_get_experiment().get_conf(), workers=2) as pool:
+        res = pool.propagate(n)
+    numpy.testing.assert_array_equal(data[0], numpy.array([r["entry_1"]["data_1"]["data"] for r in res]))
+
+def test_iter_propagate(n=5):
+    """
+    Check that prefetched shots are yielded in order and that the generator can be stopped early
+    """
+    E = _get_experiment(noise=None)
+    numpy.random.seed(2)
+    res = list(E.iter_propagate(n=n, prefetch=2, workers=2))
+    assert len(res) == n
+    E = _get_experiment(noise=None)
+    numpy.random.seed(2)
+    # Every shot draws the seed of its photon noise after its parameters
+    shots = [(E._get_next_shot(), numpy.random.randint(2**31)) for i in range(n)]
+    for r, (shot, seed) in zip(res, shots):
+        F = E._propagate_shot(*shot)["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(r["entry_1"]["data_1"]["data_fourier"], F, rtol=1E-10, atol=1E-10*abs(F).max())
+    it = E.iter_propagate(prefetch=3)
+    for i, r in enumerate(it):
+        if i == 2:
+            break
+    it.close()
+
+def test_iter_propagate_noise(n=6):
+    """
+    Check that prefetched shots with photon noise from thread workers are reproducible
+    """
+    data = []
+    for workers in [1, 3]:
+        numpy.random.seed(5)
+        data.append(numpy.array([r["entry_1"]["data_1"]["data"] for r in _get_experiment().iter_propagate(n=n, prefetch=3, workers=workers)]))
+    numpy.testing.assert_array_equal(data[0], data[1])
+    E = _get_experiment()
+    numpy.random.seed(5)
+    shots = [(E._get_next_shot(), numpy.random.randint(2**31)) for i in range(n)]
+    for I, (shot, seed) in zip(data[0], shots):
+        numpy.testing.assert_array_equal(I, E._propagate_shot(*shot, random_state=numpy.random.RandomState(seed))["entry_1"]["data_1"]["data"])
+
+def test_qmap_cache():
+    """
+    Check that rotated scattering vector maps from the cache agree with freshly generated ones
+    """
+    E = _get_experiment()
+    info = E.get_qmap_cache_info()
+    assert info["hits"] == 0 and info["misses"] == 0
+    kwargs = dict(nx=64, ny=48, cx=31.5, cy=23.5, pixel_size=750E-6, detector_distance=0.5, wavelength=0.1E-9)
+    for order in ["xyz", "zyx"]:
+        for i in range(3):
+            R = condor.utils.rotation.Rotation(formalism="random")
+            qmap = E.get_qmap(extrinsic_rotation=R, order=order, **kwargs)
+            qmap_ref = E.detector.generate_qmap(kwargs["wavelength"], cx=kwargs["cx"], cy=kwargs["cy"], extrinsic_rotation=R, order=order)
+            numpy.testing.assert_allclose(qmap, qmap_ref, rtol=1E-10, atol=1E-10*abs(qmap_ref).max())
+    info = E.get_qmap_cache_info()
+    assert info["misses"] == 2 and info["hits"] == 4 and info["currsize"] == 2
+    E.set_qmap_cache_size(1)
+    assert E.get_qmap_cache_info()["currsize"] == 1
+
+def test_map_cache():
+    """
+    Check that maps of generated geometries are served from the cache by rescaling the grid spacing if the diameter varies between shots
+    """
+    for geometry in ["icosahedron", "spheroid"]:
+        par = condor.ParticleMap(geometry=geometry, diameter=60E-9, diameter_variation="range", diameter_spread=20E-9, diameter_variation_n=3, material_type="water")
+        m_ref, dx_ref = condor.ParticleMap(geometry=geometry, diameter=70E-9, material_type="water").get_new_map(dict(par.get_next(), diameter=70E-9), 2E-9, 2E-9)
+        par = condor.ParticleMap(geometry=geometry, diameter=60E-9, diameter_variation="range", diameter_spread=20E-9, diameter_variation_n=3, material_type="water")
+        for i in range(6):
+            O = par.get_next()
+            m, dx = par.get_new_map(O, 2E-9, 2E-9)
+            numpy.testing.assert_allclose(dx, dx_ref * O["diameter"] / 70E-9, rtol=1E-12)
+            numpy.testing.assert_allclose(m, m_ref, rtol=0, atol=1E-10)
+        info = par.get_map_cache_info()
+        assert info["misses"] == 1 and info["hits"] == 5 and info["currsize"] == 1
+        # Rescaled grid spacing too coarse
+        m, dx = par.get_new_map(O, 1E-9, 1E-9)
+        assert dx == 1E-9 and par.get_map_cache_info()["currsize"] == 2
+        # The most recently generated map is kept even if it exceeds the memory budget alone
+        par.set_map_cache_size(0)
+        info = par.get_map_cache_info()
+        assert info["currsize"] == 1 and info["evictions"] == 1 and m.nbytes <= info["currbytes"] < 2*m.nbytes
+
+def test_map_pyramid():
+    """
+    Compare patterns of a finely sampled custom map with patterns of its downsampled level of the map pyramid and check the pyramid stored on disk
+    """
+    import tempfile, shutil, os
+    src = condor.Source(wavelength=0.5E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=32, ny=32, noise=None)
+    map3d = condor.utils.bodies.make_sphere_map(64, 20.)
+    par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=1E-9, diameter=40E-9, material_type="water")
+    E = condor.Experiment(src, {"particle_map" : par}, det)
+    I_ref = E.propagate()["entry_1"]["data_1"]["data"]
+    condor.particle.particle_map.ENABLE_MAP_INTERPOLATION = True
+    try:
+        O = E.propagate(save_map3d=True)
+    finally:
+        condor.particle.particle_map.ENABLE_MAP_INTERPOLATION = False
+    I = O["entry_1"]["data_1"]["data"]
+    assert O["particles"]["particle_00"]["map3d_dn"].shape[-1] < 64
+    numpy.testing.assert_allclose(I, I_ref, rtol=0, atol=1E-2*I_ref.max())
+    directory = tempfile.mkdtemp()
+    try:
+        par.set_map_pyramid_directory(directory)
+        par._pyramid = None
+        pyramid = par.get_map_pyramid()
+        assert len(os.listdir(directory)) == 1
+        par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=1E-9, diameter=40E-9, material_type="water")
+        par.set_map_pyramid_directory(directory)
+        for (m, dx), (m_ref, dx_ref) in zip(par.get_map_pyramid(), pyramid):
+            assert dx == dx_ref
+            numpy.testing.assert_array_equal(m, m_ref)
+    finally:
+        shutil.rmtree(directory)
+
+def test_detector_geometry_cache(n=9):
+    """
+    Check that the cached pixel geometry of a detector with a finite set of beam center positions agrees with the uncached calculation
+    """
+    E = _get_experiment(noise=None)
+    E.source.polarization = "unpolarized"
+    E.detector.distance = 0.05
+    E.detector.set_center_variation(center_variation="range", center_spread_x=4., center_spread_y=2., center_variation_n=3)
+    centers = E.detector.get_all_center_positions()
+    assert len(centers) == n
+    numpy.random.seed(3)
+    res = E.propagate_many(n)
+    assert E.detector.geometry_cache.get_info()["hits"] > 0
+    numpy.testing.assert_array_equal(numpy.array([res["detector"]["cx"], res["detector"]["cy"]]).T, numpy.array(centers))
+    wavelength = E.source.photon.get_wavelength()
+    for cx, cy in centers:
+        X, Y = E.detector.generate_xypix(cx=cx, cy=cy)
+        numpy.testing.assert_allclose(E.detector.geometry_cache.get_solid_angles(cx, cy), E.detector.get_pixel_solid_angle(X, Y), rtol=1E-10)
+        numpy.testing.assert_allclose(E.detector.geometry_cache.get_polarization_factors(cx, cy, "unpolarized"), E.detector.calculate_polarization_factors(cx, cy, "unpolarized"), rtol=1E-10)
+        q = numpy.sqrt((E.detector.generate_qmap(wavelength, cx=cx, cy=cy)**2).sum(axis=2))
+        numpy.testing.assert_allclose(E.detector.geometry_cache.get_q_abs(wavelength, cx, cy), q, rtol=1E-10)
+    E.detector.geometry_cache.clear()
+    numpy.random.seed(3)
+    numpy.testing.assert_allclose(E.propagate_many(n)["entry_1"]["data_1"]["data_fourier"], res["entry_1"]["data_1"]["data_fourier"], rtol=1E-10)
+
+def test_propagate_orientations(n=4):
+    """
+    Compare the patterns of many orientations and diameters from one concatenated NFFT with the patterns of single shots
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=32, ny=24, cx=14, cy=11)
+    map3d = numpy.zeros((12, 12, 12))
+    map3d[2:10, 3:9, 4:8] = 1.
+    par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=5E-9, diameter=60E-9, material_type="water", position=[20E-9, 0., 0.])
+    E = condor.Experiment(src, {"particle_map" : par}, det)
+    quaternions = numpy.array([condor.utils.rotation.rand_quat() for i in range(n)])
+    diameters = numpy.linspace(50E-9, 60E-9, n)
+    res = E.propagate_orientations(quaternions, diameters=diameters)
+    F_many = res["entry_1"]["data_1"]["data_fourier"]
+    assert F_many.shape == (n, 24, 32)
+    numpy.testing.assert_array_equal(res["particles"]["particle_00"]["diameter"], diameters)
+    for q, d, F_i in zip(quaternions, diameters, F_many):
+        D_source, D_particles, D_detector = E._get_next_shot()
+        D_particles["particle_00"]["extrinsic_quaternion"] = q
+        D_particles["particle_00"]["diameter"] = d
+        F = E._propagate_shot(D_source, D_particles, D_detector)["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(F_i, F, rtol=1E-8, atol=1E-8*abs(F).max())
+
+def test_nfft_map_reuse(n=3):
+    """
+    Check that the map of a ParticleMap is set only once for many shots and that the patterns agree with patterns from new NFFT plans
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=32, ny=24, cx=14, cy=11)
+    par = condor.ParticleMap(geometry="cube", diameter=40E-9, rotation_formalism="random", material_type="water")
+    E = condor.Experiment(src, {"particle_map" : par}, det)
+    shots = [E._get_next_shot() for i in range(n)]
+    maps = []
+    for D_source, D_particles, D_detector in shots:
+        # Copies because the propagation removes private entries from the parameter dictionaries
+        shot = lambda: (dict(D_source), dict([(k, dict(v)) for k, v in D_particles.items()]), dict(D_detector))
+        res = E._propagate_shot(*shot(), save_map3d=True)
+        maps.append(res["particles"]["particle_00"]["map3d_dn"])
+        F = res["entry_1"]["data_1"]["data_fourier"]
+        E._nfft_plans.clear()
+        F_ref = E._propagate_shot(*shot())["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(F, F_ref, rtol=1E-10, atol=1E-10*abs(F_ref).max())
+    assert all([m is maps[0] for m in maps])
+    assert not maps[0].flags.writeable
+
+def test_map_accuracy():
+    """
+    Check that the accuracy tiers of ParticleMap agree with each other within the accuracy of the draft tier
+    """
+    src = condor.Source(wavelength=1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=0.3, pixel_size=600E-6, nx=64, ny=64, cx=31.5, cy=31.5)
+    F = {}
+    for accuracy in ["draft", "standard", (8, 2., 1.)]:
+        par = condor.ParticleMap(geometry="cube", diameter=60E-9, rotation_values=[1., 0., 0., 0.], rotation_formalism="quaternion", material_type="water", accuracy=accuracy)
+        assert condor.ParticleMap(**par.get_conf()).get_accuracy_parameters() == par.get_accuracy_parameters()
+        E = condor.Experiment(src, {"particle_map" : par}, det)
+        F[accuracy] = E.propagate()["entry_1"]["data_1"]["data_fourier"]
+    numpy.testing.assert_allclose(F["standard"], F[(8, 2., 1.)], rtol=0, atol=1E-8*abs(F["standard"]).max())
+    numpy.testing.assert_allclose(F["draft"], F["standard"], rtol=0, atol=1E-3*abs(F["standard"]).max())
+    try:
+        par.set_accuracy("fast")
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+def test_fourier_volume_sampling(n=3):
+    """
+    Compare patterns interpolated from cached Fourier volumes with patterns from the NFFT and the analytical form factor of a sphere
+    """
+    src = condor.Source(wavelength=1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=0.3, pixel_size=600E-6, nx=64, ny=64, cx=31.5, cy=31.5)
+    for key, par in [("particle_map", condor.ParticleMap(geometry="cube", diameter=60E-9, rotation_formalism="random", material_type="water")),
+                     ("particle_sphere", condor.ParticleSphere(diameter=60E-9, material_type="water"))]:
+        E = condor.Experiment(src, {key : par}, det)
+        shots = [E._get_next_shot() for i in range(n)]
+        # Copies because the propagation removes private entries from the parameter dictionaries
+        copy = lambda D_source, D_particles, D_detector: (dict(D_source), dict([(k, dict(v)) for k, v in D_particles.items()]), dict(D_detector))
+        F_ref = [E._propagate_shot(*copy(*shot))["entry_1"]["data_1"]["data_fourier"] for shot in shots]
+        for accuracy, tolerance in [("draft", 5E-2), ("reference", 1E-4)]:
+            E.set_fourier_volume_sampling(accuracy)
+            for shot, F in zip(shots, F_ref):
+                numpy.testing.assert_allclose(E._propagate_shot(*copy(*shot))["entry_1"]["data_1"]["data_fourier"], F, rtol=0, atol=tolerance*abs(F).max())
+            info = E.get_fourier_volume_sampler().get_info()
+            assert info["misses"] == 1 and info["hits"] == n-1
+        E.set_fourier_volume_sampling(None)
+        assert E.get_fourier_volume_sampler() is None
+
+def test_pattern_library(n=6):
+    """
+    Compare the patterns of a pattern library with freshly propagated patterns
+    """
+    import tempfile, shutil
+    import condor.library
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6)
+    det = condor.Detector(distance=0.5, pixel_size=750E-6, nx=32, ny=24, cx=14, cy=11, noise="poisson")
+    par = condor.ParticleSpheroid(diameter=80E-9, flattening=0.7, rotation_formalism="random", material_type="water")
+    E = condor.Experiment(src, {"particle_spheroid" : par}, det)
+    quaternions = numpy.array([condor.utils.rotation.rand_quat() for i in range(n)])
+    directory = tempfile.mkdtemp()
+    try:
+        condor.library.create_pattern_library(directory, E, quaternions)
+        L = condor.library.PatternLibrary(directory, detector=det)
+        assert len(L) == n
+        for q in quaternions:
+            D_source, D_particles, D_detector = E._get_next_shot()
+            D_particles["particle_00"]["extrinsic_quaternion"] = q
+            I = abs(E._propagate_shot(D_source, D_particles, D_detector)["entry_1"]["data_1"]["data_fourier"])**2
+            numpy.testing.assert_allclose(L.get_intensity(q), I, rtol=1E-10)
+            # Opposite quaternions describe the same rotation
+            numpy.testing.assert_allclose(L.get_intensity(-q, neighbors=3), I, rtol=1E-10)
+        index, angles = L.find_nearest(quaternions[0], k=n)
+        assert index[0] == 0 and angles[0] < 1E-6 and numpy.all(numpy.diff(angles) >= 0)
+        I_det, M_det = L.get_pattern(condor.utils.rotation.rand_quat(), neighbors=2)
+        assert I_det.shape == (24, 32) and M_det.shape == (24, 32)
+        numpy.testing.assert_array_equal(I_det, numpy.round(I_det))
+    finally:
+        shutil.rmtree(directory)
+
+def test_propagate3d_grid():
+    """
+    Compare 3D Fourier volumes from the regular-grid FFT with volumes from the NFFT for rotations that map the grid onto itself
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=16, ny=16, cx=7.5, cy=7.5, solid_angle_correction=False)
+    map3d = numpy.zeros((12, 12, 12))
+    map3d[2:10, 3:9, 4:8] = 1.
+    map3d[2:4, 3:5, 4:5] = 2.
+    s = numpy.sqrt(0.5)
+    for q in [[1., 0., 0., 0.], [s, s, 0., 0.], [0., 0., 1., 0.], [0.5, 0.5, -0.5, 0.5]]:
+        par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=5E-9, diameter=60E-9, material_type="water", position=[20E-9, -10E-9, 5E-9],
+                                 rotation_values=numpy.array(q), rotation_formalism="quaternion")
+        E = condor.Experiment(src, {"particle_map" : par}, det)
+        F = E.propagate3d()["entry_1"]["data_1"]["data_fourier"]
+        get_grid_axes = condor.experiment._get_grid_axes
+        condor.experiment._get_grid_axes = lambda extrinsic_rotation: None
+        try:
+            F_ref = E.propagate3d()["entry_1"]["data_1"]["data_fourier"]
+        finally:
+            condor.experiment._get_grid_axes = get_grid_axes
+        assert F.shape == (16, 16, 16)
+        numpy.testing.assert_allclose(F, F_ref, rtol=0, atol=1E-8*abs(F_ref).max())
+    assert condor.experiment._get_grid_axes(condor.utils.rotation.Rotation(values=numpy.array([0.9, 0.1, 0.3, 0.]), formalism="quaternion")) is None
+    assert E.propagate3d(qn=10)["entry_1"]["data_1"]["data_fourier"].shape == (10, 10, 10)
+
+def test_propagate3d_symmetry():
+    """
+    Compare 3D Fourier volumes that are calculated on the asymmetric part of the grid and expanded with volumes of the whole grid
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=16, ny=16, cx=7.5, cy=7.5, solid_angle_correction=False)
+    s = numpy.sqrt(0.5)
+    q_random = numpy.array([0.9, 0.1, 0.3, 0.])
+    q_random /= numpy.sqrt((q_random**2).sum())
+    for geometry in ["icosahedron", "cube"]:
+        for q in [numpy.array([1., 0., 0., 0.]), numpy.array([s, 0., s, 0.]), q_random]:
+            par = condor.ParticleMap(geometry=geometry, diameter=60E-9, material_type="water", position=[20E-9, -10E-9, 5E-9],
+                                     rotation_values=q, rotation_formalism="quaternion")
+            E = condor.Experiment(src, {"particle_map" : par}, det)
+            for qn in [15, 16]:
+                F = E.propagate3d(qn=qn, symmetry=True)["entry_1"]["data_1"]["data_fourier"]
+                F_ref = E.propagate3d(qn=qn)["entry_1"]["data_1"]["data_fourier"]
+                numpy.testing.assert_allclose(F, F_ref, rtol=0, atol=1E-8*numpy.nanmax(abs(F_ref)))
+    # Icosahedra and cubes are symmetric under all reflections of the grid
+    map3d_dn, dx = par.get_new_dn_map(par.get_next(), 5E-9, 5E-9, src.photon.get_wavelength())
+    assert condor.utils.symmetry.get_reduced_axes(condor.utils.symmetry.get_reflections(map3d_dn)) == [0, 1, 2]
+
+def test_propagate3d_to_file(qn=12):
+    """
+    Compare 3D Fourier volumes that are written slab by slab (also after an interruption) with volumes from propagate3d
+    """
+    import tempfile, shutil, os, h5py
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=16, ny=16, cx=7.5, cy=7.5, solid_angle_correction=False, noise=None)
+    map3d = numpy.zeros((12, 12, 12))
+    map3d[2:10, 3:9, 4:8] = 1.
+    s = numpy.sqrt(0.5)
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "volume.cxi")
+        for rotation_values, rotation_formalism in [(numpy.array([s, 0., s, 0.]), "quaternion"), (None, "random")]:
+            par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=5E-9, diameter=60E-9, material_type="water", position=[20E-9, -10E-9, 5E-9],
+                                     rotation_values=rotation_values, rotation_formalism=rotation_formalism)
+            E = condor.Experiment(src, {"particle_map" : par, "particle_sphere" : condor.ParticleSphere(diameter=40E-9, material_type="water")}, det)
+            E.propagate3d_to_file(filename, qn=qn, slab_size=5, resume=False)
+            with h5py.File(filename, "r") as f:
+                assert f["entry_1/data_1"].attrs["next_slab"] == qn
+                F = f["entry_1/data_1/data_fourier"][0]
+                q = f["particles/particle_00/extrinsic_quaternion"][0]
+            # Interruption after the first slab
+            with h5py.File(filename, "r+") as f:
+                f["entry_1/data_1"].attrs["next_slab"] = 5
+                f["entry_1/data_1/data_fourier"][0,5:] = 0.
+            E.propagate3d_to_file(filename, qn=qn, slab_size=3)
+            with h5py.File(filename, "r") as f:
+                numpy.testing.assert_allclose(f["entry_1/data_1/data_fourier"][0], F, rtol=0, atol=1E-12*abs(F).max())
+                numpy.testing.assert_allclose(f["entry_1/data_1/data"][0], abs(F)**2, rtol=1E-12)
+            # Reference with the same orientation
+            par.set_alignment(rotation_values=q, rotation_formalism="quaternion", rotation_mode="extrinsic")
+            F_ref = E.propagate3d(qn=qn)["entry_1"]["data_1"]["data_fourier"]
+            numpy.testing.assert_allclose(F, F_ref, rtol=0, atol=1E-8*abs(F_ref).max())
+    finally:
+        shutil.rmtree(directory)
+
+def test_support_cropping():
+    """
+    Compare patterns and 3D Fourier volumes of a map that is cropped to its support with those of the whole map
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=16, ny=16, cx=7.5, cy=7.5, solid_angle_correction=False, noise=None)
+    map3d = numpy.zeros((40, 40, 40))
+    map3d[5:20, 8:22, 20:33] = 1.
+    map3d[6, 9, 21] = 2.
+    q_random = numpy.array([0.9, 0.1, 0.3, 0.])
+    q_random /= numpy.sqrt((q_random**2).sum())
+    for q in [numpy.array([1., 0., 0., 0.]), q_random]:
+        par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=10E-9, material_type="water", rotation_values=q, rotation_formalism="quaternion")
+        E = condor.Experiment(src, {"particle_map" : par}, det)
+        map3d_dn, dx, origins = par.get_new_dn_map_cropped(par.get_next(), 20E-9, 20E-9, src.photon.get_wavelength())
+        assert map3d_dn.size < map3d.size / 4
+        F = E.propagate()["entry_1"]["data_1"]["data_fourier"]
+        F3d = E.propagate3d(qn=15, symmetry=True)["entry_1"]["data_1"]["data_fourier"]
+        condor.particle.particle_map.ENABLE_SUPPORT_CROPPING = False
+        try:
+            F_ref = E.propagate()["entry_1"]["data_1"]["data_fourier"]
+            F3d_ref = E.propagate3d(qn=15, symmetry=True)["entry_1"]["data_1"]["data_fourier"]
+        finally:
+            condor.particle.particle_map.ENABLE_SUPPORT_CROPPING = True
+        numpy.testing.assert_allclose(F, F_ref, rtol=0, atol=1E-8*abs(F_ref).max())
+        numpy.testing.assert_allclose(F3d, F3d_ref, rtol=0, atol=1E-8*numpy.nanmax(abs(F3d_ref)))
+
+def test_material_transforms():
+    """
+    Compare patterns and 3D Fourier volumes of a map of two materials (transformed per material) with those of its refractive index map and check that materials share generated maps
+    """
+    src = condor.Source(wavelength=0.1E-9, pulse_energy=1E-3, focus_diameter=1E-6, polarization="ignore")
+    det = condor.Detector(distance=2., pixel_size=750E-6, nx=16, ny=16, cx=7.5, cy=7.5, solid_angle_correction=False, noise=None)
+    map3d = numpy.zeros((2, 40, 40, 40))
+    map3d[0, 5:20, 8:22, 20:33] = 1.
+    map3d[1, 10:30, 10:30, 10:30] = 0.5
+    q = numpy.array([0.9, 0.1, 0.3, 0.])
+    q /= numpy.sqrt((q**2).sum())
+    par = condor.ParticleMap(geometry="custom", map3d=map3d, dx=10E-9, material_type=["water", "protein"], rotation_values=q, rotation_formalism="quaternion")
+    E = condor.Experiment(src, {"particle_map" : par}, det)
+    map3d_dn, dx = par.get_new_dn_map(par.get_next(), 20E-9, 20E-9, src.photon.get_wavelength())
+    par_ref = condor.ParticleMap(geometry="custom", map3d=numpy.array(map3d_dn), dx=10E-9, material_type=None, rotation_values=q, rotation_formalism="quaternion")
+    E_ref = condor.Experiment(src, {"particle_map" : par_ref}, det)
+    for propagate in [lambda E: E.propagate(), lambda E: E.propagate3d(qn=15, symmetry=True)]:
+        F = propagate(E)["entry_1"]["data_1"]["data_fourier"]
+        F_ref = propagate(E_ref)["entry_1"]["data_1"]["data_fourier"]
+        numpy.testing.assert_allclose(F, F_ref, rtol=0, atol=1E-8*numpy.nanmax(abs(F_ref)))
+    # Geometric maps are shared by all materials
+    par = condor.ParticleMap(geometry="sphere", diameter=50E-9, material_type=["water", "protein"])
+    m, dx = par.get_new_map(par.get_next(), 2E-9, 2E-9)
+    assert m.shape[0] == 2 and m.strides[0] == 0
+    assert par.get_map_cache_info()["currbytes"] < m.nbytes
+    maps, dn, dx, origins = par.get_new_material_maps_cropped(par.get_next(), 2E-9, 2E-9, src.photon.get_wavelength())
+    assert maps.shape[0] == 1 and len(dn) == 1
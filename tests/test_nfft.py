@@ -30,6 +30,9 @@
 # All variables are in SI units by default. Exceptions explicit by variable name.
 # -----------------------------------------------------------------------------------------------------
 import numpy
+import time
+import logging
+logger = logging.getLogger(__name__)
 import condor.utils.nfft as nfft
 import unittest
 
@@ -89,3 +92,132 @@ class TestNfft(unittest.TestCase):
         a = numpy.random.random(self._size)
         self.assertRaises(ValueError, nfft.nfft, (a, "hej"))
         self.assertRaises(ValueError, nfft.nfft, ("hej", a))
+
+    def test_plan(self):
+        a = numpy.random.random((self._size, )*3)
+        b = numpy.random.random((self._size, )*3)
+        coordinates = numpy.random.random((20, 3)) - 0.5
+        plan = nfft.Plan(a.shape, len(coordinates))
+        plan.set_coordinates(coordinates)
+        plan.set_map(a)
+        numpy.testing.assert_almost_equal(plan.transform(), nfft.nfft(a, coordinates), decimal=self._decimals)
+        # Only the map is updated, the result is written into the given buffer
+        plan.set_map(b)
+        out = numpy.zeros(len(coordinates), dtype=numpy.complex128)
+        plan.transform(out=out)
+        numpy.testing.assert_almost_equal(out, nfft.nfft(b, coordinates), decimal=self._decimals)
+        # Stack of maps
+        plan.set_maps([a, b])
+        numpy.testing.assert_almost_equal(plan.transform_many(), nfft.nfft_many([a, b], coordinates), decimal=self._decimals)
+        self.assertRaises(ValueError, plan.set_map, numpy.random.random((self._size, )*2))
+        self.assertRaises(ValueError, plan.set_coordinates, coordinates[:10])
+
+    def test_num_threads(self):
+        a = numpy.random.random((self._size, )*3)
+        coordinates = numpy.random.random((20, 3)) - 0.5
+        ft_nfft = nfft.nfft(a, coordinates)
+        numpy.testing.assert_almost_equal(nfft.nfft(a, coordinates, nthreads=2), ft_nfft, decimal=self._decimals)
+        nfft.set_num_threads(2)
+        try:
+            numpy.testing.assert_almost_equal(nfft.nfft(a, coordinates), ft_nfft, decimal=self._decimals)
+        finally:
+            nfft.set_num_threads(None)
+        self.assertGreaterEqual(nfft.get_num_threads(), 1)
+        self.assertRaises(ValueError, nfft.nfft, a, coordinates, nthreads=0)
+
+    def test_backends(self):
+        """
+        Compare accuracy and speed of all available backends with a direct evaluation of the Fourier sum (timings are logged at level INFO)
+        """
+        shape = (24, )*3
+        a = numpy.random.random(shape) + 1j*numpy.random.random(shape)
+        coordinates = numpy.random.random((2000, 3)) - 0.5
+        k = numpy.array([g.ravel() for g in numpy.meshgrid(*[numpy.arange(n) - n//2 for n in shape], indexing="ij")]).T
+        t0 = time.perf_counter()
+        ft_ndft = numpy.exp(-2j*numpy.pi*coordinates.dot(k.T)).dot(a.ravel())
+        t_ndft = time.perf_counter() - t0
+        backends = ["numpy"] + (["c"] if nfft.is_c_backend_available() else [])
+        try:
+            for backend in backends:
+                nfft.set_backend(backend)
+                self.assertEqual(nfft.get_backend(), backend)
+                t0 = time.perf_counter()
+                ft_nfft = nfft.nfft(a, coordinates)
+                t_nfft = time.perf_counter() - t0
+                logger.info("%s backend: %.2e s, NDFT: %.2e s", backend, t_nfft, t_ndft)
+                numpy.testing.assert_almost_equal(ft_nfft/abs(ft_ndft).max(), ft_ndft/abs(ft_ndft).max(), decimal=self._decimals)
+        finally:
+            nfft.set_backend("auto")
+        self.assertRaises(RuntimeError, nfft.set_backend, "fortran")
+
+    def test_nfft_many(self):
+        maps = numpy.random.random((3, )+(self._size, )*3)
+        coordinates = numpy.random.random((50, 3)) - 0.5
+        ft_many = nfft.nfft_many(maps, coordinates)
+        self.assertEqual(ft_many.shape, (3, 50))
+        for m, ft in zip(maps, ft_many):
+            numpy.testing.assert_almost_equal(ft, nfft.nfft(m, coordinates), decimal=self._decimals)
+        # 1D maps and sequences of maps
+        ft_many = nfft.nfft_many([maps[0,0,0], maps[1,0,0]], self._coord_1d)
+        numpy.testing.assert_almost_equal(ft_many[1], nfft.nfft(maps[1,0,0], self._coord_1d), decimal=self._decimals)
+        self.assertRaises(ValueError, nfft.nfft_many, maps[0,0,0], self._coord_1d)
+
+    def test_nfft_grid(self):
+        a = numpy.random.random((self._size, self._size+1, self._size-1))
+        for n, h in [(7, 0.09), (8, 0.13)]:
+            x = (numpy.arange(n) - (n-1)/2.) * h
+            coordinates = numpy.array([c.ravel() for c in numpy.meshgrid(x, x, x, indexing="ij")]).T
+            k = numpy.array([g.ravel() for g in numpy.meshgrid(*[numpy.arange(N) - N//2 for N in a.shape], indexing="ij")]).T
+            ft_ndft = numpy.exp(-2j*numpy.pi*coordinates.dot(k.T)).dot(a.ravel()).reshape((n, n, n))
+            numpy.testing.assert_almost_equal(nfft.nfft_grid(a, h, n)/abs(ft_ndft).max(), ft_ndft/abs(ft_ndft).max(), decimal=self._decimals+3)
+        self.assertRaises(ValueError, nfft.nfft_grid, a, 0.1, 0)
+
+    def test_crop_to_support(self):
+        a = numpy.zeros((20, 21, 16))
+        a[3:9, 12:17, 5:11] = numpy.random.random((6, 5, 6))
+        cropped, origins = nfft.crop_to_support(a)
+        self.assertTrue(all([n < N and n % 2 == N % 2 for n, N in zip(cropped.shape, a.shape)]))
+        self.assertAlmostEqual(abs(cropped).sum(), abs(a).sum())
+        coordinates = numpy.random.random((50, 3)) - 0.5
+        ft = nfft.nfft(cropped, coordinates) * nfft.get_origin_phase(coordinates, cropped.shape, origins)
+        ft_ref = nfft.nfft(a, coordinates)
+        numpy.testing.assert_almost_equal(ft/abs(ft_ref).max(), ft_ref/abs(ft_ref).max(), decimal=self._decimals)
+        numpy.testing.assert_almost_equal(nfft.nfft_grid(cropped, 0.09, 7, origins=origins), nfft.nfft_grid(a, 0.09, 7), decimal=self._decimals)
+
+    @unittest.skipIf(not nfft.is_c_backend_available(), "C backend not available")
+    def test_wisdom(self):
+        import tempfile, os
+        a = numpy.random.random((self._size, )*3)
+        coordinates = numpy.random.random((20, 3)) - 0.5
+        ft_nfft = nfft.nfft(a, coordinates)
+        directory = tempfile.mkdtemp()
+        try:
+            nfft.set_wisdom_directory(directory, planner_effort="measure")
+            nfft.preplan([a.shape, (8, 8)])
+            self.assertTrue(os.path.exists(os.path.join(directory, "fftw_wisdom")))
+            # The planner effort does not change the result
+            numpy.testing.assert_almost_equal(nfft.nfft(a, coordinates), ft_nfft, decimal=self._decimals)
+        finally:
+            nfft.set_wisdom_directory(None)
+
+    def test_window(self):
+        a = numpy.random.random((self._size, )*3)
+        coordinates = numpy.random.random((50, 3)) - 0.5
+        ft_nfft = nfft.nfft(a, coordinates)
+        numpy.testing.assert_allclose(nfft.nfft(a, coordinates, m=8, sigma=2.), ft_nfft, rtol=0, atol=1E-10*abs(ft_nfft).max())
+        plan = nfft.Plan(a.shape, len(coordinates), m=3, sigma=1.5)
+        plan.set_coordinates(coordinates)
+        plan.set_map(a)
+        numpy.testing.assert_allclose(plan.transform(), ft_nfft, rtol=0, atol=1E-3*abs(ft_nfft).max())
+        # The window of the NumPy backend is calculated in chunks of points
+        chunk_bytes = nfft._NUMPY_CHUNK_BYTES
+        nfft.set_backend("numpy")
+        try:
+            ft_numpy = nfft.nfft(a, coordinates)
+            nfft._NUMPY_CHUNK_BYTES = 1
+            numpy.testing.assert_array_equal(nfft.nfft(a, coordinates), ft_numpy)
+        finally:
+            nfft._NUMPY_CHUNK_BYTES = chunk_bytes
+            nfft.set_backend("auto")
+        self.assertRaises(ValueError, nfft.nfft, a, coordinates, sigma=1.)
+        self.assertRaises(ValueError, nfft.Plan, a.shape, len(coordinates), m=0)